@@ -0,0 +1,4 @@
+"""Performance benchmarks for kcli.
+
+Run a benchmark with ``python -m benchmarks.<name>`` from the repository root.
+"""
@@ -0,0 +1,130 @@
+"""Startup benchmark for the kcli commands.
+
+Every command is run in a fresh interpreter under ``python -X importtime``
+against an empty temporary knowledge base. The benchmark fails when the
+median wall time of a command exceeds its budget, when a command exits with an
+error, or when it imports a module it has no use for.
+
+Usage:
+    python -m benchmarks.startup [--runs 5] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+# command arguments -> (time budget in seconds, modules that must not be imported)
+BUDGETS: Dict[Tuple[str, ...], Tuple[float, Tuple[str, ...]]] = {
+    ("--help",): (0.5, ("numpy", "hnswlib", "litellm", "crawl4ai")),
+    ("doc", "1"): (1.0, ("hnswlib", "litellm", "crawl4ai")),
+    ("stats",): (1.0, ("hnswlib", "litellm", "crawl4ai")),
+}
+
+RUNNER = "import sys; from kcli.cli import main; main(sys.argv[1:])"
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """Parse ``-X importtime`` output.
+
+    Returns:
+        Dict[str, Tuple[int, int]]: Module name to (cumulative microseconds, nesting
+        depth), where depth 0 is an import made directly by the command.
+    """
+    modules: Dict[str, Tuple[int, int]] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(cumulative), depth)
+    return modules
+
+
+def run_command(
+    args: Tuple[str, ...], env: Dict[str, str]
+) -> Tuple[float, Dict[str, Tuple[int, int]], int]:
+    """Run one command in a fresh interpreter.
+
+    Returns:
+        Tuple[float, Dict[str, Tuple[int, int]], int]: Wall time, imports as parsed by
+        `parse_importtime`, and the exit code of the command.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", RUNNER, *args],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, parse_importtime(result.stderr), result.returncode
+
+
+def main(argv: List[str] = None) -> int:
+    """Run the startup benchmark and return the process exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Runs per command.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    options = parser.parse_args(argv)
+
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            KCLI_DB_PATH=os.path.join(tmp, "db.sqlite"),
+            KCLI_INDEX_PATH=os.path.join(tmp, "index.ann"),
+            KCLI_EMBEDDING_CACHE_PATH=os.path.join(tmp, "cache.sqlite"),
+        )
+        for args, (budget, forbidden) in BUDGETS.items():
+            times = []
+            imports: Dict[str, Tuple[int, int]] = {}
+            failed_runs = 0
+            for _ in range(options.runs):
+                elapsed, imports, returncode = run_command(args, env)
+                times.append(elapsed)
+                failed_runs += returncode != 0
+            median = statistics.median(times)
+            loaded = sorted(m for m in forbidden if m in imports)
+            top_level = {name: us for name, (us, depth) in imports.items() if depth == 0}
+            report.append(
+                {
+                    "command": " ".join(args),
+                    "median_s": round(median, 4),
+                    "budget_s": budget,
+                    "forbidden_imports": loaded,
+                    "failed_runs": failed_runs,
+                    "slowest_imports_ms": {
+                        name: round(us / 1000, 1)
+                        for name, us in sorted(top_level.items(), key=lambda i: -i[1])[:5]
+                    },
+                    "ok": median <= budget and not loaded and not failed_runs,
+                }
+            )
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for entry in report:
+            status = "ok" if entry["ok"] else "FAIL"
+            print(
+                f"{status:4} kcli {entry['command']:<8} {entry['median_s']:.3f}s "
+                f"(budget {entry['budget_s']}s)"
+            )
+            if entry["failed_runs"]:
+                print(f"     exited with an error in {entry['failed_runs']} run(s)")
+            if entry["forbidden_imports"]:
+                print(f"     imports {', '.join(entry['forbidden_imports'])}")
+            for name, ms in entry["slowest_imports_ms"].items():
+                print(f"     {ms:8.1f} ms  {name}")
+    return 0 if all(entry["ok"] for entry in report) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
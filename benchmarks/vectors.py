@@ -0,0 +1,348 @@
+"""Ingest and search benchmark for the kcli storage, on a synthetic corpus.
+
+The corpus is made of deterministic clustered vectors: the same seed, scale
+and dimension always give the same documents and queries, so two runs only
+differ by the code under test. Everything runs offline, the storage is opened
+with the local hashing embedding model, which is never called since the
+documents come with their embeddings.
+
+For each scale the benchmark measures:
+
+- ingest throughput of `Storage.add`, one document per transaction, and of
+  `Storage.add_many`, in bulk batches, then of the final index flush;
+- latency percentiles of single-query searches in the hnswlib index and in the
+  exact search matrix (re-ranked when it is quantized);
+- recall@k of both against the true neighbors, found by a full scan;
+- the size of the files on disk, and the resident memory of the process.
+
+Usage:
+    python -m benchmarks.vectors [--scales 1k,10k,100k,1m] [--dim 384] [--json]
+        [--out results.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+SCALE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+# Vectors generated at a time, so the corpus never has to fit in memory
+BLOCK = 10_000
+# Random stream of the queries, distinct from the block streams keyed by their start
+QUERY_STREAM = 2**40
+# Metrics compared by --compare, and whether higher is better
+COMPARED = {
+    "ingest.add_docs_per_s": True,
+    "ingest.add_many_docs_per_s": True,
+    "search.hnsw.p50_ms": False,
+    "search.hnsw.p99_ms": False,
+    "search.exact.p50_ms": False,
+    "search.exact.p99_ms": False,
+    "recall.hnsw": True,
+    "recall.exact": True,
+    "disk.total_bytes": False,
+    "memory.rss_delta_bytes": False,
+}
+
+
+def parse_scale(value: str) -> int:
+    """Parse a corpus size such as ``1000``, ``10k`` or ``1m``."""
+    value = value.strip().lower()
+    if value[-1:] in SCALE_SUFFIXES:
+        return int(float(value[:-1]) * SCALE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+class Corpus:
+    """Deterministic clustered unit vectors, generated block by block.
+
+    Each vector is a random cluster center plus Gaussian noise, so that
+    neighbors are meaningful, as with real embeddings, unlike uniform noise.
+    """
+
+    def __init__(
+        self: "Corpus", size: int, dim: int, clusters: int = 100, noise: float = 1.0, seed: int = 0
+    ) -> None:
+        """Define the corpus.
+
+        Args:
+            size (int): Number of vectors.
+            dim (int): Dimension of the vectors.
+            clusters (int): Number of cluster centers.
+            noise (float): Standard deviation of the noise, relative to the centers.
+            seed (int): Seed of every random draw.
+        """
+        self.size = size
+        self.dim = dim
+        self.noise = noise
+        self.seed = seed
+        self.centers = np.random.default_rng(seed).normal(size=(clusters, dim))
+
+    def _draw(self: "Corpus", rng: np.random.Generator, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        clusters = rng.integers(len(self.centers), size=n)
+        vectors = self.centers[clusters] + rng.normal(scale=self.noise, size=(n, self.dim))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.astype(np.float32), clusters
+
+    def blocks(self: "Corpus") -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """Yield ``(start, vectors, clusters)`` blocks of at most `BLOCK` rows, in order."""
+        for start in range(0, self.size, BLOCK):
+            rng = np.random.default_rng([self.seed, start])
+            yield (start, *self._draw(rng, min(BLOCK, self.size - start)))
+
+    def queries(self: "Corpus", n: int) -> np.ndarray:
+        """Return query vectors drawn like the corpus, but not part of it."""
+        return self._draw(np.random.default_rng([self.seed, QUERY_STREAM]), n)[0]
+
+    def neighbors(self: "Corpus", queries: np.ndarray, k: int) -> np.ndarray:
+        """Return the row numbers of the ``k`` true nearest vectors of each query."""
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start, vectors, _ in self.blocks():
+            scores = np.hstack([best_scores, queries @ vectors.T])
+            rows = np.arange(start, start + len(vectors))
+            rows = np.hstack([best_rows, np.broadcast_to(rows, (len(queries), len(rows)))])
+            top = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        return best_rows
+
+
+def documents(start: int, vectors: np.ndarray, clusters: np.ndarray) -> List["Document"]:  # noqa: F821
+    """Return one single-chunk document per vector, with unique contents."""
+    from kcli.storage import Chunk, Document
+
+    docs = []
+    for i, (vector, cluster) in enumerate(zip(vectors, clusters.tolist()), start=start):
+        content = f"Synthetic document {i} of cluster {cluster}."
+        docs.append(
+            Document(
+                content=content,
+                url=f"https://bench.example/{i}",
+                title=f"doc {i}",
+                created_at=datetime(2024, 1, 1),
+                embedding=None,
+                meta={},
+                chunks=[Chunk(0, len(content), vector)],
+            )
+        )
+    return docs
+
+
+def rss_bytes() -> int:
+    """Return the resident memory of the process, or 0 where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    """Return the p50, p95 and p99 of durations, in milliseconds."""
+    p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+    return {"p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3)}
+
+
+def recall(found: List[List[int]], truth: np.ndarray) -> float:
+    """Return the fraction of the true neighbors that were found."""
+    hits = sum(len(set(ids) & set(expected)) for ids, expected in zip(found, truth.tolist()))
+    return round(hits / max(truth.size, 1), 4)
+
+
+def bench_scale(
+    size: int, options: argparse.Namespace, directory: str
+) -> Dict[str, Dict[str, float]]:
+    """Ingest and search a corpus of ``size`` vectors in a new knowledge base."""
+    from kcli import storage as storage_module
+
+    os.environ["KCLI_DB_PATH"] = os.path.join(directory, "db.sqlite")
+    os.environ["KCLI_INDEX_PATH"] = os.path.join(directory, "index.ann")
+    storage_module.configure()
+    rss_before = rss_bytes()
+    storage = storage_module.Storage()
+    corpus = Corpus(size, options.dim, seed=options.seed)
+
+    single = min(size, options.single)
+    add_seconds = add_many_seconds = 0.0
+    for start, vectors, clusters in corpus.blocks():
+        docs = documents(start, vectors, clusters)
+        # The first documents go through the one-transaction-per-document path
+        singles, docs = docs[: max(single - start, 0)], docs[max(single - start, 0) :]
+        began = time.perf_counter()
+        for doc in singles:
+            storage.add(doc)
+        add_seconds += time.perf_counter() - began
+        began = time.perf_counter()
+        for batch in range(0, len(docs), options.batch):
+            storage.add_many(docs[batch : batch + options.batch])
+        add_many_seconds += time.perf_counter() - began
+    began = time.perf_counter()
+    storage.flush_index()
+    flush_seconds = time.perf_counter() - began
+    # Documents get increasing ids, so the chunk of corpus row i is the i-th one
+    labels = np.array(
+        [row[0] for row in storage.db.execute("SELECT id FROM chunks ORDER BY document_id")]
+    )
+
+    queries = corpus.queries(options.queries)
+    truth = labels[corpus.neighbors(queries, options.k)]
+    report: Dict[str, Dict] = {"search": {}, "recall": {}}
+    for name, search in (("hnsw", storage._hnsw_candidates), ("exact", storage._exact_candidates)):
+        search(queries[:1], options.k)  # warm up: load the index, map the matrix
+        found, seconds = [], []
+        for query in queries:
+            began = time.perf_counter()
+            ((ids, _),) = search(query[None], options.k)
+            seconds.append(time.perf_counter() - began)
+            found.append(ids)
+        report["search"][name] = percentiles(seconds)
+        report["recall"][name] = recall(found, truth)
+
+    files = {
+        "db_bytes": os.path.getsize(storage.db_path),
+        "index_bytes": os.path.getsize(storage.index_path),
+        "matrix_bytes": storage.exact.nbytes(),
+    }
+    report["disk"] = {**files, "total_bytes": sum(files.values())}
+    report["memory"] = {"rss_delta_bytes": rss_bytes() - rss_before}
+    storage.close()
+    report["ingest"] = {
+        "add_docs": single,
+        "add_docs_per_s": round(single / add_seconds, 1) if single else None,
+        "add_many_docs": size - single,
+        "add_many_docs_per_s": (
+            round((size - single) / add_many_seconds, 1) if size > single else None
+        ),
+        "flush_s": round(flush_seconds, 3),
+    }
+    return {"size": size, **report}
+
+
+def git_commit() -> Optional[str]:
+    """Return the commit of the working tree, or None outside of a git checkout."""
+    try:
+        result = subprocess.run(  # noqa: S603
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def metric(entry: Dict, path: str) -> Optional[float]:
+    """Return a nested metric of a scale entry, such as ``search.hnsw.p50_ms``."""
+    for key in path.split("."):
+        if not isinstance(entry, dict) or key not in entry:
+            return None
+        entry = entry[key]
+    return entry
+
+
+def compare(previous: Dict, current: Dict) -> List[str]:
+    """Describe the changes of the compared metrics between two runs, scale by scale."""
+    lines = [f"{previous.get('commit')} -> {current.get('commit')}"]
+    before = {entry["size"]: entry for entry in previous["results"]}
+    for entry in current["results"]:
+        if entry["size"] not in before:
+            continue
+        for path, higher_is_better in COMPARED.items():
+            old, new = metric(before[entry["size"]], path), metric(entry, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            better = (change > 0) == higher_is_better
+            flag = "" if abs(change) < 5 else (" better" if better else " WORSE")
+            lines.append(
+                f"{entry['size']:>9} {path:<28} {old:>14} -> {new:<14} {change:+.1f}%{flag}"
+            )
+    return lines
+
+
+def main(argv: List[str] = None) -> int:
+    """Run the benchmark and return the process exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="1k,10k", help="Corpus sizes, as in 1k,10k,100k,1m.")
+    parser.add_argument("--dim", type=int, default=384, help="Dimension of the vectors.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of search queries.")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query.")
+    parser.add_argument("--single", type=int, default=1000, help="Documents added one by one.")
+    parser.add_argument("--batch", type=int, default=1000, help="Documents per add_many batch.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus.")
+    parser.add_argument(
+        "--matrix-dtype", default="float32", help="Type of the exact search matrix."
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    parser.add_argument("--out", help="Write the JSON results to this file.")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with.")
+    options = parser.parse_args(argv)
+
+    # Before kcli reads its configuration: offline model, no daemon, quiet logs
+    os.environ["KCLI_EMBEDDING_MODEL"] = f"local/hashing-{options.dim}"
+    os.environ["KCLI_MATRIX_DTYPE"] = options.matrix_dtype
+    os.environ["KCLI_NO_DAEMON"] = "1"
+    from kcli.log import console
+
+    console.quiet = True
+    report = {
+        "benchmark": "vectors",
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": {
+            key: value
+            for key, value in vars(options).items()
+            if key not in ("json", "out", "compare")
+        },
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["KCLI_EMBEDDING_CACHE_PATH"] = os.path.join(tmp, "cache.sqlite")
+        for size in map(parse_scale, options.scales.split(",")):
+            directory = os.path.join(tmp, str(size))
+            os.makedirs(directory)
+            report["results"].append(bench_scale(size, options, directory))
+
+    if options.out:
+        with open(options.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for entry in report["results"]:
+            ingest, search = entry["ingest"], entry["search"]
+            print(
+                f"{entry['size']:>9} docs  add {ingest['add_docs_per_s']}/s  "
+                f"add_many {ingest['add_many_docs_per_s']}/s  flush {ingest['flush_s']}s"
+            )
+            for name in ("hnsw", "exact"):
+                print(
+                    f"{'':>9} {name:<6} p50 {search[name]['p50_ms']}ms  "
+                    f"p95 {search[name]['p95_ms']}ms  p99 {search[name]['p99_ms']}ms  "
+                    f"recall@{options.k} {entry['recall'][name]}"
+                )
+            print(
+                f"{'':>9} disk {entry['disk']['total_bytes'] / 2**20:.1f} MiB  "
+                f"rss +{entry['memory']['rss_delta_bytes'] / 2**20:.1f} MiB"
+            )
+    if options.compare:
+        with open(options.compare) as f:
+            print("\n".join(compare(json.load(f), report)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,12 +5,9 @@ __version__ = "0.1.0"
 
 import logging
 
-from rich.console import Console
-
-import kcli.storage as storage
-
-storage.configure()
+from kcli.log import console
 
 logging.getLogger("LiteLLM").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
-console = Console()
+
+__all__ = ["console"]
@@ -0,0 +1,152 @@
+"""Persistent embedding cache for kcli."""
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+CACHE_DTYPE = np.float32
+
+
+def text_hash(text: str) -> str:
+    """Return the SHA-256 hex digest used to key a text in the cache."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache stored in SQLite.
+
+    Entries are keyed by ``(model, sha256(text))``. When the cache holds more than
+    ``max_entries`` vectors the least recently used ones are evicted. The cache
+    may be shared by threads embedding concurrently.
+    """
+
+    def __init__(self: "EmbeddingCache", path: str, max_entries: int = 100_000) -> None:
+        """Open or create the cache database.
+
+        Args:
+            path (str): Path of the SQLite file holding the cache.
+            max_entries (int): Maximum number of cached vectors before eviction.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Serializes each read-modify-commit sequence on the shared connection
+        self.lock = threading.Lock()
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            );
+            """
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self.db.commit()
+
+    def get_many(
+        self: "EmbeddingCache", model: str, texts: Sequence[str]
+    ) -> List[Optional[np.ndarray]]:
+        """Look up the cached vectors of several texts.
+
+        Args:
+            model (str): Name of the embedding model.
+            texts (Sequence[str]): Texts to look up.
+
+        Returns:
+            List[Optional[np.ndarray]]: One entry per text, None on a cache miss.
+        """
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        unique = list(set(hashes))
+        with self.lock:
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(unique), 500):
+                batch = unique[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.db.execute(
+                    f"""
+                    SELECT text_hash, vector FROM embeddings
+                    WHERE model = ? AND text_hash IN ({placeholders})
+                    """,
+                    [model, *batch],
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=CACHE_DTYPE)
+            if found:
+                now = time.time()
+                self.db.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, key) for key in found],
+                )
+                self.db.commit()
+            results = [found.get(key) for key in hashes]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(
+        self: "EmbeddingCache",
+        model: str,
+        texts: Sequence[str],
+        vectors: Sequence[np.ndarray],
+    ) -> None:
+        """Store vectors for several texts and evict old entries if needed.
+
+        Args:
+            model (str): Name of the embedding model.
+            texts (Sequence[str]): Texts that were embedded.
+            vectors (Sequence[np.ndarray]): Their embeddings, in the same order.
+        """
+        with self.lock:
+            now = time.time()
+            self.db.executemany(
+                """
+                INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (
+                        model,
+                        text_hash(text),
+                        np.asarray(vector, dtype=CACHE_DTYPE).tobytes(),
+                        now,
+                    )
+                    for text, vector in zip(texts, vectors)
+                ],
+            )
+            self._evict()
+            self.db.commit()
+
+    def _evict(self: "EmbeddingCache") -> None:
+        (count,) = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                """
+                DELETE FROM embeddings WHERE rowid IN (
+                    SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?
+                )
+                """,
+                (count - self.max_entries,),
+            )
+
+    def stats(self: "EmbeddingCache") -> Dict[str, int]:
+        """Return hit/miss counters of this process and the size of the cache."""
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length(vector)), 0) FROM embeddings"
+        ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self: "EmbeddingCache") -> None:
+        """Close the cache database."""
+        self.db.close()
@@ -1,43 +1,353 @@
-"""CLI implementation for kcli."""
+"""CLI implementation for kcli.
+
+Commands import `kcli.main` and other heavy modules inside their body, so that
+`kcli --help` and cheap commands do not pay for numpy, litellm or crawl4ai.
+"""
+
+from datetime import datetime
+from typing import Any, Optional, TextIO
 
 import click
-from rich.table import Table
 
 from kcli.log import console
-from kcli.main import (
-    add_file,
-    crawl_web_content,
-    get_knowledge_base_stats,
-    search_knowledge_base,
-)
-from kcli.main import get_document_by_id
+
+# Operations of `_dispatch` writing to the knowledge base, see `_refuse_beside_daemon`
+WRITE_OPS = {"add", "add_dir", "sync", "web", "crawl_site", "rm", "compact"}
+# Commands writing to the knowledge base
+WRITE_COMMANDS = {"add", "add-dir", "sync", "web", "rm", "compact", "migrate"}
 
 
 @click.group()
 @click.version_option()
-def main() -> None:
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time the stages of the command and report them on stderr. The command runs in "
+    "this process, so commands writing to the knowledge base refuse to run while a daemon "
+    "is running.",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice(["table", "json", "chrome"]),
+    default="table",
+    show_default=True,
+    help="Per-stage table, JSON summary, or Chrome trace of every span.",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the JSON summary, or the Chrome trace, to this file instead of stderr.",
+)
+@click.pass_context
+def main(
+    ctx: click.Context, profile: bool, profile_format: str, profile_output: Optional[str]
+) -> None:
     """KCLI - Local Knowledge Base CLI."""
-    pass
+    if profile or profile_output:
+        import os
+
+        from kcli import profiling
+
+        if ctx.invoked_subcommand in WRITE_COMMANDS:
+            _refuse_beside_daemon(f"kcli --profile {ctx.invoked_subcommand}")
+        # The stages run by a daemon would not be seen
+        os.environ["KCLI_NO_DAEMON"] = "1"
+        profiling.enable()
+        ctx.call_on_close(lambda: _report_profile(profile_format, profile_output))
+
+
+def _report_profile(profile_format: str, output: Optional[str]) -> None:
+    """Print or write the stages recorded by `kcli.profiling`."""
+    import json
+
+    from rich.console import Console
+    from rich.table import Table
+
+    from kcli import profiling
+
+    profiling.disable()
+    # A table is only printed, a file gets the JSON summary unless a trace is asked for
+    if profile_format != "table" or output:
+        data = profiling.chrome_trace() if profile_format == "chrome" else profiling.summary()
+        text = json.dumps(data, indent=2, default=str)
+        if output:
+            with open(output, "w") as f:
+                f.write(text)
+        else:
+            click.echo(text, err=True)
+        return
+    summary = profiling.summary()
+    table = Table(title=f"Profile, {summary['wall_ms']:.1f} ms wall time")
+    for column in ("Stage", "Calls", "Total ms", "Mean ms", "Max ms"):
+        table.add_column(column, justify="left" if column == "Stage" else "right")
+    for name, stage in summary["stages"].items():
+        table.add_row(
+            name,
+            str(stage["calls"]),
+            f"{stage['total_ms']:.2f}",
+            f"{stage['mean_ms']:.2f}",
+            f"{stage['max_ms']:.2f}",
+        )
+    for name, value in summary["counters"].items():
+        table.add_row(name, "", f"{value:g}", "", "", style="dim")
+    Console(stderr=True).print(table)
+
+
+@main.result_callback()
+def close(*args: object, **kwargs: object) -> None:
+    """Flush pending index updates once a command is done."""
+    import sys
+
+    if "kcli.main" in sys.modules:
+        from kcli.main import close_storage
+
+        close_storage()
+
+
+def _dispatch(op: str, **args: Any) -> Any:
+    """Run an operation in the daemon when one is running, in this process otherwise.
+
+    Args:
+        op (str): Name of the operation, see `kcli.server.HANDLERS`.
+        **args (Any): JSON-serializable arguments of the operation.
+
+    Returns:
+        Any: The JSON result of the operation.
+    """
+    import os
+
+    from kcli.server import HANDLERS, DaemonError, DaemonUnavailable, request
+
+    try:
+        return request(op, **args)
+    except DaemonUnavailable:
+        if op in WRITE_OPS and os.environ.get("KCLI_NO_DAEMON"):
+            _refuse_beside_daemon(f"kcli {op.replace('_', '-')} with KCLI_NO_DAEMON")
+        return HANDLERS[op](**args)
+    except DaemonError as e:
+        raise click.ClickException(str(e)) from e
+
+
+def _refuse_beside_daemon(action: str) -> None:
+    """Refuse to write to the knowledge base in this process while a daemon is running.
+
+    The daemon keeps its own copy of the hnswlib index in memory, and would
+    save it over the changes made by this process.
+
+    Args:
+        action (str): What would write in this process, for the error message.
+
+    Raises:
+        click.ClickException: If a daemon answers on the socket.
+    """
+    from kcli.server import running_daemon
+
+    pid = running_daemon()
+    if pid is not None:
+        raise click.ClickException(
+            f"{action} writes to the knowledge base in this process, but the daemon {pid} "
+            "holds its index. Stop the daemon first."
+        )
+
+
+def _print_embedding_stats() -> None:
+    """Print the embedding requests sent by this command, if any."""
+    from kcli.embeddings import get_embeddings
+
+    stats = get_embeddings().stats.summary()
+    if stats["requests"]:
+        console.print(
+            f"Embedding requests: {stats['requests']} ({stats['retries']} retries), "
+            f"latency p50 {stats['latency_p50'] * 1000:.0f} ms, "
+            f"p95 {stats['latency_p95'] * 1000:.0f} ms, "
+            f"{stats['tokens_per_second']:.0f} tokens/s"
+        )
 
 
 @main.command()
-@click.argument("url")
-def web(url: str) -> None:
+@click.argument("urls", nargs=-1)
+@click.option(
+    "--file",
+    "url_file",
+    type=click.File("r"),
+    help="File with one URL per line, - for standard input. Lines starting with # are skipped.",
+)
+@click.option(
+    "--concurrency", default=4, show_default=True, help="Pages fetched or embedded at once."
+)
+@click.option(
+    "--batch-size", default=32, show_default=True, help="Documents stored per transaction."
+)
+@click.option(
+    "--depth",
+    default=0,
+    show_default=True,
+    help="Follow links this many levels deep from the given URLs.",
+)
+@click.option(
+    "--same-domain/--any-domain",
+    default=True,
+    show_default=True,
+    help="Only follow links to the host of the starting URL.",
+)
+@click.option(
+    "--delay",
+    default=1.0,
+    show_default=True,
+    help="Seconds between two requests to the same host, when following links.",
+)
+@click.option("--resume", is_flag=True, help="Continue the URLs left pending by a previous crawl.")
+def web(
+    urls: tuple,
+    url_file: Optional[TextIO],
+    concurrency: int,
+    batch_size: int,
+    depth: int,
+    same_domain: bool,
+    delay: float,
+    resume: bool,
+) -> None:
     """Crawl and add web content to knowledge base."""
-    console.print(f"Crawling {url}...")
-    crawl_web_content(url)
+    urls = list(urls)
+    if url_file is not None:
+        lines = (line.strip() for line in url_file)
+        urls.extend(line for line in lines if line and not line.startswith("#"))
+    if not urls and not resume:
+        raise click.UsageError("Give at least one URL, or --file, or --resume.")
+
+    if depth > 0 or resume:
+        console.print(f"Crawling {len(urls)} URL(s) up to depth {depth}...")
+        summary = _dispatch(
+            "crawl_site",
+            seeds=urls,
+            depth=depth,
+            same_domain=same_domain,
+            concurrency=concurrency,
+            delay=delay,
+            batch_size=batch_size,
+        )
+        console.print(
+            f"Added {summary['documents']} of {summary['pages']} pages "
+            f"({summary['updated']} updated, {summary['skipped']} already stored, "
+            f"{summary['failed']} failed) in {summary['seconds']:.1f}s"
+        )
+        _print_embedding_stats()
+        return
+
+    console.print(f"Crawling {len(urls)} URL(s)...")
+    summary = _dispatch("web", urls=urls, concurrency=concurrency, batch_size=batch_size)
+    console.print(
+        f"Added {summary['documents']} of {summary['urls']} pages "
+        f"({summary['updated']} updated, {summary['skipped']} already stored, "
+        f"{summary['failed']} failed) in {summary['seconds']:.1f}s"
+    )
+    _print_embedding_stats()
 
 
 @main.command()
-@click.argument("query")
+@click.argument("query", required=False)
+@click.option(
+    "--content", is_flag=True, help="Display the full text of the matching passages."
+)
+@click.option("--json", "as_json", is_flag=True, help="Print one JSON line per result.")
+@click.option(
+    "--batch",
+    "batch_file",
+    type=click.File("r"),
+    help="File with one query per line, - for standard input. Prints one JSON line per query.",
+)
+@click.option("--limit", default=10, show_default=True, help="Documents returned per query.")
+@click.option(
+    "--offset", default=0, show_default=True, help="Best documents to skip, to page results."
+)
+@click.option(
+    "--ef", type=int, default=None, help="hnswlib search depth, higher is slower but more accurate."
+)
 @click.option(
-    "--content", is_flag=True, help="Display the content of the search results."
+    "--mode",
+    type=click.Choice(["vector", "lexical", "hybrid"]),
+    default="vector",
+    show_default=True,
+    help="Rank by embedding similarity, by keywords (BM25), or by both.",
 )
-def search(query: str, content: bool) -> None:
+@click.option(
+    "--source", type=click.Choice(["web", "file"]), help="Only search crawled pages or files."
+)
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    help="Only search documents added at or after this date.",
+)
+@click.option("--url-prefix", help="Only search pages whose URL starts with this prefix.")
+@click.option(
+    "--path-prefix",
+    type=click.Path(),
+    help="Only search files below this path.",
+)
+def search(
+    query: str,
+    content: bool,
+    as_json: bool,
+    ef: Optional[int],
+    mode: str,
+    source: Optional[str],
+    since: Optional[datetime],
+    url_prefix: Optional[str],
+    path_prefix: Optional[str],
+    batch_file: Optional[TextIO],
+    limit: int,
+    offset: int,
+) -> None:
     """Search the knowledge base."""
-    console.print(f"Searching for: {query}")
-    results = search_knowledge_base(query)
-    console.print(results)
+    import json
+    import os
+
+    from kcli import profiling
+    from kcli.render import SNIPPET_CHARS, result_panel, results_table
+
+    filters = None
+    if source or since or url_prefix or path_prefix:
+        # The JSON form of a `SearchFilter`, see `kcli.server`
+        filters = {
+            "source": source,
+            "since": since.isoformat() if since else None,
+            "url_prefix": url_prefix,
+            "path_prefix": os.path.abspath(path_prefix) if path_prefix else None,
+        }
+    options = {"limit": limit, "offset": offset, "mode": mode, "ef": ef, "filters": filters}
+    if batch_file is not None:
+        _search_batch(batch_file, options)
+        return
+    if query is None:
+        raise click.UsageError("Give a query, or --batch.")
+    if not (content or as_json):
+        # The table only shows the start of the best passage
+        options["passage_chars"] = SNIPPET_CHARS
+    if not as_json:
+        # Standard output only carries the JSON lines
+        console.print(f"Searching for: {query}")
+    results = _dispatch("search", query=query, **options)
+    with profiling.span("render"):
+        if as_json:
+            for result in results:
+                click.echo(json.dumps(result))
+        elif content:
+            for result in results:
+                console.print(result_panel(result))
+        else:
+            console.print(results_table(results) if results else None)
+
+
+def _search_batch(batch_file: TextIO, options: dict, batch_size: int = 256) -> None:
+    """Print the results of each query of a file as a JSON line, a batch at a time."""
+    import json
+    from itertools import islice
+
+    lines = (line.strip() for line in batch_file)
+    queries = (line for line in lines if line)
+    while batch := list(islice(queries, batch_size)):
+        for query, results in zip(batch, _dispatch("search_many", queries=batch, **options)):
+            click.echo(json.dumps({"query": query, "results": results}))
 
 
 @main.command()
@@ -46,8 +356,68 @@ def search(query: str, content: bool) -> None:
 )
 def add(file_path: str) -> None:
     """Add a local file to the knowledge base."""
+    import os
+
     console.log(f"Adding file: {file_path}")
-    add_file(file_path)
+    _dispatch("add", file_path=os.path.abspath(file_path))
+
+
+@main.command("add-dir")
+@click.argument(
+    "directory", type=click.Path(exists=True, file_okay=False, dir_okay=True)
+)
+@click.option(
+    "--glob",
+    "patterns",
+    multiple=True,
+    default=("**/*",),
+    show_default=True,
+    help="Glob pattern of the files to add, can be repeated.",
+)
+@click.option("--exclude", multiple=True, help="Pattern of files to skip, can be repeated.")
+@click.option("--workers", default=8, show_default=True, help="Threads reading files.")
+@click.option(
+    "--batch-size", default=256, show_default=True, help="Maximum files per embedding batch."
+)
+def add_dir(
+    directory: str, patterns: tuple, exclude: tuple, workers: int, batch_size: int
+) -> None:
+    """Add all matching files of a directory to the knowledge base."""
+    import os
+
+    summary = _dispatch(
+        "add_dir",
+        directory=os.path.abspath(directory),
+        patterns=patterns,
+        excludes=exclude,
+        workers=workers,
+        batch_docs=batch_size,
+    )
+    seconds = max(summary["seconds"], 1e-9)
+    console.print(
+        f"Added {summary['documents']} of {summary['files']} files "
+        f"({summary['skipped']} skipped) in {summary['seconds']:.1f}s: "
+        f"{summary['documents'] / seconds:.1f} docs/s, "
+        f"{summary['chunks'] / seconds:.1f} chunks/s"
+    )
+    _print_embedding_stats()
+
+
+@main.command()
+@click.option("--workers", default=8, show_default=True, help="Threads reading new files.")
+@click.option(
+    "--batch-size", default=256, show_default=True, help="Maximum files per embedding batch."
+)
+def sync(workers: int, batch_size: int) -> None:
+    """Re-index the added files and directories that changed."""
+    summary = _dispatch("sync", workers=workers, batch_docs=batch_size)
+    console.print(
+        f"Synced {summary['files']} files in {summary['seconds']:.1f}s: "
+        f"{summary['added']} added, {summary['updated']} updated, "
+        f"{summary['removed']} removed, {summary['unchanged']} unchanged. "
+        f"Embedded {summary['chunks']} chunks, reused {summary['reused']}."
+    )
+    _print_embedding_stats()
 
 
 @main.command()
@@ -55,22 +425,132 @@ def add(file_path: str) -> None:
 def doc(doc_id: int) -> None:
     """Retrieve and display a document by its ID."""
     console.print(f"Retrieving document with ID: {doc_id}")
-    doc = get_document_by_id(doc_id)
+    doc = _dispatch("doc", doc_id=doc_id)
     if doc:
-        console.print(f"[bold cyan]Title:[/bold cyan] {doc.title}")
-        console.print(f"[bold]Content:[/bold]\n{doc.content}")
+        console.print(f"[bold cyan]Title:[/bold cyan] {doc['title']}")
+        console.print(f"[bold]Content:[/bold]\n{doc['content']}")
     else:
         console.print(f"Document with ID {doc_id} not found.")
 
 
+def _document_ref(ref: str) -> str:
+    """Return a document ID or URL prefix, turning a local path into its file URL."""
+    import os
+
+    if ref.isdigit() or not os.path.exists(ref):
+        return ref
+    path = os.path.abspath(ref)
+    # A directory only matches the files below it, not its sibling "dir2"
+    return f"file://{os.path.join(path, '') if os.path.isdir(path) else path}"
+
+
+@main.command()
+@click.argument("refs", nargs=-1, required=True)
+@click.option("--dry-run", is_flag=True, help="List the matching documents without deleting.")
+@click.option("--yes", "-y", is_flag=True, help="Delete several documents without asking.")
+def rm(refs: tuple, dry_run: bool, yes: bool) -> None:
+    """Delete documents by ID, URL prefix, or path of an added file or directory.
+
+    Files of a directory tracked by `kcli sync` are added back by the next sync
+    while they exist.
+    """
+    refs = [_document_ref(ref) for ref in refs]
+    found = _dispatch("rm", refs=refs, dry_run=True)["documents"]
+    for match in found:
+        console.print(f"{match['id']:>6}  {match['title']}  [dim]{match['url'] or ''}[/dim]")
+    if not found:
+        raise click.ClickException("No matching document.")
+    if dry_run:
+        return
+    if len(found) > 1 and not yes:
+        click.confirm(f"Delete these {len(found)} documents?", abort=True)
+    result = _dispatch("rm", refs=refs)
+    console.print(f"Deleted {result['deleted']} documents.")
+    if result["compact"]:
+        console.print("Many indexed vectors are now deleted, run `kcli compact` to reclaim them.")
+
+
+@main.command()
+@click.option(
+    "--force", is_flag=True, help="Compact even below KCLI_COMPACT_THRESHOLD deleted vectors."
+)
+def compact(force: bool) -> None:
+    """Rebuild the indexes without the vectors of deleted documents, and vacuum."""
+    from kcli.render import format_bytes
+
+    result = _dispatch("compact", force=force)
+    if not result["compacted"]:
+        console.print(
+            f"Only {result['ratio']:.1%} of the indexed vectors are deleted, below "
+            f"KCLI_COMPACT_THRESHOLD ({result['threshold']:.0%}). Use --force to compact anyway."
+        )
+        return
+    before = result["before"]
+    console.print(
+        f"Removed {result['index']} deleted vectors from the index and {result['matrix']} "
+        f"from the exact search matrix in {result['seconds']:.1f}s, "
+        f"{result['vectors']} vectors left. "
+        f"Database {format_bytes(before['db_bytes'])} -> {format_bytes(result['db_bytes'])}, "
+        f"index {format_bytes(before['index_bytes'])} -> {format_bytes(result['index_bytes'])}."
+    )
+
+
+@main.command()
+@click.option(
+    "--batch-size", default=500, show_default=True, help="Rows converted per transaction."
+)
+def migrate(batch_size: int) -> None:
+    """Convert an existing database to the current storage format."""
+    # The migration replaces the index files, it cannot run beside a daemon
+    _refuse_beside_daemon("kcli migrate")
+    from kcli.main import migrate_database
+
+    converted = migrate_database(batch_size)
+    console.print(f"Migrated {converted} embeddings.")
+
+
+@main.command()
+@click.option("--k", "k", default=10, show_default=True, help="Neighbors compared per query.")
+@click.option("--queries", default=100, show_default=True, help="Number of sampled queries.")
+def recall(k: int, queries: int) -> None:
+    """Measure the recall@k of the vector searches against a full-precision scan."""
+    from rich.table import Table
+
+    from kcli.main import measure_recall
+
+    report = measure_recall(k, queries)
+    table = Table(title=f"Recall@{k} over {report['queries']} queries")
+    table.add_column("Search")
+    table.add_column("Recall")
+    for search in ("matrix", "reranked", "hnsw"):
+        if search in report:
+            table.add_row(search, f"{report[search]:.3f}")
+    console.print(table)
+    ratio = report["float32_bytes"] / max(report["matrix_bytes"], 1)
+    console.print(
+        f"Exact search matrix: {report['dtype']}, {report['matrix_bytes'] / 2**20:.1f} MiB"
+        f" ({ratio:.1f}x smaller than float32)"
+    )
+
+
+@main.command()
+@click.option("--socket", "socket_path", type=click.Path(), help="Path of the Unix socket.")
+def serve(socket_path: Optional[str]) -> None:
+    """Keep the knowledge base loaded and answer the other commands over a socket."""
+    from kcli.server import serve as run_daemon
+
+    try:
+        run_daemon(socket_path)
+    except RuntimeError as e:
+        raise click.ClickException(str(e)) from e
+
+
 @main.command()
 def stats() -> None:
     """Display knowledge base statistics."""
-    table = Table(title="Knowledge Base Statistics")
-    table.add_column("Metric")
-    table.add_column("Value")
-    get_knowledge_base_stats()
-    console.print(table)
+    from kcli.render import stats_table
+
+    console.print(stats_table(_dispatch("stats")))
 
 
 if __name__ == "__main__":
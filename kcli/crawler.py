@@ -1,51 +1,344 @@
 """Crawler module for kcli."""
+import asyncio
 from datetime import datetime
-from typing import Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 
-from crawl4ai import AsyncWebCrawler, BrowserConfig, CacheMode, CrawlerRunConfig
-
-from kcli.embeddings import embeddings
+from kcli import profiling
+from kcli.embeddings import get_embeddings
 from kcli.log import console
-from kcli.storage import Document
+from kcli.storage import Chunk, Document
+
+if TYPE_CHECKING:
+    from crawl4ai import AsyncWebCrawler, BrowserConfig
+
+    from kcli.storage import Storage
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _browser_config() -> "BrowserConfig":
+    from crawl4ai import BrowserConfig
+
+    return BrowserConfig(
+        headless=True,
+        verbose=False,
+    )
+
+
+def normalize_url(url: str, base: Optional[str] = None) -> Optional[str]:
+    """Normalize a URL so that equivalent spellings deduplicate.
+
+    The scheme and host are lowercased, default ports, fragments and empty paths
+    are dropped and query parameters are sorted.
+
+    Args:
+        url (str): Absolute URL, or a link relative to ``base``.
+        base (Optional[str]): URL of the page the link was found on.
+
+    Returns:
+        Optional[str]: The normalized URL, or None if it is not an HTTP(S) URL.
+    """
+    try:
+        parts = urlsplit(urljoin(base, url) if base else url.strip())
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None
+    if scheme not in DEFAULT_PORTS or not host:
+        return None
+    netloc = host if port in (None, DEFAULT_PORTS[scheme]) else f"{host}:{port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class HostRateLimiter:
+    """Spaces the requests made to each host by at least ``delay`` seconds."""
+
+    def __init__(self: "HostRateLimiter", delay: float) -> None:
+        """Initialize the limiter.
+
+        Args:
+            delay (float): Minimum number of seconds between two requests to a host.
+        """
+        self.delay = delay
+        self._next: Dict[str, float] = {}
+
+    async def wait(self: "HostRateLimiter", host: str) -> None:
+        """Wait until a request to ``host`` is allowed, and book the next slot."""
+        now = asyncio.get_running_loop().time()
+        ready = max(now, self._next.get(host, now))
+        self._next[host] = ready + self.delay
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+
+async def _fetch(crawler: "AsyncWebCrawler", url: str) -> Optional[Any]:
+    """Fetch a page, returning the crawl4ai result or None on failure."""
+    from crawl4ai import CacheMode, CrawlerRunConfig
+
+    run_config = CrawlerRunConfig(
+        cache_mode=CacheMode.ENABLED,
+    )
+    try:
+        result = await crawler.arun(
+            url=url,
+            config=run_config,
+        )
+    except Exception as e:
+        console.log(f"Error processing URL {url}: {e}")
+        return None
+    if not result or not result.markdown:
+        console.log(f"Failed to crawl or extract content from {url}")
+        return None
+    return result
+
 
+async def _to_document(
+    url: str, result: Any, known: Optional[Callable[[str], bool]] = None
+) -> Document:
+    """Build the document of a fetched page, embedding it in a thread."""
+    chunks = []
+    if known is None or not known(result.markdown):
+        # Embed in a thread, so other pages are fetched meanwhile
+        (spans,) = await asyncio.to_thread(get_embeddings().chunk_and_embed, [result.markdown])
+        chunks = [Chunk(*span) for span in spans]
+    return Document(
+        content=result.markdown,
+        url=url,
+        title=result.metadata.get("title", ""),
+        created_at=datetime.now(),
+        embedding=None,
+        meta={"source": "web"},
+        chunks=chunks,
+    )
+
+
+def _links(url: str, result: Any) -> List[str]:
+    """Return the normalized HTTP(S) links of a fetched page."""
+    links = result.links or {}
+    if isinstance(links, dict):
+        links = [link for group in links.values() for link in group]
+    hrefs = (link.get("href") if isinstance(link, dict) else link for link in links)
+    normalized = (normalize_url(href, base=url) for href in hrefs if href)
+    return list(dict.fromkeys(link for link in normalized if link))
 
-async def process_url(url: str) -> Optional[Document]:
+
+async def process_url(
+    url: str,
+    crawler: Optional["AsyncWebCrawler"] = None,
+    known: Optional[Callable[[str], bool]] = None,
+) -> Optional[Document]:
     """Process a URL and return a Document.
 
     Args:
         url (str): URL string to fetch and process into a document. Must be a valid HTTP/HTTPS URL.
+        crawler (Optional[AsyncWebCrawler]): Started crawler to fetch the page with. A new
+            browser is launched for this URL alone when not given.
+        known (Optional[Callable[[str], bool]]): Returns True for page content that is
+            already stored. Such a page is returned without chunks, and not embedded.
 
     Returns:
         Optional[Document]: The resulting Document object containing the processed content,
         or None if processing fails.
     """
-    browser_config = BrowserConfig(
-        headless=True,
-        verbose=False,
-    )
-    run_config = CrawlerRunConfig(
-        cache_mode=CacheMode.ENABLED,
-    )
+    from crawl4ai import AsyncWebCrawler
+
+    if crawler is None:
+        async with AsyncWebCrawler(config=_browser_config()) as crawler:
+            return await process_url(url, crawler, known)
+
+    with profiling.span("crawl.fetch", url=url):
+        result = await _fetch(crawler, url)
+    if result is None:
+        return None
     try:
-        async with AsyncWebCrawler(config=browser_config) as crawler:
-            result = await crawler.arun(
-                url=url,
-                config=run_config,
-            )
-            if not result or not result.markdown:
-                console.log(f"Failed to crawl or extract content from {url}")
-                return None
-            embedding = embeddings.create_embeddings(result.markdown)
-            doc = Document(
-                content=result.markdown,
-                url=url,
-                title=result.metadata.get("title", ""),
-                created_at=datetime.now(),
-                embedding=embedding,
-                meta={"source": "web"},
-            )
-            console.log(f" Retreived : {url}")
-            return doc
+        with profiling.span("crawl.to_document", url=url):
+            doc = await _to_document(url, result, known)
     except Exception as e:
         console.log(f"Error processing URL {url}: {e}")
         return None
+    console.log(f" Retreived : {url}")
+    return doc
+
+
+async def process_urls(
+    urls: Iterable[str],
+    concurrency: int = 4,
+    known: Optional[Callable[[str], bool]] = None,
+) -> AsyncIterator[Tuple[str, Optional[Document]]]:
+    """Process URLs concurrently with a single browser.
+
+    Args:
+        urls (Iterable[str]): URLs to fetch.
+        concurrency (int): Maximum number of pages fetched or embedded at once.
+        known (Optional[Callable[[str], bool]]): See `process_url`.
+
+    Yields:
+        Tuple[str, Optional[Document]]: Each URL with its document, or None on failure,
+        in completion order.
+    """
+    from crawl4ai import AsyncWebCrawler
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(url: str) -> Tuple[str, Optional[Document]]:
+        async with semaphore:
+            return url, await process_url(url, crawler, known)
+
+    async with AsyncWebCrawler(config=_browser_config()) as crawler:
+        for task in asyncio.as_completed([run(url) for url in urls]):
+            yield await task
+
+
+class SiteCrawler:
+    """Recursive crawl with a persistent frontier and pipelined stages.
+
+    The frontier lives in the ``crawl_frontier`` table, so URLs are only fetched
+    once and a crawl that was interrupted is resumed by the next run, even with
+    no seeds. Fetching, embedding and storing run as separate stages connected
+    by bounded queues: ``concurrency`` fetchers, rate limited per host,
+    ``concurrency`` embedders, and one writer storing batches of documents.
+    """
+
+    def __init__(
+        self: "SiteCrawler",
+        storage: "Storage",
+        concurrency: int = 4,
+        delay: float = 1.0,
+        batch_size: int = 32,
+    ) -> None:
+        """Initialize the crawl.
+
+        Args:
+            storage (Storage): Storage holding the frontier and receiving the documents.
+            concurrency (int): Number of fetch and of embed workers.
+            delay (float): Minimum number of seconds between two requests to a host.
+            batch_size (int): Maximum number of documents stored per transaction.
+        """
+        self.storage = storage
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.limiter = HostRateLimiter(delay)
+        self.summary = {"pages": 0, "documents": 0, "updated": 0, "skipped": 0, "failed": 0}
+        self.frontier: asyncio.Queue = asyncio.Queue()
+        self.pages: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+        self.docs: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 2)
+
+    def seed(
+        self: "SiteCrawler", seeds: Iterable[str], depth: int = 1, same_domain: bool = True
+    ) -> None:
+        """Add start URLs to the frontier.
+
+        Args:
+            seeds (Iterable[str]): URLs to start from.
+            depth (int): Number of links to follow from a seed.
+            same_domain (bool): Only follow links to the host of their seed.
+        """
+        entries = []
+        for seed in seeds:
+            url = normalize_url(seed)
+            if url is None:
+                console.log(f"Skipping {seed}: not an HTTP(S) URL")
+                continue
+            entries.append((url, 0, depth, urlsplit(url).hostname if same_domain else None))
+        self.storage.enqueue_urls(entries)
+
+    def _known(self: "SiteCrawler", content: str) -> bool:
+        return self.storage.find_contents([content])[0] is not None
+
+    def _failed(self: "SiteCrawler", url: str) -> None:
+        self.storage.set_url_status([url], "failed")
+        self.summary["failed"] += 1
+        self.frontier.task_done()
+
+    async def _fetch_stage(self: "SiteCrawler", crawler: "AsyncWebCrawler") -> None:
+        while True:
+            url, depth, max_depth, domain = await self.frontier.get()
+            await self.limiter.wait(urlsplit(url).hostname)
+            result = await _fetch(crawler, url)
+            if result is None:
+                self._failed(url)
+                continue
+            self.summary["pages"] += 1
+            if depth < max_depth:
+                links = [
+                    (link, depth + 1, max_depth, domain)
+                    for link in _links(url, result)
+                    if domain is None or urlsplit(link).hostname == domain
+                ]
+                for entry in self.storage.enqueue_urls(links):
+                    self.frontier.put_nowait(entry)
+            await self.pages.put((url, result))
+
+    async def _embed_stage(self: "SiteCrawler") -> None:
+        while True:
+            url, result = await self.pages.get()
+            try:
+                doc = await _to_document(url, result, self._known)
+            except Exception as e:
+                console.log(f"Error processing URL {url}: {e}")
+                self._failed(url)
+                continue
+            await self.docs.put(doc)
+
+    async def _store_stage(self: "SiteCrawler") -> None:
+        batch: List[Document] = []
+        while True:
+            batch.append(await self.docs.get())
+            if len(batch) < self.batch_size and not self.docs.empty():
+                continue
+            new_docs = self.storage.update_pages(batch)
+            added = len(self.storage.add_many(new_docs))
+            self.summary["documents"] += added
+            self.summary["updated"] += len(batch) - len(new_docs)
+            self.summary["skipped"] += len(new_docs) - added
+            self.storage.set_url_status([doc.url for doc in batch], "done")
+            console.log(f"Stored {added} pages, {self.frontier.qsize()} URLs left to crawl")
+            for _ in batch:
+                self.frontier.task_done()
+            batch = []
+
+    async def run(self: "SiteCrawler") -> Dict[str, float]:
+        """Crawl the pending URLs of the frontier and the pages they link to.
+
+        Returns:
+            Dict[str, float]: Counts of fetched ``pages``, added ``documents``, ``updated``
+            pages, ``skipped`` duplicates and ``failed`` pages.
+        """
+        from crawl4ai import AsyncWebCrawler
+
+        for entry in self.storage.pending_urls():
+            self.frontier.put_nowait(entry)
+        async with AsyncWebCrawler(config=_browser_config()) as crawler:
+            workers = [
+                asyncio.create_task(self._fetch_stage(crawler)) for _ in range(self.concurrency)
+            ]
+            workers += [asyncio.create_task(self._embed_stage()) for _ in range(self.concurrency)]
+            workers.append(asyncio.create_task(self._store_stage()))
+            # Every URL is done once it is stored or failed, and its links are queued
+            # before that, so the frontier is only joined once the crawl is over.
+            join = asyncio.create_task(self.frontier.join())
+            try:
+                await asyncio.wait([join, *workers], return_when=asyncio.FIRST_COMPLETED)
+                for worker in workers:
+                    if worker.done():
+                        # A stage crashed, the frontier would never be joined
+                        worker.result()
+            finally:
+                join.cancel()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        return self.summary
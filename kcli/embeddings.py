@@ -1,13 +1,130 @@
 """Embedding operations for kcli."""
 import os
-from typing import List
+import pathlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
-from litellm import embedding
+
+from kcli import profiling
+from kcli.cache import EmbeddingCache, text_hash
+from kcli.local_embeddings import LOCAL_MODEL_PREFIX, HashingEmbedder, local_model_dim
+
+# Output dimensions of well-known models, so they never need a probe request.
+KNOWN_EMBEDDING_SIZES = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "openai/text-embedding-ada-002": 1536,
+    "openai/text-embedding-3-small": 1536,
+    "openai/text-embedding-3-large": 3072,
+}
+
+# Inputs and tokens accepted in one request by well-known providers
+KNOWN_REQUEST_LIMITS = {
+    "text-embedding-ada-002": (2048, 300_000),
+    "text-embedding-3-small": (2048, 300_000),
+    "text-embedding-3-large": (2048, 300_000),
+    "openai/text-embedding-ada-002": (2048, 300_000),
+    "openai/text-embedding-3-small": (2048, 300_000),
+    "openai/text-embedding-3-large": (2048, 300_000),
+}
+DEFAULT_REQUEST_LIMITS = (256, 50_000)
+
+# Tokens are estimated without a tokenizer. Three characters per token overestimates
+# English text a little, so requests stay under the limits for code and other scripts.
+CHARS_PER_TOKEN = 3
+
+# Full jitter exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+def known_embedding_size(model_name: str) -> Optional[int]:
+    """Return the dimension of a well-known or local model, None if it must be probed."""
+    return local_model_dim(model_name) or KNOWN_EMBEDDING_SIZES.get(model_name)
+
+
+def estimate_tokens(text: str) -> int:
+    """Return an upper estimate of the number of tokens of a text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _usage_tokens(response: Any) -> Optional[int]:
+    """Return the tokens billed for an embedding response, when the provider reports them."""
+    usage = response.get("usage") if hasattr(response, "get") else None
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens")
+    return getattr(usage, "prompt_tokens", None)
+
+
+def _retryable_errors() -> Tuple[type, ...]:
+    """Return the litellm errors worth retrying: rate limits and transient failures."""
+    import litellm
+
+    return (
+        litellm.RateLimitError,
+        litellm.Timeout,
+        litellm.APIConnectionError,
+        litellm.ServiceUnavailableError,
+        litellm.InternalServerError,
+        litellm.BadGatewayError,
+    )
+
+
+class RequestStats:
+    """Thread-safe counters of the embedding requests sent to the provider."""
+
+    def __init__(self: "RequestStats") -> None:
+        """Initialize empty counters."""
+        self.lock = threading.Lock()
+        self.items = 0
+        self.tokens = 0
+        self.retries = 0
+        self.latencies: List[float] = []
+        # Wall time spent waiting for requests, concurrent requests counted once
+        self.busy_seconds = 0.0
+
+    def record(self: "RequestStats", items: int, tokens: int, seconds: float) -> None:
+        """Record a successful request."""
+        with self.lock:
+            self.items += items
+            self.tokens += tokens
+            self.latencies.append(seconds)
+
+    def summary(self: "RequestStats") -> Dict[str, float]:
+        """Return request counts, latency percentiles in seconds and the throughput.
+
+        Returns:
+            Dict[str, float]: ``requests``, ``retries``, ``items`` and estimated ``tokens``,
+            ``latency_p50``, ``latency_p95`` and ``latency_max`` of single requests, and
+            ``tokens_per_second`` over the time spent waiting for requests.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies or [0.0])
+            return {
+                "requests": len(self.latencies),
+                "retries": self.retries,
+                "items": self.items,
+                "tokens": self.tokens,
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p95": float(np.percentile(latencies, 95)),
+                "latency_max": float(latencies.max()),
+                "tokens_per_second": self.tokens / self.busy_seconds if self.busy_seconds else 0.0,
+            }
 
 
 class Embeddings:
-    """Handles text-to-vector conversions using LiteLLM."""
+    """Handles text-to-vector conversions using LiteLLM, or the local model.
+
+    Models named ``local/hashing-<dim>`` are computed in process by
+    `HashingEmbedder`, without network access.
+    """
 
     def __init__(self: "Embeddings") -> None:
         """Initialize the embedding model."""
@@ -15,20 +132,184 @@ class Embeddings:
             "KCLI_EMBEDDING_MODEL", "text-embedding-ada-002"
         )
         self.chunk_size = 5000
-        try:
-            test_embedding = self.create_embeddings("test")
-            self.embedding_size = len(test_embedding)
-        except Exception as e:
-            raise RuntimeError(
-                f"Embedding model '{self.model_name}' is not available: {str(e)}"
-            ) from e
+        # Limits of a single embedding request
+        items, tokens = KNOWN_REQUEST_LIMITS.get(self.model_name, DEFAULT_REQUEST_LIMITS)
+        self.max_batch_items = int(os.environ.get("KCLI_EMBEDDING_BATCH_ITEMS", items))
+        self.max_batch_tokens = int(os.environ.get("KCLI_EMBEDDING_BATCH_TOKENS", tokens))
+        # Requests in flight at once, shared by all the threads embedding
+        self.max_concurrency = int(os.environ.get("KCLI_EMBEDDING_CONCURRENCY", 4))
+        self.max_retries = int(os.environ.get("KCLI_EMBEDDING_RETRIES", 5))
+        self.stats = RequestStats()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._cache: Optional[EmbeddingCache] = None
+        # Number of chunks embedded by this instance, cached or not
+        self.chunks_embedded = 0
+        self._embedding_size: Optional[int] = known_embedding_size(self.model_name)
+        self.local: Optional[HashingEmbedder] = None
+        if self.model_name.startswith(LOCAL_MODEL_PREFIX):
+            self.local = HashingEmbedder(self._embedding_size)
+
+    @property
+    def embedding_size(self: "Embeddings") -> int:
+        """Return the dimension of the model's vectors.
+
+        The dimension comes from `known_embedding_size` or from the value recorded
+        in the database. Only an unknown model is probed, once, and the probe goes
+        through the embedding cache.
+        """
+        if self._embedding_size is None:
+            try:
+                self._embedding_size = len(self.create_embeddings("test"))
+            except Exception as e:
+                raise RuntimeError(
+                    f"Embedding model '{self.model_name}' is not available: {str(e)}"
+                ) from e
+        return self._embedding_size
+
+    @embedding_size.setter
+    def embedding_size(self: "Embeddings", value: int) -> None:
+        self._embedding_size = value
+
+    @property
+    def cache(self: "Embeddings") -> Optional[EmbeddingCache]:
+        """Return the on-disk embedding cache, or None when it is disabled."""
+        if self._cache is None:
+            max_entries = int(os.environ.get("KCLI_EMBEDDING_CACHE_SIZE", 100_000))
+            if max_entries <= 0:
+                return None
+            path = os.environ.get(
+                "KCLI_EMBEDDING_CACHE_PATH",
+                f"{pathlib.Path.home()}/.kcli/embedding_cache.sqlite",
+            )
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._cache = EmbeddingCache(path, max_entries=max_entries)
+        return self._cache
+
+    def close(self: "Embeddings") -> None:
+        """Close the embedding cache and stop the request threads."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
 
     def create_embeddings(self: "Embeddings", text: str) -> np.ndarray:
         """Generate embeddings for a single text."""
         if len(text) > self.chunk_size:
             return self.batch_embed([text])[0]
-        response = embedding(model=self.model_name, input=[text])
-        return np.array(response.data[0]["embedding"])
+        return self._embed_chunks([text])[0]
+
+    def _embed_chunks(self: "Embeddings", chunks: List[str]) -> List[np.ndarray]:
+        """Embed chunks, sending only the ones missing from the cache to the provider.
+
+        Misses are sent in several concurrent requests, bounded in items and tokens,
+        so a large file never exceeds the per-request limits of the provider.
+
+        Args:
+            chunks (List[str]): Texts short enough to be embedded in one piece.
+
+        Returns:
+            List[np.ndarray]: One embedding per chunk, in input order.
+        """
+        self.chunks_embedded += len(chunks)
+        if self.local is not None:
+            # Encoding locally is faster than a cache lookup
+            start = time.perf_counter()
+            with profiling.span("embed.local", chunks=len(chunks)):
+                vectors = self.local.encode(chunks)
+            seconds = time.perf_counter() - start
+            self.stats.record(len(chunks), sum(estimate_tokens(c) for c in chunks), seconds)
+            with self.stats.lock:
+                self.stats.busy_seconds += seconds
+            return list(vectors)
+        cache = self.cache
+        with profiling.span("embed.cache_get", chunks=len(chunks)):
+            results = cache.get_many(self.model_name, chunks) if cache else [None] * len(chunks)
+        # Deduplicate the misses so repeated chunks are only sent once
+        missing = list(dict.fromkeys(c for c, r in zip(chunks, results) if r is None))
+        profiling.count("embed.cache_hits", len(chunks) - sum(r is None for r in results))
+        if missing:
+            vectors = self._dispatch(missing)
+            if cache:
+                with profiling.span("embed.cache_put", chunks=len(missing)):
+                    cache.put_many(self.model_name, missing, vectors)
+            computed = dict(zip(missing, vectors))
+            results = [computed[c] if r is None else r for c, r in zip(chunks, results)]
+        return results
+
+    def _dispatch(self: "Embeddings", texts: List[str]) -> List[np.ndarray]:
+        """Embed texts with concurrent requests, see `_request_batches` and `_request`.
+
+        Returns:
+            List[np.ndarray]: One embedding per text, in input order.
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="kcli-embed"
+            )
+        start = time.perf_counter()
+        batches = self._pool.map(self._request, self._request_batches(texts))
+        vectors = [vector for batch in batches for vector in batch]
+        with self.stats.lock:
+            self.stats.busy_seconds += time.perf_counter() - start
+        return vectors
+
+    def _request(self: "Embeddings", batch: List[str]) -> List[np.ndarray]:
+        """Send one embedding request, retrying rate limits and transient errors.
+
+        Retries wait a random time, up to a limit doubling with every attempt, so
+        that concurrent requests hitting a rate limit do not retry all at once.
+
+        Args:
+            batch (List[str]): Texts of the request.
+
+        Returns:
+            List[np.ndarray]: The embeddings of the texts.
+        """
+        import litellm  # Imported on first use, it takes seconds to load
+
+        retryable = _retryable_errors()
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                with profiling.span("embed.request", items=len(batch), attempt=attempt):
+                    response = litellm.embedding(model=self.model_name, input=batch)
+                break
+            except retryable:
+                if attempt >= self.max_retries:
+                    raise
+                with self.stats.lock:
+                    self.stats.retries += 1
+                time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)))
+                attempt += 1
+        tokens = sum(estimate_tokens(text) for text in batch)
+        self.stats.record(len(batch), tokens, time.perf_counter() - start)
+        profiling.count("embed.items", len(batch))
+        profiling.count("embed.tokens", _usage_tokens(response) or tokens)
+        with profiling.span("embed.decode", items=len(batch)):
+            return [np.array(item["embedding"], dtype=np.float32) for item in response["data"]]
+
+    def _request_batches(self: "Embeddings", texts: List[str]) -> Iterator[List[str]]:
+        """Split texts into embedding requests.
+
+        A request holds at most ``max_batch_items`` texts and ``max_batch_tokens``
+        estimated tokens, a single longer text is sent alone.
+        """
+        batch: List[str] = []
+        size = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if batch and (
+                len(batch) >= self.max_batch_items or size + tokens > self.max_batch_tokens
+            ):
+                yield batch
+                batch, size = [], 0
+            batch.append(text)
+            size += tokens
+        if batch:
+            yield batch
 
     def create_chunks(
         self: "Embeddings",
@@ -46,65 +327,130 @@ class Embeddings:
         Returns:
             List[str]: A list of text chunks with specified overlap between consecutive pieces
         """
+        return [text[start:end] for start, end in self.chunk_spans(text, chunk_size, overlap)]
+
+    def chunk_spans(
+        self: "Embeddings",
+        text: str,
+        chunk_size: int = 1000,
+        overlap: int = 200,
+    ) -> List[Tuple[int, int]]:
+        """Return the ``(start, end)`` character offsets of the chunks of a text.
+
+        Args:
+            text (str): The input text content that needs to be split into smaller chunks
+            chunk_size (int): The maximum number of characters allowed in each chunk
+            overlap (int): The number of characters that should overlap between consecutive chunks
+
+        Returns:
+            List[Tuple[int, int]]: Offsets of each chunk, without surrounding whitespace.
+        """
         if len(text) <= chunk_size:
-            return [text]
+            return [(0, len(text))]
 
-        chunks = []
+        # Each chunk must end past the start of the next one
+        overlap = min(overlap, chunk_size // 2)
+        spans = []
         start = 0
         while start < len(text):
             # Find the end of this chunk
-            end = start + chunk_size
+            end = min(start + chunk_size, len(text))
 
-            # If this is not the last chunk, try to break at a space
+            # If this is not the last chunk, try to break at a space, as long as
+            # the next chunk still starts after this one
             if end < len(text):
-                # Look for the last space within the overlap region
                 last_space = text.rfind(" ", start, end)
-                if last_space != -1:
+                if last_space > start + overlap:
                     end = last_space
 
-            chunks.append(text[start:end].strip())
+            chunk = text[start:end]
+            left = len(chunk) - len(chunk.lstrip())
+            right = len(chunk.rstrip())
+            if right > left:
+                spans.append((start + left, start + right))
+            if end >= len(text):
+                break
 
-            # Move start to create overlap, but don't go backwards
-            start = max(start, end - overlap)
+            # Move start back to create the overlap
+            start = end - overlap
 
-        return chunks
+        # A text made of whitespace only is still embedded as a whole
+        return spans or [(0, len(text))]
 
-    def batch_embed(self: "Embeddings", texts: List[str], overlap: int = 200) -> List[np.ndarray]:
-        """Generate embeddings for a list of texts, with chunking.
+    def chunk_and_embed(
+        self: "Embeddings",
+        texts: List[str],
+        overlap: int = 200,
+        known: Optional[Dict[str, np.ndarray]] = None,
+    ) -> List[List[Tuple[int, int, np.ndarray]]]:
+        """Split texts into chunks and embed every chunk.
 
         Args:
             texts (List[str]): List of text strings to generate embeddings for. Each text will be
                 processed independently.
             overlap (int): The number of characters that should overlap between consecutive chunks
                 when splitting long texts.
+            known (Optional[Dict[str, np.ndarray]]): Embeddings of chunks that are already
+                stored, keyed by `text_hash` of the chunk text. These chunks are reused
+                and not embedded again.
 
         Returns:
-            List[np.ndarray]: List of embedding arrays, one per input text, where each array
-            represents the text's semantic vector.
+            List[List[Tuple[int, int, np.ndarray]]]: For each text, the start and end offsets
+            of its chunks with their embeddings.
         """
         all_chunks = []
-        chunk_counts = []
+        all_spans = []
 
         # Create chunks for each text
         for text in texts:
-            chunks = self.create_chunks(text, self.chunk_size, overlap)
-            all_chunks.extend(chunks)
-            chunk_counts.append(len(chunks))
+            spans = self.chunk_spans(text, self.chunk_size, overlap)
+            all_chunks.extend(text[start:end] for start, end in spans)
+            all_spans.append(spans)
 
-        # Get embeddings for all chunks
-        response = embedding(model=self.model_name, input=all_chunks)
-        chunk_embeddings = [np.array(item["embedding"]) for item in response.data]
+        # Get embeddings for all chunks, only cache misses reach the provider
+        if known:
+            chunk_embeddings = [known.get(text_hash(chunk)) for chunk in all_chunks]
+        else:
+            chunk_embeddings = [None] * len(all_chunks)
+        missing = [i for i, vector in enumerate(chunk_embeddings) if vector is None]
+        vectors = self._embed_chunks([all_chunks[i] for i in missing]) if missing else []
+        for i, vector in zip(missing, vectors):
+            chunk_embeddings[i] = vector
 
-        # Combine chunk embeddings for each original text
         results = []
         start_idx = 0
-        for count in chunk_counts:
-            if count == 1:
-                results.append(chunk_embeddings[start_idx])
-            else:
-                # Average the embeddings of all chunks for this text
-                text_embeddings = chunk_embeddings[start_idx : start_idx + count]
-                results.append(np.mean(text_embeddings, axis=0))
-            start_idx += count
+        for spans in all_spans:
+            vectors = chunk_embeddings[start_idx : start_idx + len(spans)]
+            results.append([(start, end, v) for (start, end), v in zip(spans, vectors)])
+            start_idx += len(spans)
         return results
-embeddings = Embeddings()
+
+    def batch_embed(self: "Embeddings", texts: List[str], overlap: int = 200) -> List[np.ndarray]:
+        """Generate embeddings for a list of texts, with chunking.
+
+        Args:
+            texts (List[str]): List of text strings to generate embeddings for. Each text will be
+                processed independently.
+            overlap (int): The number of characters that should overlap between consecutive chunks
+                when splitting long texts.
+
+        Returns:
+            List[np.ndarray]: List of embedding arrays, one per input text, where each array
+            represents the text's semantic vector.
+        """
+        # Average the embeddings of all chunks of each text
+        return [
+            np.mean([vector for _, _, vector in chunks], axis=0)
+            for chunks in self.chunk_and_embed(texts, overlap)
+        ]
+
+
+_embeddings: Optional[Embeddings] = None
+
+
+def get_embeddings() -> Embeddings:
+    """Return the shared `Embeddings` instance, creating it on first use."""
+    global _embeddings
+    if _embeddings is None:
+        _embeddings = Embeddings()
+    return _embeddings
@@ -0,0 +1,268 @@
+"""Exact vector search over a memory-mapped embedding matrix."""
+import os
+from contextlib import ExitStack
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+MATRIX_DTYPE = np.float32
+ID_DTYPE = np.int64
+SCALE_DTYPE = np.float32
+
+# Storage types of the matrix, with the suffix of their file
+FORMATS = {"float32": "f32", "float16": "f16", "int8": "i8"}
+# Rows converted to float32 at a time when scoring a quantized matrix
+SCORE_BLOCK = 8192
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors row-wise so a dot product is a cosine similarity.
+
+    Args:
+        vectors (np.ndarray): A single vector or a 2D array of vectors.
+
+    Returns:
+        np.ndarray: float32 array of the same shape with unit-length rows.
+    """
+    vectors = np.asarray(vectors, dtype=MATRIX_DTYPE)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize vectors to int8 with one scale per vector.
+
+    Each row is divided by its own scale, ``max(abs(row)) / 127``, and rounded,
+    so ``row ≈ q * scale`` with an error of at most half a scale per value.
+
+    Args:
+        vectors (np.ndarray): 2D array of vectors.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The int8 rows, and their float32 scales.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(SCALE_DTYPE)
+
+
+class ExactIndex:
+    """Append-only matrix of normalized vectors with their labels, kept on disk.
+
+    The vectors live in ``<path>.f32`` as raw float32 rows, in ``<path>.f16`` as
+    float16 rows, or in ``<path>.i8`` as int8 rows with their scales in
+    ``<path>.scale``, see `quantize_int8`. The labels live in ``<path>.ids`` as
+    int64. All are memory-mapped for search. Rows are only ever appended, a
+    full rewrite goes through `rebuild`.
+
+    float16 halves the size of the matrix and int8 divides it by four, at the
+    cost of approximate scores: callers needing exact ones re-rank the best
+    candidates with the full-precision vectors.
+    """
+
+    def __init__(self: "ExactIndex", path: str, dim: int, dtype: str = "float32") -> None:
+        """Open the matrix files.
+
+        Args:
+            path (str): Path prefix of the matrix files.
+            dim (int): Dimension of the stored vectors.
+            dtype (str): ``float32``, ``float16`` or ``int8``.
+
+        Raises:
+            ValueError: If the storage type is unknown.
+        """
+        if dtype not in FORMATS:
+            raise ValueError(f"Unknown matrix type '{dtype}', use one of {', '.join(FORMATS)}.")
+        self.path = path
+        self.dim = dim
+        self.dtype = dtype
+        self.vectors_path = f"{path}.{FORMATS[dtype]}"
+        self.ids_path = f"{path}.ids"
+        self.scales_path = f"{path}.scale"
+        self._vectors: Optional[np.ndarray] = None
+        self._ids: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+
+    @property
+    def quantized(self: "ExactIndex") -> bool:
+        """Whether the stored vectors lost precision, so their scores are approximate."""
+        return self.dtype != "float32"
+
+    def _files(self: "ExactIndex") -> List[str]:
+        files = [self.vectors_path, self.ids_path]
+        if self.dtype == "int8":
+            files.append(self.scales_path)
+        return files
+
+    def count(self: "ExactIndex") -> Optional[int]:
+        """Return the number of rows on disk, or None if the files disagree."""
+        if not all(os.path.exists(file) for file in self._files()):
+            return 0
+        row_bytes = self.dim * np.dtype(self.dtype).itemsize
+        vector_bytes = os.path.getsize(self.vectors_path)
+        n_ids = os.path.getsize(self.ids_path) // np.dtype(ID_DTYPE).itemsize
+        if vector_bytes % row_bytes or vector_bytes // row_bytes != n_ids:
+            return None
+        if self.dtype == "int8":
+            if os.path.getsize(self.scales_path) != n_ids * np.dtype(SCALE_DTYPE).itemsize:
+                return None
+        return n_ids
+
+    def nbytes(self: "ExactIndex") -> int:
+        """Return the size of the matrix files, in bytes."""
+        return sum(os.path.getsize(file) for file in self._files() if os.path.exists(file))
+
+    def _load(self: "ExactIndex") -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        n = self.count()
+        if self._vectors is None or len(self._vectors) != n:
+            self._scales = None
+            if not n:
+                self._vectors = np.empty((0, self.dim), dtype=self.dtype)
+                self._ids = np.empty(0, dtype=ID_DTYPE)
+                if self.dtype == "int8":
+                    self._scales = np.empty(0, dtype=SCALE_DTYPE)
+            else:
+                self._vectors = np.memmap(
+                    self.vectors_path, dtype=self.dtype, mode="r", shape=(n, self.dim)
+                )
+                self._ids = np.memmap(self.ids_path, dtype=ID_DTYPE, mode="r", shape=(n,))
+                if self.dtype == "int8":
+                    self._scales = np.memmap(
+                        self.scales_path, dtype=SCALE_DTYPE, mode="r", shape=(n,)
+                    )
+        return self._vectors, self._ids, self._scales
+
+    def _encode(self: "ExactIndex", vectors: np.ndarray) -> Tuple[bytes, bytes]:
+        """Return the rows and scales of vectors as stored, normalizing them first."""
+        vectors = normalize(np.atleast_2d(vectors))
+        if self.dtype == "int8":
+            quantized, scales = quantize_int8(vectors)
+            return quantized.tobytes(), scales.tobytes()
+        return vectors.astype(self.dtype).tobytes(), b""
+
+    def _write(
+        self: "ExactIndex", mode: str, batches: Iterable[Tuple[np.ndarray, Iterable[int]]]
+    ) -> int:
+        """Write batches to the files, appending, or to new ``.tmp`` files with mode ``wb``."""
+        suffix = ".tmp" if mode == "wb" else ""
+        count = 0
+        with ExitStack() as stack:
+            vectors_file, ids_file, *scales_file = [
+                stack.enter_context(open(f"{file}{suffix}", mode)) for file in self._files()
+            ]
+            for vectors, ids in batches:
+                ids = np.asarray(list(ids), dtype=ID_DTYPE)
+                rows, scales = self._encode(vectors)
+                vectors_file.write(rows)
+                ids_file.write(ids.tobytes())
+                for f in scales_file:
+                    f.write(scales)
+                count += len(ids)
+        self._vectors = None
+        self._ids = None
+        self._scales = None
+        return count
+
+    def add(self: "ExactIndex", vectors: np.ndarray, ids: Iterable[int]) -> None:
+        """Append vectors and their labels.
+
+        Args:
+            vectors (np.ndarray): 2D array of vectors, normalized before writing.
+            ids (Iterable[int]): One label per vector.
+        """
+        self._write("ab", [(vectors, ids)])
+
+    def rebuild(self: "ExactIndex", batches: Iterable[Tuple[np.ndarray, np.ndarray]]) -> int:
+        """Rewrite the matrix from scratch and atomically replace the files.
+
+        The files of the other storage types are removed.
+
+        Args:
+            batches (Iterable[Tuple[np.ndarray, np.ndarray]]): ``(vectors, ids)`` pairs.
+
+        Returns:
+            int: The number of rows written.
+        """
+        count = self._write("wb", batches)
+        for file in self._files():
+            os.replace(f"{file}.tmp", file)
+        stale = [f"{self.path}.{suffix}" for suffix in FORMATS.values()] + [self.scales_path]
+        for file in set(stale) - set(self._files()):
+            if os.path.exists(file):
+                os.remove(file)
+        return count
+
+    def _scores(
+        self: "ExactIndex", queries: np.ndarray, vectors: np.ndarray, scales: Optional[np.ndarray]
+    ) -> np.ndarray:
+        """Return the cosine similarities of normalized queries to stored rows."""
+        if not self.quantized:
+            return queries @ vectors.T
+        # Convert a block of rows at a time, so the float32 copy stays small
+        scores = np.empty((len(queries), len(vectors)), dtype=MATRIX_DTYPE)
+        for start in range(0, len(vectors), SCORE_BLOCK):
+            block = np.asarray(vectors[start : start + SCORE_BLOCK], dtype=MATRIX_DTYPE)
+            scores[:, start : start + len(block)] = queries @ block.T
+        if scales is not None:
+            scores *= scales
+        return scores
+
+    def search(
+        self: "ExactIndex",
+        query: np.ndarray,
+        k: int = 10,
+        similarity_threshold: Optional[float] = None,
+        allowed: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the ``k`` most similar labels by cosine similarity.
+
+        Args:
+            query (np.ndarray): The query vector.
+            k (int): Number of results to return.
+            similarity_threshold (Optional[float]): Drop results scoring below this value.
+            allowed (Optional[np.ndarray]): Only score the rows of these labels.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Labels and similarities, best first.
+        """
+        return self.search_many(np.atleast_2d(query), k, similarity_threshold, allowed)[0]
+
+    def search_many(
+        self: "ExactIndex",
+        queries: np.ndarray,
+        k: int = 10,
+        similarity_threshold: Optional[float] = None,
+        allowed: Optional[np.ndarray] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Search several queries with a single matrix product, see `search`.
+
+        Args:
+            queries (np.ndarray): Query vectors, one per row.
+            k (int): Number of results per query.
+            similarity_threshold (Optional[float]): Drop results scoring below this value.
+            allowed (Optional[np.ndarray]): Only score the rows of these labels.
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: Labels and similarities of each query.
+        """
+        vectors, ids, scales = self._load()
+        if allowed is not None:
+            rows = np.flatnonzero(np.isin(ids, allowed))
+            vectors, ids = vectors[rows], ids[rows]
+            scales = scales[rows] if scales is not None else None
+        if not len(ids) or k <= 0:
+            empty = (np.empty(0, dtype=ID_DTYPE), np.empty(0, dtype=MATRIX_DTYPE))
+            return [empty] * len(queries)
+        results = []
+        for scores in self._scores(normalize(queries), vectors, scales):
+            if k < len(scores):
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            if similarity_threshold is not None:
+                top = top[scores[top] >= similarity_threshold]
+            results.append((np.asarray(ids[top]), np.asarray(scores[top])))
+        return results
@@ -0,0 +1,191 @@
+"""hnswlib index management for kcli."""
+import contextlib
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from kcli import profiling
+
+GROWTH_FACTOR = 2
+
+# kcli_meta key -> (IndexParams field, environment variable)
+PARAM_KEYS = {
+    "hnsw_m": ("M", "KCLI_HNSW_M"),
+    "hnsw_ef_construction": ("ef_construction", "KCLI_HNSW_EF_CONSTRUCTION"),
+    "hnsw_ef_search": ("ef_search", "KCLI_HNSW_EF_SEARCH"),
+    "hnsw_initial_capacity": ("initial_capacity", "KCLI_HNSW_INITIAL_CAPACITY"),
+}
+
+
+@dataclass
+class IndexParams:
+    """Construction and search parameters of the hnswlib index."""
+
+    M: int = 16  # noqa: N815
+    ef_construction: int = 200
+    ef_search: int = 50
+    initial_capacity: int = 10000
+
+    @classmethod
+    def resolve(cls: type, stored: Dict[str, str]) -> "IndexParams":
+        """Build parameters from the stored values and the environment.
+
+        M, ef_construction and the initial capacity are fixed once the index file
+        exists, so their stored values win. ef_search only affects queries, so an
+        environment variable may override the stored value.
+
+        Args:
+            stored (Dict[str, str]): Values read from ``kcli_meta``, keyed like `PARAM_KEYS`.
+
+        Returns:
+            IndexParams: The parameters to use.
+        """
+        params = cls()
+        for key, (field, env_var) in PARAM_KEYS.items():
+            value = stored.get(key)
+            if value is None or (field == "ef_search" and env_var in os.environ):
+                value = os.environ.get(env_var, value)
+            if value is not None:
+                setattr(params, field, int(value))
+        return params
+
+    def to_meta(self: "IndexParams") -> Dict[str, str]:
+        """Return the parameters keyed like `PARAM_KEYS`, to be stored in ``kcli_meta``."""
+        return {key: str(getattr(self, field)) for key, (field, _) in PARAM_KEYS.items()}
+
+
+class VectorIndex:
+    """hnswlib cosine index that grows geometrically as vectors are added."""
+
+    def __init__(
+        self: "VectorIndex", path: str, dim: int, params: IndexParams, fresh: bool = False
+    ) -> None:
+        """Load the index from ``path``, or create an empty one.
+
+        Args:
+            path (str): Location of the index file.
+            dim (int): Dimension of the indexed vectors.
+            params (IndexParams): Construction and search parameters.
+            fresh (bool): Start empty even if the file exists, `save` then replaces it.
+        """
+        import hnswlib
+
+        self.path = path
+        self.params = params
+        self.hnsw = hnswlib.Index(space="cosine", dim=dim)
+        if os.path.exists(path) and not fresh:
+            self.hnsw.load_index(path)
+        else:
+            self.hnsw.init_index(
+                max_elements=params.initial_capacity,
+                ef_construction=params.ef_construction,
+                M=params.M,
+            )
+        self.hnsw.set_ef(params.ef_search)
+
+    @property
+    def element_count(self: "VectorIndex") -> int:
+        """Return the number of vectors in the index, including deleted ones."""
+        return self.hnsw.element_count
+
+    @property
+    def max_elements(self: "VectorIndex") -> int:
+        """Return the current capacity of the index."""
+        return self.hnsw.max_elements
+
+    def get_ids_list(self: "VectorIndex") -> list:
+        """Return the labels stored in the index."""
+        return self.hnsw.get_ids_list()
+
+    def reserve(self: "VectorIndex", count: int) -> None:
+        """Make room for ``count`` more vectors, growing the capacity geometrically."""
+        needed = self.hnsw.element_count + count
+        capacity = max(self.hnsw.max_elements, 1)
+        while capacity < needed:
+            capacity *= GROWTH_FACTOR
+        if capacity > self.hnsw.max_elements:
+            self.hnsw.resize_index(capacity)
+
+    def add(
+        self: "VectorIndex",
+        vectors: np.ndarray,
+        labels: Iterable[int],
+        num_threads: int = -1,
+    ) -> None:
+        """Add vectors under the given labels.
+
+        Args:
+            vectors (np.ndarray): 2D array of vectors.
+            labels (Iterable[int]): One label per vector.
+            num_threads (int): Threads used by hnswlib, -1 for all cores.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        labels = np.asarray(list(labels))
+        self.reserve(len(labels))
+        with profiling.span("index.add_items", items=len(labels)):
+            self.hnsw.add_items(vectors, labels, num_threads=num_threads)
+
+    def mark_deleted(self: "VectorIndex", labels: Iterable[int]) -> None:
+        """Hide labels from search results, ignoring labels that are not in the index.
+
+        hnswlib keeps the deleted vectors in the graph, so they still count in
+        `element_count`.
+        """
+        for label in labels:
+            # Unknown or already deleted labels raise a RuntimeError
+            with contextlib.suppress(RuntimeError):
+                self.hnsw.mark_deleted(label)
+
+    def search(
+        self: "VectorIndex",
+        vectors: np.ndarray,
+        k: int = 10,
+        ef: Optional[int] = None,
+        filter: Optional[Callable[[int], bool]] = None,  # noqa: A002
+        num_threads: int = -1,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Query the nearest neighbours of one or more vectors.
+
+        Args:
+            vectors (np.ndarray): A query vector or a 2D array of query vectors.
+            k (int): Number of neighbours per query, lowered when fewer labels are left.
+            ef (Optional[int]): Size of the dynamic candidate list for this query only.
+                Defaults to ``params.ef_search``.
+            filter (Optional[Callable[[int], bool]]): Only return labels accepted by it.
+            num_threads (int): Threads used by hnswlib, -1 for all cores.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Labels and cosine distances, one row per query.
+        """
+        k = min(k, self.hnsw.element_count)
+        if ef is not None:
+            self.hnsw.set_ef(max(ef, k))
+        try:
+            while True:
+                try:
+                    with profiling.span("index.knn_query", queries=len(np.atleast_2d(vectors))):
+                        return self.hnsw.knn_query(
+                            vectors, k=k, num_threads=num_threads, filter=filter
+                        )
+                except RuntimeError:
+                    # Fewer than k labels are left once deleted ones are skipped
+                    if k <= 1:
+                        raise
+                    k //= 2
+        finally:
+            if ef is not None:
+                self.hnsw.set_ef(self.params.ef_search)
+
+    def save(self: "VectorIndex") -> None:
+        """Write the index to a temporary file and atomically replace the index file.
+
+        A crash while saving leaves the previous index file untouched.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with profiling.span("index.save", items=self.hnsw.element_count):
+            self.hnsw.save_index(tmp_path)
+            with open(tmp_path, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,120 @@
+"""Local embedding model for kcli, computed with NumPy only."""
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+LOCAL_MODEL_PREFIX = "local/"
+LOCAL_MODEL_PATTERN = re.compile(r"local/hashing(?:-(\d+))?")
+DEFAULT_LOCAL_DIM = 384
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Texts encoded together, bounding the size of the count and projection matrices
+ENCODE_BLOCK = 32
+
+# splitmix64 constants, used as a stateless random generator
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def local_model_dim(model_name: str) -> Optional[int]:
+    """Return the dimension of a local model, or None for a remote model.
+
+    Args:
+        model_name (str): ``local/hashing`` or ``local/hashing-<dim>``.
+
+    Returns:
+        Optional[int]: The vector dimension of the model.
+
+    Raises:
+        ValueError: If the name starts with ``local/`` but is not a local model.
+    """
+    if not model_name.startswith(LOCAL_MODEL_PREFIX):
+        return None
+    match = LOCAL_MODEL_PATTERN.fullmatch(model_name)
+    if match is None:
+        raise ValueError(
+            f"Unknown local embedding model '{model_name}', use 'local/hashing-<dim>'."
+        )
+    return int(match.group(1) or DEFAULT_LOCAL_DIM)
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        x = x + _GOLDEN
+        x = (x ^ (x >> np.uint64(30))) * _MIX1
+        x = (x ^ (x >> np.uint64(27))) * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+class HashingEmbedder:
+    """Embeds texts offline by feature hashing and random projection.
+
+    Each word is hashed, weighted by its sublinear term frequency ``1 + log(tf)``
+    and projected onto a random ``±1/sqrt(dim)`` vector derived from its hash,
+    so texts sharing words get similar vectors. The projection is generated
+    from the hashes on the fly: nothing is trained or stored, and the same text
+    always gets the same vector, on any host.
+    """
+
+    def __init__(self: "HashingEmbedder", dim: int = DEFAULT_LOCAL_DIM, seed: int = 0) -> None:
+        """Initialize the embedder.
+
+        Args:
+            dim (int): Dimension of the vectors.
+            seed (int): Seed of the random projection.
+        """
+        self.dim = dim
+        self.seed = seed
+        # Each 64-bit hash gives the signs of 64 dimensions
+        words = -(-dim // 64)
+        self._columns = np.arange(words, dtype=np.uint64) + np.uint64(seed) * np.uint64(words)
+
+    def encode(self: "HashingEmbedder", texts: List[str]) -> np.ndarray:
+        """Embed texts.
+
+        Args:
+            texts (List[str]): Texts of any length.
+
+        Returns:
+            np.ndarray: Unit-length float32 vectors, one row per text. A text
+            without any word gets a zero vector.
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), ENCODE_BLOCK):
+            vectors[start : start + ENCODE_BLOCK] = self._encode_block(
+                texts[start : start + ENCODE_BLOCK]
+            )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _encode_block(self: "HashingEmbedder", texts: List[str]) -> np.ndarray:
+        lengths = []
+        tokens: List[str] = []
+        for text in texts:
+            words = TOKEN_PATTERN.findall(text.lower())
+            lengths.append(len(words))
+            tokens.extend(words)
+        if not tokens:
+            return np.zeros((len(texts), self.dim), dtype=np.float32)
+        # Number the distinct words, only they are hashed
+        vocab: Dict[str, int] = {word: i for i, word in enumerate(dict.fromkeys(tokens))}
+        columns = np.fromiter(map(vocab.__getitem__, tokens), dtype=np.intp, count=len(tokens))
+        hashes = map(zlib.crc32, map(str.encode, vocab))
+        words = np.fromiter(hashes, dtype=np.uint64, count=len(vocab))
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        cells = rows * len(words) + columns
+        counts = np.bincount(cells, minlength=len(texts) * len(words)).astype(np.float32)
+        counts = counts.reshape(len(texts), len(words))
+        weights = np.log(counts, where=counts > 0, out=np.zeros_like(counts))
+        weights[counts > 0] += 1
+        return weights @ self._projection(words)
+
+    def _projection(self: "HashingEmbedder", words: np.ndarray) -> np.ndarray:
+        """Return the random ``±1/sqrt(dim)`` projection rows of hashed words."""
+        bits = _splitmix64((words[:, None] << np.uint64(32)) ^ self._columns)
+        signs = np.unpackbits(bits.view(np.uint8), axis=1)[:, : self.dim].astype(np.float32)
+        return (signs * 2 - 1) / np.float32(np.sqrt(self.dim))
@@ -1,80 +1,513 @@
 """Core logic for kcli."""
 import asyncio
 import os
+import pathlib
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
-from rich.table import Table
-from kcli.crawler import process_url
-from kcli.embeddings import embeddings
+from fnmatch import fnmatch
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from kcli import profiling
+from kcli.crawler import SiteCrawler, normalize_url, process_url, process_urls
+from kcli.embeddings import get_embeddings
 from kcli.log import console
-from kcli.storage import Document, Storage
-from typing import Optional
-from rich import box
+from kcli.storage import Chunk, Document, SearchFilter, SearchResult, Storage, content_hash
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+storage: Optional[Storage] = None
+
+
+def get_storage() -> Storage:
+    """Return the shared `Storage`, opening it on first use."""
+    global storage
+    if storage is None:
+        storage = Storage()
+    return storage
 
-storage = Storage()
+
+def close_storage() -> None:
+    """Flush and close the shared `Storage` if it was opened."""
+    global storage
+    if storage is not None:
+        storage.close()
+        storage = None
 
 
 def get_document_by_id(doc_id: int) -> Optional[Document]:
     """Retrieve a document by its ID."""
-    return storage.get_document_by_id(doc_id)
+    return get_storage().get_document_by_id(doc_id)
 
 
-def add_file(file_path: str) -> Document:
-    """Add a local file to the knowledge base."""
-    abs_path = os.path.abspath(file_path)
-    with open(abs_path) as f:
-        content = f.read()
-    embedding = embeddings.create_embeddings(content)
-    doc = Document(
+def _file_document(
+    abs_path: str, content: str, chunks: List[Chunk], stat: Optional[os.stat_result] = None
+) -> Document:
+    meta = {"file_path": abs_path}
+    if stat is not None:
+        # Recorded for `sync_sources` to detect changes without reading the file
+        meta.update(mtime=stat.st_mtime, size=stat.st_size)
+    return Document(
         content=content,
         url=f"file://{abs_path}",
         title=os.path.basename(abs_path),
         created_at=datetime.now(),
-        embedding=embedding,
-        meta={"file_path": abs_path},
+        embedding=None,
+        meta=meta,
+        chunks=chunks,
     )
-    storage.add(doc)
+
+
+def add_file(file_path: str) -> Document:
+    """Add a local file to the knowledge base."""
+    abs_path = os.path.abspath(file_path)
+    get_storage().add_source(abs_path)
+    stat = os.stat(abs_path)
+    with open(abs_path) as f:
+        content = f.read()
+    # Check for a duplicate before paying for the embeddings
+    (doc_id,) = get_storage().find_contents([content])
+    if doc_id is not None:
+        console.log(f"Document already in the database: {doc_id}")
+        return get_storage().get_document_by_id(doc_id)
+    (spans,) = get_embeddings().chunk_and_embed([content])
+    doc = _file_document(abs_path, content, [Chunk(*span) for span in spans], stat)
+    get_storage().add(doc)
     return doc
 
 
+def find_files(
+    directory: str, patterns: Iterable[str] = ("**/*",), excludes: Iterable[str] = ()
+) -> List[str]:
+    """List the files of a directory matching glob patterns.
+
+    Args:
+        directory (str): Root directory to search.
+        patterns (Iterable[str]): Glob patterns relative to ``directory``.
+        excludes (Iterable[str]): fnmatch patterns, matched against the path relative to
+            ``directory``, of files to leave out.
+
+    Returns:
+        List[str]: Sorted absolute paths of the matching files.
+    """
+    root = pathlib.Path(directory).resolve()
+    excludes = list(excludes)
+    files = set()
+    for pattern in patterns:
+        for path in root.glob(pattern):
+            relative = path.relative_to(root).as_posix()
+            if path.is_file() and not any(fnmatch(relative, ex) for ex in excludes):
+                files.add(str(path))
+    return sorted(files)
+
+
+def _read_file(path: str) -> Tuple[str, Optional[str], Optional[os.stat_result]]:
+    try:
+        # Stat before reading, so a change made meanwhile is seen by the next sync
+        stat = os.stat(path)
+        with profiling.span("ingest.read"), open(path, encoding="utf-8") as f:
+            return path, f.read(), stat
+    except (OSError, UnicodeDecodeError) as e:
+        console.log(f"Skipping {path}: {e}")
+        return path, None, None
+
+
+def _read_files(
+    pool: ThreadPoolExecutor, files: List[str], window: int
+) -> Iterator[Tuple[str, Optional[str], Optional[os.stat_result]]]:
+    """Read files in order with the pool, keeping at most ``window`` reads ahead.
+
+    Unlike ``pool.map``, which submits every file at once, the contents waiting
+    for the slower embedding loop stay bounded.
+    """
+    paths = iter(files)
+    pending: Deque[Future] = deque(pool.submit(_read_file, p) for p in islice(paths, window))
+    while pending:
+        result = pending.popleft().result()
+        for path in islice(paths, 1):
+            pending.append(pool.submit(_read_file, path))
+        yield result
+
+
+def add_directory(
+    directory: str,
+    patterns: Iterable[str] = ("**/*",),
+    excludes: Iterable[str] = (),
+    workers: int = 8,
+    batch_chars: int = 200_000,
+    batch_docs: int = 256,
+) -> Dict[str, float]:
+    """Add all matching files of a directory to the knowledge base.
+
+    Files are read by a thread pool, a bounded number of files ahead, while
+    previous batches are embedded. Each batch holds at most ``batch_docs`` files
+    and ``batch_chars`` characters. Files whose content is already stored are
+    dropped from it before it is embedded with one `Embeddings.chunk_and_embed`
+    call and stored with one `Storage.add_many` transaction.
+
+    Args:
+        directory (str): Root directory to ingest.
+        patterns (Iterable[str]): Glob patterns of the files to add.
+        excludes (Iterable[str]): fnmatch patterns of files to leave out.
+        workers (int): Number of threads reading files.
+        batch_chars (int): Maximum number of characters per embedding batch.
+        batch_docs (int): Maximum number of files per embedding batch.
+
+    Returns:
+        Dict[str, float]: Counts of files, added documents, skipped files and embedded
+        chunks, and the elapsed time in seconds.
+    """
+    patterns, excludes = list(patterns), list(excludes)
+    get_storage().add_source(str(pathlib.Path(directory).resolve()), patterns, excludes)
+    files = find_files(directory, patterns, excludes)
+    return _add_files(files, workers, batch_chars, batch_docs)
+
+
+def _add_files(
+    files: List[str], workers: int = 8, batch_chars: int = 200_000, batch_docs: int = 256
+) -> Dict[str, float]:
+    """Add files in batches, see `add_directory`."""
+    from rich.progress import Progress
+
+    embeddings = get_embeddings()
+    storage = get_storage()
+    summary = {"files": len(files), "documents": 0, "skipped": 0, "chunks": 0}
+    chunks_before = embeddings.chunks_embedded
+    start = time.perf_counter()
+
+    with Progress(console=console) as progress, ThreadPoolExecutor(workers) as pool:
+        task = progress.add_task("Indexing", total=len(files))
+        batch: List[Tuple[str, str, os.stat_result]] = []
+        batch_size = 0
+
+        def flush() -> None:
+            nonlocal batch, batch_size
+            known = storage.find_contents([content for _, content, _ in batch])
+            new = [item for item, doc_id in zip(batch, known) if doc_id is None]
+            summary["skipped"] += len(batch) - len(new)
+            progress.advance(task, len(batch) - len(new))
+            batch = new
+            if batch:
+                with profiling.span("ingest.embed", files=len(batch)):
+                    spans = embeddings.chunk_and_embed([content for _, content, _ in batch])
+                docs = [
+                    _file_document(path, content, [Chunk(*span) for span in doc_spans], stat)
+                    for (path, content, stat), doc_spans in zip(batch, spans)
+                ]
+                added = len(storage.add_many(docs))
+                summary["documents"] += added
+                summary["skipped"] += len(docs) - added
+                progress.advance(task, len(batch))
+            batch, batch_size = [], 0
+
+        for path, content, stat in _read_files(pool, files, window=workers * 4):
+            if not content or not content.strip():
+                summary["skipped"] += 1
+                progress.advance(task)
+                continue
+            if batch and (
+                len(batch) >= batch_docs or batch_size + len(content) > batch_chars
+            ):
+                flush()
+            batch.append((path, content, stat))
+            batch_size += len(content)
+        flush()
+
+    summary["chunks"] = embeddings.chunks_embedded - chunks_before
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def sync_sources(workers: int = 8, batch_docs: int = 256) -> Dict[str, float]:
+    """Bring the knowledge base up to date with the files and directories added to it.
+
+    A file is only read when its modification time or size changed, and only
+    re-embedded when its content hash changed. Then only the chunks whose text
+    changed are embedded again, see `Storage.update_document`. Documents of
+    files that disappeared, or no longer match the patterns of their
+    directory, are deleted.
+
+    Args:
+        workers (int): Number of threads reading new files.
+        batch_docs (int): Maximum number of new files per embedding batch.
+
+    Returns:
+        Dict[str, float]: Counts of ``files``, ``added``, ``updated``, ``unchanged`` and
+        ``removed`` documents, of ``chunks`` embedded and ``reused``, and the elapsed
+        ``seconds``.
+    """
+    storage = get_storage()
+    embeddings = get_embeddings()
+    start = time.perf_counter()
+    chunks_before = embeddings.chunks_embedded
+    files = set()
+    stored: Dict[str, Tuple[int, float, int, str]] = {}
+    for source in storage.get_sources():
+        path = source["path"]
+        if source["patterns"] is None:
+            if os.path.isfile(path):
+                files.add(path)
+        elif os.path.isdir(path):
+            files.update(find_files(path, source["patterns"], source["excludes"]))
+        stored.update(storage.file_documents(path))
+
+    summary = {
+        "files": len(files),
+        "added": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "removed": 0,
+        "reused": 0,
+    }
+    new_files = [path for path in sorted(files) if path not in stored]
+    for path in sorted(files & stored.keys()):
+        _sync_file(path, *stored[path], summary)
+
+    for path in stored.keys() - files:
+        storage.delete_document(stored[path][0])
+        summary["removed"] += 1
+
+    if new_files:
+        summary["added"] = _add_files(new_files, workers, batch_docs=batch_docs)["documents"]
+    summary["chunks"] = embeddings.chunks_embedded - chunks_before
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def _sync_file(
+    path: str, doc_id: int, mtime: float, size: int, stored_hash: str, summary: Dict
+) -> None:
+    """Update the document of a file that changed since it was stored, see `sync_sources`."""
+    storage = get_storage()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    if (stat.st_mtime, stat.st_size) == (mtime, size):
+        summary["unchanged"] += 1
+        return
+    _, content, stat = _read_file(path)
+    if content is None:
+        return
+    if content_hash(content) == stored_hash:
+        storage.set_file_stat(doc_id, stat.st_mtime, stat.st_size)
+        summary["unchanged"] += 1
+        return
+    (other_id,) = storage.find_contents([content])
+    if other_id is not None:
+        # The file now has the same content as another document
+        storage.delete_document(doc_id)
+        summary["removed"] += 1
+        return
+    known = storage.chunk_vectors(doc_id)
+    (spans,) = get_embeddings().chunk_and_embed([content], known=known)
+    doc = _file_document(path, content, [Chunk(*span) for span in spans], stat)
+    doc.id = doc_id
+    summary["reused"] += storage.update_document(doc)["reused"]
+    summary["updated"] += 1
+
+
 def search_knowledge_base(
-    query: str, limit: int = 10, similarity_threshold: Optional[float] = None
-) -> str | None:
-    """Search the knowledge base."""
-    results = storage.search(
-        query, limit=limit, similarity_threshold=similarity_threshold
+    query: str,
+    limit: int = 10,
+    similarity_threshold: Optional[float] = None,
+    ef: Optional[int] = None,
+    mode: str = "vector",
+    filters: Optional[SearchFilter] = None,
+    offset: int = 0,
+) -> Optional["Table"]:
+    """Search the knowledge base, see `Storage.search` for the modes, filters and paging."""
+    from kcli.render import SNIPPET_CHARS, results_table
+
+    results = get_storage().search(
+        query,
+        limit=limit,
+        similarity_threshold=similarity_threshold,
+        ef=ef,
+        mode=mode,
+        filters=filters,
+        offset=offset,
+        passage_chars=SNIPPET_CHARS,
     )
     if not results:
         return None
-    table_result = Table(
-        title=f"({len(results)}) Search Results",
-        header_style="bold magenta",
-        show_lines=True,
-    )
-    table_result.add_column("date", justify="right", style="dim")
-    table_result.add_column("id", justify="right", style="dim")
-    table_result.add_column("Title", justify="left", style="cyan")
-    table_result.add_column("Content", justify="left", min_width=60)
-    for _, doc in enumerate(results):
-        table_result.add_row(
-            doc.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            str(doc.id),
-            doc.title,
-            doc.content[:50],
-        )
-    return table_result
+    with profiling.span("render"):
+        return results_table([result_to_dict(result) for result in results])
+
+
+def result_to_dict(result: SearchResult) -> Dict:
+    """Return a search result as JSON-serializable data."""
+    return {
+        "id": result.id,
+        "url": result.url,
+        "title": result.title,
+        "created_at": result.created_at.isoformat(),
+        "meta": result.meta,
+        "score": result.score,
+        "passages": [
+            {
+                "chunk_id": p.chunk_id,
+                "start": p.start,
+                "end": p.end,
+                "score": p.score,
+                "text": p.text,
+            }
+            for p in result.passages
+        ],
+    }
 
 
 def crawl_web_content(url: str) -> None:
     """Crawl and add web content to knowledge base."""
+    url = normalize_url(url) or url
     doc = asyncio.run(process_url(url))
     if doc:
-        storage.add(doc)
+        get_storage().add(doc)
     else:
         console.log(f"Failed to crawl {url}")
 
 
-def get_knowledge_base_stats() -> None:
-    """Display knowledge base statistics."""
-    # TODO: Implement storage.get_stats()
-    pass
+def crawl_urls(
+    urls: Iterable[str], concurrency: int = 4, batch_size: int = 32
+) -> Dict[str, float]:
+    """Crawl many URLs with a shared browser and add them to the knowledge base.
+
+    Pages are fetched and embedded concurrently, see `process_urls`, and stored
+    in batches of ``batch_size`` documents, each with one `Storage.add_many`
+    transaction. Pages whose content is already stored are not embedded, and
+    pages stored under the same URL are updated in place, see `Storage.update_pages`.
+
+    Args:
+        urls (Iterable[str]): URLs to crawl, normalized like those of the crawl frontier,
+            see `normalize_url`, so duplicates are crawled once however they are spelled.
+        concurrency (int): Maximum number of pages fetched or embedded at once.
+        batch_size (int): Number of documents stored per transaction.
+
+    Returns:
+        Dict[str, float]: Counts of ``urls``, added ``documents``, ``updated`` pages,
+        ``skipped`` duplicates and ``failed`` pages, and the elapsed ``seconds``.
+    """
+    storage = get_storage()
+    normalized = {url: normalize_url(url) for url in urls}
+    invalid = [url for url, link in normalized.items() if link is None]
+    for url in invalid:
+        console.log(f"Skipping {url}: not an HTTP(S) URL")
+    urls = list(dict.fromkeys(link for link in normalized.values() if link))
+    summary = {
+        "urls": len(urls) + len(invalid),
+        "documents": 0,
+        "updated": 0,
+        "skipped": 0,
+        "failed": len(invalid),
+    }
+    start = time.perf_counter()
+
+    def known(content: str) -> bool:
+        return storage.find_contents([content])[0] is not None
+
+    def store(docs: List[Document]) -> None:
+        new_docs = storage.update_pages(docs)
+        added = len(storage.add_many(new_docs))
+        summary["documents"] += added
+        summary["updated"] += len(docs) - len(new_docs)
+        summary["skipped"] += len(new_docs) - added
+
+    async def crawl() -> None:
+        batch: List[Document] = []
+        async for url, doc in process_urls(urls, concurrency, known):
+            if doc is None:
+                summary["failed"] += 1
+                console.log(f"Failed to crawl {url}")
+                continue
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                store(batch)
+                batch = []
+        if batch:
+            store(batch)
+
+    asyncio.run(crawl())
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def crawl_site(
+    seeds: Iterable[str],
+    depth: int = 1,
+    same_domain: bool = True,
+    concurrency: int = 4,
+    delay: float = 1.0,
+    batch_size: int = 32,
+) -> Dict[str, float]:
+    """Crawl web pages recursively, following their links up to ``depth``.
+
+    Seeds are added to the persistent crawl frontier, which is then crawled
+    together with any URL left pending by an interrupted crawl, see `SiteCrawler`.
+
+    Args:
+        seeds (Iterable[str]): URLs to start from, may be empty to resume a crawl.
+        depth (int): Number of links to follow from a seed.
+        same_domain (bool): Only follow links to the host of their seed.
+        concurrency (int): Number of pages fetched or embedded at once.
+        delay (float): Minimum number of seconds between two requests to a host.
+        batch_size (int): Number of documents stored per transaction.
+
+    Returns:
+        Dict[str, float]: Counts of fetched ``pages``, added ``documents``, ``updated``
+        pages, ``skipped`` duplicates and ``failed`` pages, and the elapsed ``seconds``.
+    """
+    start = time.perf_counter()
+    crawl = SiteCrawler(get_storage(), concurrency=concurrency, delay=delay, batch_size=batch_size)
+    crawl.seed(seeds, depth=depth, same_domain=same_domain)
+    summary = asyncio.run(crawl.run())
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def migrate_database(batch_size: int = 500) -> int:
+    """Convert a JSON-encoded knowledge base to binary embeddings."""
+    return get_storage().migrate(batch_size=batch_size)
+
+
+def measure_recall(k: int = 10, queries: int = 100) -> Dict[str, float]:
+    """Measure the recall of the vector searches, see `Storage.vector_recall`."""
+    return get_storage().vector_recall(k=k, queries=queries)
+
+
+def get_knowledge_base_stats() -> Dict:
+    """Return knowledge base statistics, see `Storage.get_stats`."""
+    return get_storage().get_stats()
+
+
+def remove_documents(refs: Iterable[str], dry_run: bool = False) -> Dict[str, Any]:
+    """Delete the documents designated by IDs or URL prefixes.
+
+    Deleted vectors stay in the indexes as tombstones until `compact_knowledge_base`.
+
+    Args:
+        refs (Iterable[str]): Document IDs or URL prefixes, see `Storage.find_documents`.
+        dry_run (bool): Only return the matching documents.
+
+    Returns:
+        Dict[str, Any]: The matching ``documents``, each with its ``id``, ``title`` and
+        ``url``, the number ``deleted``, and whether compacting is now due (``compact``).
+    """
+    storage = get_storage()
+    found: Dict[int, Dict[str, Any]] = {}
+    for ref in refs:
+        for doc_id, title, url in storage.find_documents(ref):
+            found[doc_id] = {"id": doc_id, "title": title, "url": url}
+    deleted = 0 if dry_run else storage.delete_documents(list(found))
+    return {
+        "documents": list(found.values()),
+        "deleted": deleted,
+        "compact": storage.tombstones()["due"],
+    }
+
+
+def compact_knowledge_base(force: bool = False) -> Dict[str, Any]:
+    """Rebuild the indexes without their deleted vectors, see `Storage.compact`."""
+    return get_storage().compact(force=force)
@@ -0,0 +1,184 @@
+"""Lightweight timing spans and counters for the kcli hot paths.
+
+Profiling is off by default: `span` then returns a shared no-op context manager
+and `count` returns at once, so instrumented code only pays a function call.
+`enable` records the spans and counters in memory, for `summary` and
+`chrome_trace`. Hooks registered with `add_hook` receive every finished span,
+to forward it to another metrics pipeline, whether recording is enabled or not::
+
+    from kcli import profiling
+
+    profiling.add_hook(lambda span: statsd.timing(span.name, span.duration_ns / 1e6))
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, ContextManager, Dict, Iterator, List
+
+_NOOP = nullcontext()
+_lock = threading.Lock()
+
+# Whether spans and counters are recorded, see `enable`
+_recording = False
+# Whether spans are timed at all: recording is enabled, or a hook is registered
+_active = False
+_hooks: List[Callable[["Span"], None]] = []
+_spans: List["Span"] = []
+_counters: Dict[str, float] = {}
+_started_ns = time.perf_counter_ns()
+
+
+@dataclass
+class Span:
+    """A timed stage that finished."""
+
+    name: str
+    # time.perf_counter_ns() when the stage started
+    start_ns: int
+    duration_ns: int
+    thread_id: int
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+
+def enable() -> None:
+    """Start recording spans and counters, clearing the previous ones."""
+    global _recording, _active, _started_ns
+    reset()
+    _started_ns = time.perf_counter_ns()
+    _recording = _active = True
+
+
+def disable() -> None:
+    """Stop recording, keeping what was recorded for `summary` and `chrome_trace`."""
+    global _recording, _active
+    _recording = False
+    _active = bool(_hooks)
+
+
+def is_enabled() -> bool:
+    """Return whether spans and counters are being recorded."""
+    return _recording
+
+
+def reset() -> None:
+    """Forget the recorded spans and counters."""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def add_hook(hook: Callable[[Span], None]) -> None:
+    """Call ``hook`` with every span once it finished, in the thread that ran it.
+
+    Args:
+        hook (Callable[[Span], None]): Receiver of the spans. It runs on the hot
+            path, so it should hand the span over rather than do any I/O itself.
+    """
+    global _active
+    _hooks.append(hook)
+    _active = True
+
+
+def remove_hook(hook: Callable[[Span], None]) -> None:
+    """Stop calling a hook registered with `add_hook`."""
+    global _active
+    _hooks.remove(hook)
+    _active = _recording or bool(_hooks)
+
+
+def span(name: str, **attrs: Any) -> ContextManager:
+    """Time the stage run in the ``with`` block.
+
+    Args:
+        name (str): Name of the stage, dotted by component, e.g. ``index.knn_query``.
+        **attrs (Any): Details of this call, such as the number of items.
+
+    Returns:
+        ContextManager: The timing context, or a shared no-op one when profiling is off.
+    """
+    if not _active:
+        return _NOOP
+    return _timed(name, attrs)
+
+
+@contextmanager
+def _timed(name: str, attrs: Dict[str, Any]) -> Iterator[None]:
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        record = Span(name, start, time.perf_counter_ns() - start, threading.get_ident(), attrs)
+        if _recording:
+            # list.append is atomic, spans of concurrent threads need no lock
+            _spans.append(record)
+        for hook in _hooks:
+            hook(record)
+
+
+def count(name: str, value: float = 1) -> None:
+    """Add ``value`` to a counter, such as rows read or bytes decoded, when recording."""
+    if not _recording:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counters() -> Dict[str, float]:
+    """Return the recorded counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def summary() -> Dict[str, Any]:
+    """Aggregate the recorded spans by stage.
+
+    Stages nest, an ``index.knn_query`` runs within a ``search`` for example, so
+    their totals overlap and do not add up to the wall time.
+
+    Returns:
+        Dict[str, Any]: ``wall_ms`` since `enable`, ``stages`` mapping each stage to its
+        ``calls``, ``total_ms``, ``mean_ms`` and ``max_ms``, slowest total first, and the
+        ``counters``.
+    """
+    stages: Dict[str, Dict[str, float]] = {}
+    for record in list(_spans):
+        stage = stages.setdefault(record.name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+        ms = record.duration_ns / 1e6
+        stage["calls"] += 1
+        stage["total_ms"] += ms
+        stage["max_ms"] = max(stage["max_ms"], ms)
+    for stage in stages.values():
+        stage["mean_ms"] = stage["total_ms"] / stage["calls"]
+    return {
+        "wall_ms": (time.perf_counter_ns() - _started_ns) / 1e6,
+        "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total_ms"])),
+        "counters": counters(),
+    }
+
+
+def chrome_trace() -> Dict[str, Any]:
+    """Return the recorded spans in the Chrome trace event format.
+
+    The result, written as JSON, opens in ``chrome://tracing`` or Perfetto, with
+    one track per thread.
+
+    Returns:
+        Dict[str, Any]: The trace, with the counters in its ``otherData``.
+    """
+    pid = os.getpid()
+    events = [
+        {
+            "name": record.name,
+            "cat": record.name.split(".")[0],
+            "ph": "X",
+            "ts": (record.start_ns - _started_ns) / 1000,
+            "dur": record.duration_ns / 1000,
+            "pid": pid,
+            "tid": record.thread_id,
+            "args": record.attrs,
+        }
+        for record in list(_spans)
+    ]
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": counters()}
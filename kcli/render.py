@@ -0,0 +1,128 @@
+"""Rendering of search results for kcli.
+
+Results are rendered from their JSON form, see `kcli.main.result_to_dict`, so
+that a client of the daemon renders them without importing the storage.
+"""
+from datetime import datetime
+from typing import Any, Dict, List
+
+from rich.panel import Panel
+from rich.table import Table
+from rich.text import Text
+
+# Characters of a passage shown in the results table
+SNIPPET_WIDTH = 200
+# Characters read per passage for the table, leaving room for collapsed whitespace
+SNIPPET_CHARS = 2 * SNIPPET_WIDTH
+
+
+def results_table(results: List[Dict[str, Any]]) -> Table:
+    """Return the table of search results, one row per document.
+
+    Args:
+        results (List[Dict[str, Any]]): Search results as returned by `result_to_dict`.
+
+    Returns:
+        Table: The rich table to print.
+    """
+    table_result = Table(
+        title=f"({len(results)}) Search Results",
+        header_style="bold magenta",
+        show_lines=True,
+    )
+    table_result.add_column("date", justify="right", style="dim")
+    table_result.add_column("id", justify="right", style="dim")
+    table_result.add_column("Title", justify="left", style="cyan")
+    table_result.add_column("Score", justify="right")
+    table_result.add_column("Passage", justify="left", min_width=60)
+    for result in results:
+        table_result.add_row(
+            datetime.fromisoformat(result["created_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+            str(result["id"]),
+            Text(result["title"] or ""),
+            f"{result['score']:.3f}",
+            Text(snippet(result)),
+        )
+    return table_result
+
+
+def snippet(result: Dict[str, Any], width: int = SNIPPET_WIDTH) -> str:
+    """Return the start of the best matching passage on a single line."""
+    text = " ".join(result["passages"][0]["text"].split())
+    return text if len(text) <= width else f"{text[:width]}..."
+
+
+def result_panel(result: Dict[str, Any]) -> Panel:
+    """Return a search result with the full text of its matching passages.
+
+    Args:
+        result (Dict[str, Any]): A search result as returned by `result_to_dict`.
+
+    Returns:
+        Panel: The rich panel to print.
+    """
+    # Passage text is shown as is, never parsed as rich markup
+    passages = Text("\n...\n", style="dim").join(
+        Text(passage["text"].strip())
+        for passage in sorted(result["passages"], key=lambda passage: passage["start"])
+    )
+    return Panel(
+        passages,
+        title=Text.assemble((str(result["id"]), "dim"), " ", (result["title"] or "", "cyan")),
+        title_align="left",
+        subtitle=Text(f"{result['score']:.3f}  {result['url'] or ''}"),
+        subtitle_align="right",
+    )
+
+
+def format_bytes(size: float) -> str:
+    """Return a size in bytes in the largest unit keeping it at least 1."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def stats_table(stats: Dict[str, Any]) -> Table:
+    """Return the table of knowledge base statistics.
+
+    Args:
+        stats (Dict[str, Any]): Statistics as returned by `Storage.get_stats`.
+
+    Returns:
+        Table: The rich table to print.
+    """
+    table = Table(title="Knowledge Base Statistics")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    table.add_row("Documents", f"{stats['documents']:,}")
+    for source, count in stats["documents_by_source"].items():
+        table.add_row(f"  {source}", f"{count:,}", style="dim")
+    table.add_row("Chunks", f"{stats['chunks']:,}")
+    table.add_row("Tracked files and directories", f"{stats['sources']:,}")
+    table.add_row("Content", format_bytes(stats["content_bytes"]))
+    table.add_row("Vectors in the database", format_bytes(stats["vector_bytes"]))
+    table.add_row("Last updated", stats["updated_at"] or "never")
+    table.add_row("Embedding model", f"{stats['embedding_model']} ({stats['vector_dim']} dims)")
+
+    index = stats["index"]
+    db_bytes = stats["db_bytes"]
+    ratio = f" ({stats['index_bytes'] / db_bytes:.2f}x the database)" if db_bytes else ""
+    table.add_row("Database file", format_bytes(db_bytes))
+    table.add_row("hnswlib index file", f"{format_bytes(stats['index_bytes'])}{ratio}")
+    table.add_row(
+        "Exact search matrix", f"{format_bytes(stats['matrix_bytes'])} ({stats['matrix_dtype']})"
+    )
+    used = f" ({index['elements'] / index['capacity']:.0%} used)" if index["capacity"] else ""
+    elements = f"{index['elements']:,} / {index['capacity']:,}{used}"
+    table.add_row("Index elements / capacity", elements)
+    table.add_row("Index deleted elements", f"{index['deleted']:,}")
+    table.add_row("Index labels pending in the journal", f"{index['pending']:,}")
+    if index["elements"]:
+        per_vector = stats["index_bytes"] / index["elements"]
+        table.add_row("Index bytes per element", format_bytes(per_vector))
+    params = [index[key] for key in ("hnsw_m", "hnsw_ef_construction", "hnsw_ef_search")]
+    if any(value is not None for value in params):
+        table.add_row("HNSW M / ef_construction / ef_search", " / ".join(map(str, params)))
+    return table
@@ -0,0 +1,261 @@
+"""Long-running kcli daemon, and its client.
+
+The daemon keeps the storage, the hnswlib index and the embedding client in
+memory and answers requests on a Unix socket. Each request and response is a
+single line of JSON::
+
+    {"op": "search", "args": {"query": "...", "limit": 10}}
+    {"ok": true, "result": [...]}
+    {"ok": false, "error": "ValueError: ..."}
+
+Requests are handled one at a time, so the daemon is the only writer of the
+knowledge base while it runs, and writes to the index are serialized.
+
+This module only imports the standard library at the top, so that the client
+side adds nothing to the start-up time of the CLI.
+"""
+import json
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from kcli.log import console
+
+
+class DaemonUnavailable(ConnectionError):
+    """No daemon is listening on the socket."""
+
+
+class DaemonError(RuntimeError):
+    """The daemon failed to handle a request."""
+
+
+def socket_path() -> str:
+    """Return the path of the daemon socket, from ``KCLI_SOCKET_PATH``."""
+    return os.environ.get("KCLI_SOCKET_PATH", f"{pathlib.Path.home()}/.kcli/kcli.sock")
+
+
+def request(op: str, **args: Any) -> Any:
+    """Send a request to the daemon and return its result.
+
+    Args:
+        op (str): Name of the operation, see `HANDLERS`.
+        **args (Any): JSON-serializable arguments of the operation.
+
+    Returns:
+        Any: The result of the operation.
+
+    Raises:
+        DaemonUnavailable: If no daemon is running, or ``KCLI_NO_DAEMON`` is set.
+        DaemonError: If the daemon failed to handle the request.
+    """
+    if os.environ.get("KCLI_NO_DAEMON"):
+        raise DaemonUnavailable(socket_path())
+    return _send(socket_path(), op, args)
+
+
+def running_daemon(path: Optional[str] = None) -> Optional[int]:
+    """Return the pid of the daemon listening on the socket, even if ``KCLI_NO_DAEMON`` is set.
+
+    Args:
+        path (Optional[str]): Socket path, `socket_path` by default.
+
+    Returns:
+        Optional[int]: The pid of the daemon, or None if none is running.
+    """
+    try:
+        return _send(path or socket_path(), "ping", {})
+    except DaemonUnavailable:
+        return None
+
+
+def _send(path: str, op: str, args: Dict[str, Any]) -> Any:
+    if not os.path.exists(path):
+        raise DaemonUnavailable(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        sock.close()
+        raise DaemonUnavailable(path) from e
+    with sock, sock.makefile("rwb") as stream:
+        stream.write(json.dumps({"op": op, "args": args}).encode() + b"\n")
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        raise DaemonError("The daemon closed the connection.")
+    response = json.loads(line)
+    if not response["ok"]:
+        raise DaemonError(response["error"])
+    return response["result"]
+
+
+def _search(
+    query: str,
+    limit: int = 10,
+    mode: str = "vector",
+    ef: Optional[int] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    offset: int = 0,
+    passage_chars: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    from kcli.main import get_storage, result_to_dict
+
+    results = get_storage().search(
+        query,
+        limit=limit,
+        ef=ef,
+        mode=mode,
+        filters=_search_filter(filters),
+        offset=offset,
+        passage_chars=passage_chars,
+    )
+    return [result_to_dict(result) for result in results]
+
+
+def _search_many(
+    queries: List[str],
+    limit: int = 10,
+    mode: str = "vector",
+    ef: Optional[int] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    offset: int = 0,
+    passage_chars: Optional[int] = None,
+) -> List[List[Dict[str, Any]]]:
+    from kcli.main import get_storage, result_to_dict
+
+    results = get_storage().search_many(
+        queries,
+        limit=limit,
+        ef=ef,
+        mode=mode,
+        filters=_search_filter(filters),
+        offset=offset,
+        passage_chars=passage_chars,
+    )
+    return [[result_to_dict(result) for result in query_results] for query_results in results]
+
+
+def _search_filter(filters: Optional[Dict[str, Any]]) -> Optional["SearchFilter"]:  # noqa: F821
+    """Rebuild a `SearchFilter` from its JSON form, with ``since`` in ISO format."""
+    from kcli.storage import SearchFilter
+
+    if not filters:
+        return None
+    since = filters.get("since")
+    return SearchFilter(**{**filters, "since": datetime.fromisoformat(since) if since else None})
+
+
+def _add(file_path: str) -> Dict[str, Any]:
+    from kcli.main import add_file
+
+    doc = add_file(file_path)
+    return {"id": doc.id, "title": doc.title}
+
+
+def _doc(doc_id: int) -> Optional[Dict[str, Any]]:
+    from kcli.main import get_document_by_id
+
+    doc = get_document_by_id(doc_id)
+    return None if doc is None else {"id": doc.id, "title": doc.title, "content": doc.content}
+
+
+def _call(name: str) -> Callable[..., Any]:
+    """Return a handler calling a `kcli.main` function, which returns JSON data."""
+
+    def handler(**args: Any) -> Any:
+        from kcli import main
+
+        return getattr(main, name)(**args)
+
+    return handler
+
+
+HANDLERS: Dict[str, Callable[..., Any]] = {
+    "ping": lambda: os.getpid(),
+    "search": _search,
+    "search_many": _search_many,
+    "add": _add,
+    "doc": _doc,
+    "add_dir": _call("add_directory"),
+    "sync": _call("sync_sources"),
+    "web": _call("crawl_urls"),
+    "crawl_site": _call("crawl_site"),
+    "stats": _call("get_knowledge_base_stats"),
+    "rm": _call("remove_documents"),
+    "compact": _call("compact_knowledge_base"),
+}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self: "_RequestHandler") -> None:
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                handler = HANDLERS.get(message.get("op"))
+                if handler is None:
+                    raise ValueError(f"Unknown operation '{message.get('op')}'.")
+                response = {"ok": True, "result": handler(**message.get("args", {}))}
+            except Exception as e:
+                console.log(f"Request failed: {e!r}")
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _Server(socketserver.UnixStreamServer):
+    def service_actions(self: "_Server") -> None:
+        """Flush pending index updates when they are due, between requests."""
+        from kcli.main import get_storage
+
+        get_storage()._maybe_flush_index()
+
+
+def serve(path: Optional[str] = None) -> None:
+    """Run the daemon until it is interrupted or terminated.
+
+    The storage, the index and the embedding client are loaded before the
+    socket is opened, so the first request is as fast as the next ones.
+
+    Args:
+        path (Optional[str]): Socket path, `socket_path` by default.
+
+    Raises:
+        RuntimeError: If a daemon is already listening on the socket.
+    """
+    from kcli.main import close_storage, get_storage
+
+    path = path or socket_path()
+    pid = running_daemon(path)
+    if pid is not None:
+        raise RuntimeError(f"A daemon is already running with pid {pid}, on {path}.")
+    if os.path.exists(path):
+        # Left over by a daemon that was killed
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    storage = get_storage()
+    storage.index  # noqa: B018
+    if storage.embeddings.local is None:
+        import litellm  # noqa: F401
+
+    def stop(signum: int, frame: Any) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    server = _Server(path, _RequestHandler)
+    os.chmod(path, 0o600)
+    console.log(f"kcli daemon {os.getpid()} listening on {path}")
+    try:
+        server.serve_forever(poll_interval=1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        close_storage()
+        console.log("kcli daemon stopped")
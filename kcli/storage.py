@@ -2,40 +2,190 @@
 import json
 import os
 import pathlib
+import re
 import sqlite3
-from dataclasses import dataclass
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-import hnswlib
 import numpy as np
 
-from kcli.embeddings import Embeddings
+from kcli import profiling
+from kcli.cache import text_hash
+from kcli.embeddings import get_embeddings, known_embedding_size
+from kcli.exact import ExactIndex, normalize
+from kcli.index import PARAM_KEYS, IndexParams, VectorIndex
 from kcli.log import console
 
 storage = None
-embedding = None
 
-VECTOR_DIM: Optional[int] = None
 DB_PATH: Optional[str] = None
 INDEX_PATH: Optional[str] = None
+MATRIX_PATH: Optional[str] = None
+MATRIX_TYPE = "float32"
+COMPACT_THRESHOLD = 0.2
+
+# Version 1 stored embeddings as JSON text, version 2 as raw float32 bytes,
+# version 3 indexes one vector per chunk instead of one per document, version 4
+# no longer stores the mean vector of documents that have chunk vectors.
+SCHEMA_VERSION = 4
+VECTOR_DTYPE = np.float32
+# Chunks fetched per requested document, several chunks can match the same document
+CHUNK_OVERFETCH = 4
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+# Rank offset of reciprocal rank fusion, the usual value damping the top ranks
+RRF_K = 60
+# Adds the values of a ``kcli_stats`` insert to the existing counters
+STATS_UPSERT = "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value;"
+# Current Unix time in SQL, for the ``updated_at`` statistic
+STATS_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+# Filtered searches allowing fewer chunks are scored exactly instead of through hnswlib
+FILTER_EXACT_ROWS = 20_000
+# Candidates scored on a quantized matrix per result, then re-ranked at full precision
+RERANK_FACTOR = 4
 
 
 def configure() -> None:
     """Configure the storage."""
-    global embedding
-    global VECTOR_DIM
     global DB_PATH
     global INDEX_PATH
+    global MATRIX_PATH
+    global MATRIX_TYPE
+    global COMPACT_THRESHOLD
 
     DB_PATH = os.environ.get("KCLI_DB_PATH", f"{pathlib.Path.home()}/.kcli/db.sqlite")
     INDEX_PATH = os.environ.get(
         "KCLI_INDEX_PATH", f"{pathlib.Path.home()}/.kcli/index.ann"
     )
+    MATRIX_PATH = os.environ.get("KCLI_MATRIX_PATH", f"{INDEX_PATH}.exact")
+    # float16 or int8 shrink the exact search matrix, see `ExactIndex`
+    MATRIX_TYPE = os.environ.get("KCLI_MATRIX_DTYPE", "float32")
+    # Share of deleted vectors in an index above which `Storage.compact` rebuilds them
+    COMPACT_THRESHOLD = float(os.environ.get("KCLI_COMPACT_THRESHOLD", 0.2))
     if not os.path.exists(DB_PATH):
         os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    embedding = Embeddings()
-    VECTOR_DIM = embedding.embedding_size
+
+
+def content_hash(content: str) -> str:
+    """Return the deduplication key of a document content.
+
+    Line endings and surrounding whitespace are normalized first, so the same
+    file saved on another platform is still recognized.
+
+    Args:
+        content (str): Document content.
+
+    Returns:
+        str: SHA-256 hex digest of the normalized content.
+    """
+    return text_hash(content.replace("\r\n", "\n").strip())
+
+
+def encode_vector(vector: Any) -> bytes:
+    """Encode a vector as raw float32 bytes for the ``embedding`` column.
+
+    Args:
+        vector (Any): Array-like vector to encode.
+
+    Returns:
+        bytes: The little-endian float32 representation of the vector.
+    """
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def decode_vector(value: Any) -> Optional[np.ndarray]:
+    """Decode a value read from the ``embedding`` column.
+
+    Args:
+        value (Any): A float32 BLOB, or a legacy JSON-encoded list that has not been
+            migrated yet.
+
+    Returns:
+        Optional[np.ndarray]: The decoded vector, or None when no embedding is stored.
+    """
+    if value is None:
+        return None
+    profiling.count("vectors.decoded_bytes", len(value))
+    if isinstance(value, str):
+        with profiling.span("vectors.json_decode"):
+            return np.array(json.loads(value), dtype=VECTOR_DTYPE)
+    return np.frombuffer(value, dtype=VECTOR_DTYPE)
+
+
+def fts_query(query: str) -> Optional[str]:
+    """Turn free text into an FTS5 query matching any of its words.
+
+    Words joined by punctuation, such as ``get_storage`` or ``foo.bar``, are
+    matched as phrases, and FTS5 operators in the query are taken literally.
+
+    Args:
+        query (str): Text typed by the user.
+
+    Returns:
+        Optional[str]: The FTS5 query, or None if the text has no word.
+    """
+    phrases = []
+    for word in query.split():
+        terms = re.findall(r"[^\W_]+", word)
+        if terms:
+            phrases.append(f'"{" ".join(terms)}"')
+    return " OR ".join(phrases) or None
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    """Return the bounds of the strings starting with a non-empty prefix.
+
+    ``lower <= value < upper`` can use an index, unlike ``LIKE 'prefix%'``.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def document_source(meta: Dict[str, Any]) -> Optional[str]:
+    """Return the ``source`` column of a document: its meta source, or ``file``."""
+    return meta.get("source") or ("file" if meta.get("file_path") else None)
+
+
+def _document_vector(doc: "Document") -> Optional[bytes]:
+    """Return the ``embedding`` column of a document, NULL when its chunks hold its vectors."""
+    if doc.embedding is None or any(chunk.embedding is not None for chunk in doc.chunks):
+        return None
+    return encode_vector(doc.embedding)
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[int]], k: int = RRF_K
+) -> Tuple[List[int], List[float]]:
+    """Merge rankings, scoring each item by the sum of ``1 / (k + rank)``.
+
+    Args:
+        rankings (Sequence[Sequence[int]]): Item ids, best first, one list per ranker.
+        k (int): Rank offset, larger values give more weight to lower ranks.
+
+    Returns:
+        Tuple[List[int], List[float]]: The items, best first, and their fused scores.
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    items = sorted(scores, key=scores.__getitem__, reverse=True)
+    return items, [scores[item] for item in items]
+
+
+@dataclass
+class Chunk:
+    """A passage of a document, indexed with its own embedding."""
+
+    start: int
+    end: int
+    embedding: Optional[np.ndarray]
+    id: Optional[int] = None
 
 
 @dataclass
@@ -49,6 +199,71 @@ class Document:
     embedding: Optional[np.ndarray]
     meta: Dict[str, Any]
     id: Optional[int] = None
+    chunks: List[Chunk] = field(default_factory=list)
+
+    def __post_init__(self: "Document") -> None:
+        """Default the document embedding to the mean of its chunk embeddings."""
+        if self.embedding is None and self.chunks:
+            self.embedding = np.mean([chunk.embedding for chunk in self.chunks], axis=0)
+
+
+@dataclass
+class Passage:
+    """A chunk of a document that matched a search."""
+
+    chunk_id: int
+    start: int
+    end: int
+    score: float
+    # Cut to its first characters when the search asked for snippets only
+    text: str
+
+
+@dataclass
+class SearchResult:
+    """A document that matched a search, with its matching passages."""
+
+    id: int
+    url: Optional[str]
+    title: str
+    created_at: datetime
+    meta: Dict[str, Any]
+    score: float
+    passages: List[Passage]
+
+
+@dataclass
+class SearchFilter:
+    """Restricts a search to the documents matching all the given fields."""
+
+    # "web" for crawled pages, "file" for local files
+    source: Optional[str] = None
+    since: Optional[datetime] = None
+    url_prefix: Optional[str] = None
+    # A file, or a directory matching the files below it only, not its sibling "dir2"
+    path_prefix: Optional[str] = None
+
+    def to_sql(self: "SearchFilter") -> Tuple[str, List[Any]]:
+        """Return the condition on the documents table ``d``, and its parameters.
+
+        Every condition is on an indexed column.
+        """
+        conditions = []
+        params: List[Any] = []
+        if self.source is not None:
+            conditions.append("d.source = ?")
+            params.append(self.source)
+        if self.since is not None:
+            conditions.append("d.created_at >= ?")
+            params.append(self.since.isoformat())
+        if self.url_prefix:
+            conditions.append("d.url >= ? AND d.url < ?")
+            params.extend(prefix_range(self.url_prefix))
+        if self.path_prefix:
+            path = self.path_prefix.rstrip(os.sep)
+            conditions.append("(d.file_path = ? OR (d.file_path >= ? AND d.file_path < ?))")
+            params.extend([path, *prefix_range(path + os.sep)])
+        return " AND ".join(conditions) or "1", params
 
 
 class Storage:
@@ -58,57 +273,683 @@ class Storage:
         """Initialize the storage."""
         global DB_PATH
         global INDEX_PATH
-        global VECTOR_DIM
         if not DB_PATH:
             configure()
 
         self.db_path = DB_PATH
         self.index_path = INDEX_PATH
+        self.matrix_path = MATRIX_PATH
 
         # Initialize SQLite connection
         self.db = sqlite3.connect(self.db_path)
         self._create_table()
-        # Initialize hnswlib index
-        self.index = hnswlib.Index(space="cosine", dim=VECTOR_DIM)
-        if os.path.exists(self.index_path):
-            self.index.load_index(self.index_path)
-        else:
-            self.index.init_index(max_elements=10000, ef_construction=200, M=16)
-        self.embeddings = Embeddings()
+        self.embeddings = get_embeddings()
+        self.vector_dim = self._resolve_vector_dim()
+        # The hnswlib index is loaded on first access, see `index`
+        self._index: Optional[VectorIndex] = None
+        # Labels added to the loaded index that are only persisted in the journal
+        self._unflushed: List[int] = []
+        # Labels marked deleted in the loaded index since the last flush
+        self._deleted = False
+        self._last_flush = time.monotonic()
+        self.flush_items = int(os.environ.get("KCLI_INDEX_FLUSH_ITEMS", 1000))
+        self.flush_seconds = float(os.environ.get("KCLI_INDEX_FLUSH_SECONDS", 60))
+        # Exact search matrix, a memory-mapped mirror of the stored embeddings
+        self.exact = ExactIndex(self.matrix_path, self.vector_dim, MATRIX_TYPE)
+        self._sync_exact_index()
+
+    @property
+    def index(self: "Storage") -> VectorIndex:
+        """Return the hnswlib index, loading it from disk on first access.
+
+        Vectors still pending in the journal are replayed into the loaded index.
+        """
+        if self._index is None:
+            self._index = VectorIndex(self.index_path, self.vector_dim, self.index_params())
+            self._last_flush = time.monotonic()
+            self._replay_journal()
+        return self._index
+
+    def _replay_journal(self: "Storage", batch_size: int = 1000) -> None:
+        indexed = set(self._index.get_ids_list())
+        cursor = self.db.cursor()
+        cursor.execute("SELECT label, vector FROM index_journal ORDER BY label")
+        while rows := cursor.fetchmany(batch_size):
+            self._unflushed.extend(label for label, _ in rows)
+            rows = [(label, vector) for label, vector in rows if label not in indexed]
+            if rows:
+                self._index.add(
+                    np.stack([decode_vector(vector) for _, vector in rows]),
+                    [label for label, _ in rows],
+                )
+
+    def _index_vectors(
+        self: "Storage", vectors: np.ndarray, labels: List[int], num_threads: int = -1
+    ) -> None:
+        """Journal vectors for the hnswlib index, without committing.
+
+        The journal rows are committed together with the rows they index, so a
+        crash can never lose a vector. The index file itself is only rewritten
+        by `flush_index`.
+        """
+        self.db.executemany(
+            "INSERT OR REPLACE INTO index_journal (label, vector) VALUES (?, ?)",
+            [(label, encode_vector(vector)) for label, vector in zip(labels, vectors)],
+        )
+        if self._index is not None:
+            self._index.add(vectors, labels, num_threads=num_threads)
+            self._unflushed.extend(labels)
+
+    def _maybe_flush_index(self: "Storage") -> None:
+        """Flush the index once the journal or the time since the last flush is too large."""
+        if self._index is None:
+            (pending,) = self.db.execute("SELECT COUNT(*) FROM index_journal").fetchone()
+            if pending >= self.flush_items:
+                self.flush_index(load=True)
+        elif (
+            len(self._unflushed) >= self.flush_items
+            or time.monotonic() - self._last_flush >= self.flush_seconds
+        ):
+            self.flush_index()
+
+    def flush_index(self: "Storage", load: bool = False) -> None:
+        """Save the hnswlib index and clear the journal entries it now contains.
+
+        Args:
+            load (bool): Load the index to flush the journal even if it is not loaded yet.
+        """
+        if self._index is None and not load:
+            return
+        index = self.index
+        if self._unflushed or self._deleted or not os.path.exists(self.index_path):
+            with profiling.span("index.flush", items=len(self._unflushed)):
+                index.save()
+                for start in range(0, len(self._unflushed), 500):
+                    batch = self._unflushed[start : start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    self.db.execute(
+                        f"DELETE FROM index_journal WHERE label IN ({placeholders})", batch
+                    )
+                for key, value in self._index_facts(index).items():
+                    self.set_meta(key, str(value))
+                self.db.commit()
+            self._unflushed = []
+            self._deleted = False
+        self._last_flush = time.monotonic()
+
+    def _index_facts(self: "Storage", index: VectorIndex) -> Dict[str, int]:
+        """Return the size of a loaded index, recorded in ``kcli_meta`` when it is saved.
+
+        hnswlib does not count deleted labels, they are the labels of the index
+        beyond the stored chunks.
+        """
+        (chunks,) = self.db.execute(
+            "SELECT COALESCE((SELECT value FROM kcli_stats WHERE key = 'chunks'), 0)"
+        ).fetchone()
+        return {
+            "index_elements": index.element_count,
+            "index_capacity": index.max_elements,
+            "index_deleted": max(index.element_count - int(chunks), 0),
+        }
+
+    def _recorded_index_facts(self: "Storage") -> Dict[str, int]:
+        """Return `_index_facts` of the loaded index, or as of its last flush."""
+        if self._index is not None:
+            return self._index_facts(self._index)
+        return {
+            key: int(self.get_meta(key) or 0)
+            for key in ("index_elements", "index_capacity", "index_deleted")
+        }
+
+    def _db_bytes(self: "Storage") -> int:
+        return sum(_file_size(f"{self.db_path}{suffix}") for suffix in ("", "-wal"))
+
+    def get_stats(self: "Storage") -> Dict[str, Any]:
+        """Return statistics of the knowledge base, without scanning any large table.
+
+        Document aggregates come from ``kcli_stats``, see `_create_stats`. The
+        hnswlib facts are read from the index when it is loaded, otherwise from
+        ``kcli_meta``, as of its last flush, so the index is never loaded for them.
+
+        Returns:
+            Dict[str, Any]: Counts of ``documents``, per source in ``documents_by_source``,
+            of ``chunks`` and ``sources``, ``content_bytes`` and ``vector_bytes`` stored in
+            SQLite, the ISO ``updated_at`` time, the embedding model and vector format, the
+            ``db_bytes``, ``index_bytes`` and ``matrix_bytes`` file sizes, and the ``index``
+            elements, capacity, deleted and journal ``pending`` labels, and parameters.
+        """
+        values = dict(self.db.execute("SELECT key, value FROM kcli_stats").fetchall())
+        updated_at = values.get("updated_at")
+        index = self._recorded_index_facts()
+        # The journal holds at most a flush worth of labels
+        (pending,) = self.db.execute("SELECT COUNT(*) FROM index_journal").fetchone()
+        (sources,) = self.db.execute("SELECT COUNT(*) FROM sources").fetchone()
+        return {
+            "documents": int(values.get("documents", 0)),
+            "documents_by_source": {
+                key.split(".", 1)[1]: int(value)
+                for key, value in sorted(values.items())
+                if key.startswith("documents.") and value
+            },
+            "chunks": int(values.get("chunks", 0)),
+            "content_bytes": int(values.get("content_bytes", 0)),
+            "vector_bytes": int(values.get("vector_bytes", 0)),
+            "updated_at": (
+                datetime.fromtimestamp(updated_at).isoformat(timespec="seconds")
+                if updated_at
+                else None
+            ),
+            "sources": sources,
+            "embedding_model": self.embeddings.model_name,
+            "vector_dim": self.vector_dim,
+            "matrix_dtype": self.exact.dtype,
+            "db_bytes": self._db_bytes(),
+            "index_bytes": _file_size(self.index_path),
+            "matrix_bytes": self.exact.nbytes(),
+            "index": {
+                "elements": index["index_elements"],
+                "capacity": index["index_capacity"],
+                "deleted": index["index_deleted"],
+                "pending": pending,
+                **{key: self.get_meta(key) for key in PARAM_KEYS},
+            },
+        }
+
+    def index_params(self: "Storage") -> IndexParams:
+        """Return the index parameters, recording them in ``kcli_meta``.
+
+        Parameters are stored alongside the index so reloading it uses the same
+        values, see `IndexParams.resolve`.
+        """
+        stored = {key: self.get_meta(key) for key in PARAM_KEYS}
+        params = IndexParams.resolve({k: v for k, v in stored.items() if v is not None})
+        for key, value in params.to_meta().items():
+            if stored[key] != value:
+                self.set_meta(key, value)
+        self.db.commit()
+        return params
 
     def _create_table(self: "Storage") -> None:
         self.db.execute(
-            f"""
+            """
             CREATE TABLE IF NOT EXISTS documents (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 content TEXT,
                 url TEXT,
                 title TEXT,
                 created_at TEXT,
-                embedding float[{VECTOR_DIM}],
-                meta TEXT
+                embedding BLOB,
+                meta TEXT,
+                content_hash TEXT,
+                file_path TEXT,
+                mtime REAL,
+                size INTEGER,
+                source TEXT
+            );
+            """
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(documents)")]
+        if "content_hash" not in columns:
+            self._add_content_hash()
+        if "file_path" not in columns:
+            self._add_file_columns()
+        if "source" not in columns:
+            self._add_source_column()
+        self.db.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS documents_content_hash
+            ON documents (content_hash)
+            """
+        )
+        # Covers the change detection of `kcli sync`, without reading the documents
+        self.db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS documents_file
+            ON documents (file_path, mtime, size, content_hash)
+            """
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                patterns TEXT,
+                excludes TEXT,
+                added_at TEXT
+            );
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS documents_url ON documents (url)")
+        # Search filters, see `SearchFilter`
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS documents_source ON documents (source, created_at)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS documents_created_at ON documents (created_at)"
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS crawl_frontier (
+                url TEXT PRIMARY KEY,
+                depth INTEGER NOT NULL,
+                max_depth INTEGER NOT NULL,
+                domain TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                updated_at TEXT
+            );
+            """
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS crawl_frontier_status ON crawl_frontier (status)"
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL REFERENCES documents (id),
+                chunk_index INTEGER NOT NULL,
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL,
+                embedding BLOB
+            );
+            """
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_document_id ON chunks (document_id)"
+        )
+        self._create_fts()
+        self._create_stats()
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS index_journal (
+                label INTEGER PRIMARY KEY,
+                vector BLOB NOT NULL
+            );
+            """
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kcli_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        version = self.get_meta("schema_version")
+        if version is None:
+            cursor = self.db.execute(
+                "SELECT 1 FROM documents WHERE typeof(embedding) = 'text' LIMIT 1"
+            )
+            if cursor.fetchone():
+                # Pre-versioned database with JSON embeddings, see `migrate`.
+                self.set_meta("schema_version", "1")
+                console.log("Database uses JSON embeddings, run `kcli migrate` to convert it.")
+            else:
+                self._set_vector_format(None)
+                self.set_meta("schema_version", str(SCHEMA_VERSION))
+        elif version == "2":
+            self._migrate_chunks()
+        if self.get_meta("schema_version") == "3":
+            self._drop_document_vectors()
+        self.db.commit()
+
+    def _create_fts(self: "Storage") -> None:
+        """Create the full-text index of chunk texts, kept in sync by triggers.
+
+        The index stores its own copy of the texts: an external content table
+        would need the old text on delete, which `update_document` has already
+        replaced in ``documents`` by then.
+        """
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'"
+        ).fetchone()
+        self.db.executescript(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
+            USING fts5 (text, tokenize = 'porter unicode61');
+
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, text)
+                SELECT new.id, substr(content, new.start_offset + 1,
+                    new.end_offset - new.start_offset)
+                FROM documents WHERE id = new.document_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+                DELETE FROM chunks_fts WHERE rowid = old.id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_update
+            AFTER UPDATE OF document_id, start_offset, end_offset ON chunks BEGIN
+                DELETE FROM chunks_fts WHERE rowid = old.id;
+                INSERT INTO chunks_fts (rowid, text)
+                SELECT new.id, substr(content, new.start_offset + 1,
+                    new.end_offset - new.start_offset)
+                FROM documents WHERE id = new.document_id;
+            END;
+            """
+        )
+        if not exists:
+            self.db.execute(
+                """
+                INSERT INTO chunks_fts (rowid, text)
+                SELECT c.id, substr(d.content, c.start_offset + 1, c.end_offset - c.start_offset)
+                FROM chunks c JOIN documents d ON d.id = c.document_id
+                """
+            )
+
+    def _create_stats(self: "Storage") -> None:
+        """Create the ``kcli_stats`` aggregates, kept up to date by triggers.
+
+        Every insert, update and delete of a document or chunk adjusts the
+        counters in the same transaction, so `get_stats` never scans a table.
+        Documents are counted per ``source``, NULL counted as ``other``.
+        """
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'kcli_stats'"
+        ).fetchone()
+        self.db.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS kcli_stats (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
             );
+
+            CREATE TRIGGER IF NOT EXISTS stats_documents_insert AFTER INSERT ON documents BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('documents', 1),
+                    ('documents.' || COALESCE(new.source, 'other'), 1),
+                    ('content_bytes', COALESCE(length(CAST(new.content AS BLOB)), 0)),
+                    ('vector_bytes', COALESCE(length(new.embedding), 0))
+                {STATS_UPSERT}
+                INSERT OR REPLACE INTO kcli_stats (key, value) VALUES ('updated_at', {STATS_NOW});
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS stats_documents_delete AFTER DELETE ON documents BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('documents', -1),
+                    ('documents.' || COALESCE(old.source, 'other'), -1),
+                    ('content_bytes', -COALESCE(length(CAST(old.content AS BLOB)), 0)),
+                    ('vector_bytes', -COALESCE(length(old.embedding), 0))
+                {STATS_UPSERT}
+                INSERT OR REPLACE INTO kcli_stats (key, value) VALUES ('updated_at', {STATS_NOW});
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS stats_documents_update
+            AFTER UPDATE OF content, embedding, source ON documents BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('documents.' || COALESCE(old.source, 'other'), -1),
+                    ('documents.' || COALESCE(new.source, 'other'), 1),
+                    ('content_bytes', COALESCE(length(CAST(new.content AS BLOB)), 0)
+                        - COALESCE(length(CAST(old.content AS BLOB)), 0)),
+                    ('vector_bytes', COALESCE(length(new.embedding), 0)
+                        - COALESCE(length(old.embedding), 0))
+                {STATS_UPSERT}
+                INSERT OR REPLACE INTO kcli_stats (key, value) VALUES ('updated_at', {STATS_NOW});
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS stats_chunks_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('chunks', 1),
+                    ('vector_bytes', COALESCE(length(new.embedding), 0))
+                {STATS_UPSERT}
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS stats_chunks_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('chunks', -1),
+                    ('vector_bytes', -COALESCE(length(old.embedding), 0))
+                {STATS_UPSERT}
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS stats_chunks_update
+            AFTER UPDATE OF embedding ON chunks BEGIN
+                INSERT INTO kcli_stats (key, value) VALUES
+                    ('vector_bytes', COALESCE(length(new.embedding), 0)
+                        - COALESCE(length(old.embedding), 0))
+                {STATS_UPSERT}
+            END;
+            """
+        )
+        if not exists:
+            self.rebuild_stats()
+
+    def rebuild_stats(self: "Storage") -> None:
+        """Recompute the ``kcli_stats`` aggregates with a full scan, without committing."""
+        self.db.execute("DELETE FROM kcli_stats")
+        self.db.execute(
+            f"""
+            INSERT INTO kcli_stats (key, value)
+            SELECT 'documents', COUNT(*) FROM documents
+            UNION ALL
+            SELECT 'documents.' || COALESCE(source, 'other'), COUNT(*) FROM documents
+            GROUP BY source
+            UNION ALL
+            SELECT 'content_bytes', COALESCE(SUM(length(CAST(content AS BLOB))), 0)
+            FROM documents
+            UNION ALL
+            SELECT 'chunks', COUNT(*) FROM chunks
+            UNION ALL
+            SELECT 'vector_bytes',
+                (SELECT COALESCE(SUM(length(embedding)), 0) FROM documents)
+                + (SELECT COALESCE(SUM(length(embedding)), 0) FROM chunks)
+            UNION ALL
+            SELECT 'updated_at', {STATS_NOW}
+            """
+        )
+
+    def _add_content_hash(self: "Storage", batch_size: int = 1000) -> None:
+        """Add and fill the ``content_hash`` column of a database created without it.
+
+        Documents whose normalized content is already stored keep a NULL hash, the
+        unique index allows several of them.
+        """
+        console.log("Indexing document hashes")
+        self.db.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+        seen = set()
+        updates = []
+        cursor = self.db.execute("SELECT id, content FROM documents ORDER BY id")
+        while rows := cursor.fetchmany(batch_size):
+            for doc_id, content in rows:
+                key = content_hash(content or "")
+                if key not in seen:
+                    seen.add(key)
+                    updates.append((key, doc_id))
+        self.db.executemany("UPDATE documents SET content_hash = ? WHERE id = ?", updates)
+        self.db.commit()
+
+    def _add_file_columns(self: "Storage") -> None:
+        """Add the columns of file documents, filling ``file_path`` from the metadata."""
+        for column, sql_type in (("file_path", "TEXT"), ("mtime", "REAL"), ("size", "INTEGER")):
+            self.db.execute(f"ALTER TABLE documents ADD COLUMN {column} {sql_type}")
+        self.db.execute(
+            """
+            UPDATE documents SET file_path = json_extract(meta, '$.file_path')
+            WHERE meta IS NOT NULL
+            """
+        )
+        self.db.commit()
+
+    def _add_source_column(self: "Storage") -> None:
+        """Add the ``source`` column, filled like `document_source` from the metadata."""
+        self.db.execute("ALTER TABLE documents ADD COLUMN source TEXT")
+        self.db.execute(
+            """
+            UPDATE documents SET source = COALESCE(
+                json_extract(meta, '$.source'),
+                CASE WHEN file_path IS NOT NULL THEN 'file' END
+            )
+            WHERE meta IS NOT NULL
+            """
+        )
+        self.db.commit()
+
+    def _resolve_vector_dim(self: "Storage") -> int:
+        """Return the vector dimension of the database, recording it on first use.
+
+        The dimension is stored in ``kcli_meta`` together with the model name, so
+        opening an existing knowledge base never needs to ask the embedding model.
+
+        Raises:
+            RuntimeError: If the knowledge base was built with another embedding model.
+        """
+        model_name = self.embeddings.model_name
+        dim = self.get_meta("vector_dim")
+        stored_model = self.get_meta("embedding_model")
+        known_dim = known_embedding_size(model_name)
+        if dim is not None and stored_model is None and known_dim not in (None, int(dim)):
+            raise RuntimeError(
+                f"Knowledge base holds {dim}-dimensional vectors, but the configured "
+                f"'{model_name}' produces {known_dim}. Set KCLI_EMBEDDING_MODEL to the "
+                f"model it was built with or rebuild the knowledge base."
+            )
+        if dim is not None and stored_model in (None, model_name):
+            self.embeddings.embedding_size = int(dim)
+        elif dim is not None:
+            # Vectors of another model cannot be compared with the stored ones
+            raise RuntimeError(
+                f"Knowledge base was built with '{stored_model}', not the configured "
+                f"'{model_name}'. Set KCLI_EMBEDDING_MODEL={stored_model} or rebuild the "
+                f"knowledge base with the new model."
+            )
+        else:
+            dim = self.embeddings.embedding_size
+            self.set_meta("vector_dim", str(dim))
+        if stored_model is None:
+            self.set_meta("embedding_model", model_name)
+        self.db.commit()
+        return int(dim)
+
+    def get_meta(self: "Storage", key: str) -> Optional[str]:
+        """Read a value from the ``kcli_meta`` table.
+
+        Args:
+            key (str): Name of the metadata entry.
+
+        Returns:
+            Optional[str]: The stored value, or None if the key is not set.
+        """
+        row = self.db.execute("SELECT value FROM kcli_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self: "Storage", key: str, value: str) -> None:
+        """Write a value to the ``kcli_meta`` table without committing.
+
+        Args:
+            key (str): Name of the metadata entry.
+            value (str): Value to store.
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO kcli_meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def _set_vector_format(self: "Storage", dim: Optional[int]) -> None:
+        self.set_meta("vector_dtype", np.dtype(VECTOR_DTYPE).name)
+        if dim:
+            self.set_meta("vector_dim", str(dim))
+
+    def _sync_exact_index(self: "Storage") -> None:
+        """Rebuild the exact search matrix if it drifted from the database."""
+        expected = int(self.get_meta("exact_rows") or 0)
+        if self.exact.count() == expected:
+            return
+        console.log("Rebuilding exact search matrix")
+        self.rebuild_exact_index()
+
+    def rebuild_exact_index(self: "Storage", batch_size: int = 1000) -> int:
+        """Rewrite the exact search matrix from the chunk embeddings stored in SQLite.
+
+        Args:
+            batch_size (int): Number of rows read from SQLite at a time.
+
+        Returns:
+            int: The number of vectors in the rebuilt matrix.
+        """
+        count = self.exact.rebuild(self._embedding_batches(batch_size))
+        self.set_meta("exact_rows", str(count))
+        self.db.commit()
+        return count
+
+    def _embedding_batches(
+        self: "Storage", batch_size: int = 1000
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield the stored chunk embeddings of the index dimension, with their ids."""
+        cursor = self.db.cursor()
+        cursor.execute(
+            """
+            SELECT id, embedding FROM chunks
+            WHERE embedding IS NOT NULL
+            ORDER BY id
+            """
+        )
+        while rows := cursor.fetchmany(batch_size):
+            vectors = [(chunk_id, decode_vector(value)) for chunk_id, value in rows]
+            vectors = [(chunk_id, v) for chunk_id, v in vectors if len(v) == self.exact.dim]
+            if vectors:
+                yield (
+                    np.stack([v for _, v in vectors]),
+                    np.array([chunk_id for chunk_id, _ in vectors]),
+                )
+
+    def chunk_embeddings(self: "Storage", chunk_ids: Iterable[int]) -> Dict[int, np.ndarray]:
+        """Return the full-precision embeddings of chunks, by chunk id.
+
+        Args:
+            chunk_ids (Iterable[int]): IDs of the chunks, unknown ones are left out.
+
+        Returns:
+            Dict[int, np.ndarray]: The embedding of each stored chunk.
+        """
+        cursor = self.db.execute(
             """
+            SELECT id, embedding FROM chunks
+            WHERE id IN (SELECT value FROM json_each(?)) AND embedding IS NOT NULL
+            """,
+            (json.dumps([int(chunk_id) for chunk_id in chunk_ids]),),
+        )
+        return {chunk_id: decode_vector(value) for chunk_id, value in cursor.fetchall()}
+
+    @staticmethod
+    def _row_to_document(row: tuple) -> Document:
+        return Document(
+            id=row[0],
+            content=row[1],
+            url=row[2],
+            title=row[3],
+            created_at=datetime.fromisoformat(row[4]),
+            embedding=decode_vector(row[5]),
+            meta=json.loads(row[6]) if row[6] else {},
         )
 
     def query(self: "Storage", query: str) -> List[Document]:
         """Search for a query in the knowledge base."""
         cursor = self.db.cursor()  # Use existing connection
         cursor.execute(query)
-        rows = cursor.fetchall()
-        docs = []
-        for row in rows:
-            docs.append(
-                Document(
-                    id=row[0],
-                    content=row[1],
-                    url=row[2],
-                    title=row[3],
-                    created_at=datetime.fromisoformat(row[4]),
-                    embedding=np.array(json.loads(row[5])),
-                    meta=json.loads(row[6]) if row[6] else {},
-                )
-            )
+        return self._with_embeddings([self._row_to_document(row) for row in cursor.fetchall()])
+
+    def _with_embeddings(self: "Storage", docs: List[Document]) -> List[Document]:
+        """Derive the vector of documents that store none from their chunk vectors.
+
+        Documents with chunk vectors store no vector of their own, their
+        ``embedding`` is the mean of their chunk vectors.
+        """
+        missing = {doc.id: doc for doc in docs if doc.embedding is None and doc.id is not None}
+        ids = list(missing)
+        vectors: Dict[int, List[np.ndarray]] = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for doc_id, value in self.db.execute(
+                f"""
+                SELECT document_id, embedding FROM chunks
+                WHERE document_id IN ({placeholders}) AND embedding IS NOT NULL
+                ORDER BY document_id, chunk_index
+                """,
+                batch,
+            ):
+                vectors.setdefault(doc_id, []).append(decode_vector(value))
+        for doc_id, doc_vectors in vectors.items():
+            missing[doc_id].embedding = np.mean(doc_vectors, axis=0)
+        return docs
 
     def get_document_by_id(self: "Storage", doc_id: int) -> Optional[Document]:
         """Retrieve a document by its ID."""
@@ -122,188 +963,1245 @@ class Storage:
             (doc_id,),
         )
         row = cursor.fetchone()
-        if row:
-            return Document(
-                id=row[0],
-                content=row[1],
-                url=row[2],
-                title=row[3],
-                created_at=datetime.fromisoformat(row[4]),
-                embedding=np.array(json.loads(row[5])) if row[5] else None,
-                meta=json.loads(row[6]) if row[6] else {},
+        if not row:
+            return None
+        return self._with_embeddings([self._row_to_document(row)])[0]
+
+    def find_contents(self: "Storage", contents: Sequence[str]) -> List[Optional[int]]:
+        """Look up which contents are already stored, without embedding them.
+
+        Args:
+            contents (Sequence[str]): Document contents to look up.
+
+        Returns:
+            List[Optional[int]]: The id of the stored document with the same normalized
+            content, or None, for each content.
+        """
+        hashes = [content_hash(content) for content in contents]
+        found: Dict[str, int] = {}
+        unique = list(set(hashes))
+        for start in range(0, len(unique), 500):
+            batch = unique[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(
+                self.db.execute(
+                    f"""
+                    SELECT content_hash, id FROM documents
+                    WHERE content_hash IN ({placeholders})
+                    """,
+                    batch,
+                ).fetchall()
             )
-        return None
+        return [found.get(key) for key in hashes]
+
+    def add(self: "Storage", doc: Document) -> None:
         """Add a document to the storage.
 
         Args:
             doc (Document): Document object to be stored in the database. Must contain
                 content and metadata fields.
         """
-        # First add to SQLite
-        cursor = self.db.cursor()
-        cursor.execute("SELECT id FROM documents WHERE content = ?", (doc.content,))
-        existing_doc = cursor.fetchone()
-        if existing_doc:
+        with profiling.span("storage.add"):
+            inserted = self._insert_documents([doc])
+        if not inserted:
             console.log("Document already in the database, skipping.")
             return
-        cursor.execute(
-            """
-            INSERT INTO documents (content, url, title, created_at, embedding, meta)
-            VALUES (?, ?, ?, ?, ?, ?)
-            RETURNING id
-            """,
-            (
-                doc.content,
-                doc.url,
-                doc.title,
-                doc.created_at.isoformat(),
-                json.dumps(np.array(doc.embedding).tolist())
-                if doc.embedding is not None
-                else None,
-                json.dumps(doc.meta) if doc.meta else None,
-            ),
-        )
-        doc_id = cursor.fetchone()[0]
-        doc.id = doc_id
-        self.db.commit()
+        self._maybe_flush_index()
+        console.log(f"Document inserted: {doc.id}")
 
-        # Then add to hnswlib index
-        if doc.embedding is not None:
-            self.index.add_items(np.array([doc.embedding]), np.array([doc_id]))
-            self.index.save_index(self.index_path)
-        console.log(f"Document inserted: {doc_id}")
+    def add_many(
+        self: "Storage", docs: List[Document], num_threads: int = -1
+    ) -> List[Document]:
+        """Add several documents in a single transaction.
 
-    def _brut_force_search(
-        self: "Storage",
-        query: str,
-        limit: int = 10,
-        similarity_threshold: Optional[float] = None,
+        Unlike `add`, the hnswlib index is loaded so the whole batch goes into it
+        with one multi-threaded ``add_items`` call.
+
+        Args:
+            docs (List[Document]): Documents to store.
+            num_threads (int): Threads used to insert into the index, -1 for all cores.
+
+        Returns:
+            List[Document]: The documents that were inserted, duplicates left out.
+        """
+        self.index.reserve(len(docs))
+        with profiling.span("storage.add_many", docs=len(docs)):
+            inserted = self._insert_documents(docs, num_threads)
+        self._maybe_flush_index()
+        return inserted
+
+    def _insert_documents(
+        self: "Storage", docs: List[Document], num_threads: int = -1
     ) -> List[Document]:
-        query_embedding = self.embeddings.create_embeddings(query)
-        # Fetch all documents from SQLite
+        """Insert documents that are not stored yet and set their ``id``."""
         cursor = self.db.cursor()
-        cursor.execute(
-            "SELECT id, content, url, title, created_at, embedding, meta FROM documents"
-        )
-        rows = cursor.fetchall()
-
-        # Calculate cosine similarity for each document
-        similarities = []
-        for row in rows:
-            doc_id, content, url, title, created_at, embedding, meta = row
-            if embedding is not None:
-                embedding = np.array(json.loads(embedding))
-                similarity = np.dot(query_embedding, embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(embedding)
+        new_docs = []
+        seen = set()
+        for doc, doc_id in zip(docs, self.find_contents([doc.content for doc in docs])):
+            key = content_hash(doc.content)
+            if doc_id is None and key not in seen:
+                new_docs.append((doc, key))
+            seen.add(key)
+        if not new_docs:
+            return []
+
+        # Allocate the ids up front so the rows can be inserted with executemany
+        if not self.db.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for doc_id, (doc, _) in enumerate(new_docs, start=self._last_id("documents") + 1):
+                doc.id = doc_id
+                if not doc.chunks and doc.embedding is not None:
+                    doc.chunks = [Chunk(0, len(doc.content), doc.embedding)]
+            cursor.executemany(
+                """
+                INSERT INTO documents (
+                    id, content, url, title, created_at, embedding, meta, content_hash,
+                    file_path, mtime, size, source
                 )
-                if similarity_threshold is None or similarity >= similarity_threshold:
-                    similarities.append((doc_id, similarity))
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        doc.id,
+                        doc.content,
+                        doc.url,
+                        doc.title,
+                        doc.created_at.isoformat(),
+                        _document_vector(doc),
+                        json.dumps(doc.meta) if doc.meta else None,
+                        key,
+                        doc.meta.get("file_path"),
+                        doc.meta.get("mtime"),
+                        doc.meta.get("size"),
+                        document_source(doc.meta),
+                    )
+                    for doc, key in new_docs
+                ],
+            )
+            new_docs = [doc for doc, _ in new_docs]
+            chunks = self._insert_chunks(new_docs)
+            self._index_chunks(chunks, num_threads)
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
 
-        # Sort by similarity and get top results
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        top_results = similarities[:limit]
+        # Then add to the exact matrix
+        self._add_exact(chunks)
+        return new_docs
 
-        # Fetch documents from SQLite
-        doc_ids = [doc_id for doc_id, _ in top_results]
-        placeholders = ",".join("?" * len(doc_ids))
-        cursor.execute(
+    def _index_chunks(self: "Storage", chunks: List[Chunk], num_threads: int = -1) -> None:
+        """Journal the vectors of inserted chunks, within the current transaction."""
+        if chunks:
+            vectors = np.stack([np.asarray(chunk.embedding) for chunk in chunks])
+            exact_rows = int(self.get_meta("exact_rows") or 0) + len(chunks)
+            self.set_meta("exact_rows", str(exact_rows))
+            self._index_vectors(vectors, [chunk.id for chunk in chunks], num_threads)
+
+    def _add_exact(self: "Storage", chunks: List[Chunk]) -> None:
+        """Append committed chunks to the exact search matrix."""
+        if chunks:
+            with profiling.span("exact.append", rows=len(chunks)):
+                self.exact.add(
+                    np.stack([np.asarray(chunk.embedding) for chunk in chunks]),
+                    [chunk.id for chunk in chunks],
+                )
+
+    def _last_id(self: "Storage", table: str) -> int:
+        """Return the last id used in an AUTOINCREMENT table, even if it was deleted."""
+        (last_id,) = self.db.execute(
             f"""
-            SELECT id, content, url, title, created_at, embedding, meta
-            FROM documents
-            WHERE id IN ({placeholders})
+            SELECT MAX(
+                (SELECT COALESCE(MAX(id), 0) FROM {table}),
+                (SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = ?)
+            )
+            """,
+            (table,),
+        ).fetchone()
+        return last_id
+
+    def _insert_chunks(self: "Storage", docs: List[Document]) -> List[Chunk]:
+        """Insert the embedded chunks of documents and set their ``id``.
+
+        Chunks that already have an ``id`` are stored already and left out.
+        """
+        chunks = []
+        rows = []
+        next_id = self._last_id("chunks") + 1
+        for doc in docs:
+            for chunk_index, chunk in enumerate(doc.chunks):
+                if chunk.embedding is None or chunk.id is not None:
+                    continue
+                chunk.id = next_id
+                next_id += 1
+                chunks.append(chunk)
+                rows.append(
+                    (
+                        chunk.id,
+                        doc.id,
+                        chunk_index,
+                        chunk.start,
+                        chunk.end,
+                        encode_vector(chunk.embedding),
+                    )
+                )
+        self.db.executemany(
+            """
+            INSERT INTO chunks
+                (id, document_id, chunk_index, start_offset, end_offset, embedding)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        return chunks
+
+    def chunk_vectors(self: "Storage", doc_id: int) -> Dict[str, np.ndarray]:
+        """Return the stored chunk embeddings of a document, keyed by chunk text hash.
+
+        Args:
+            doc_id (int): ID of the document.
+
+        Returns:
+            Dict[str, np.ndarray]: Embeddings keyed like `Embeddings.chunk_and_embed`
+            expects its ``known`` argument.
+        """
+        return {
+            text_hash(text): decode_vector(embedding)
+            for text, embedding, _ in self._chunk_texts(doc_id)
+        }
+
+    def _chunk_texts(self: "Storage", doc_id: int) -> List[Tuple[str, bytes, int]]:
+        return self.db.execute(
+            """
+            SELECT substr(d.content, c.start_offset + 1, c.end_offset - c.start_offset),
+                c.embedding, c.id
+            FROM chunks c JOIN documents d ON d.id = c.document_id
+            WHERE c.document_id = ? AND c.embedding IS NOT NULL
+            ORDER BY c.chunk_index
+            """,
+            (doc_id,),
+        ).fetchall()
+
+    def update_document(self: "Storage", doc: Document) -> Dict[str, int]:
+        """Replace the content of a stored document, keeping its unchanged chunks.
+
+        Chunks whose text is unchanged keep their id and vector, only their
+        offsets are updated. The other old chunks are deleted from the indexes and
+        the new ones are added, so the cost is proportional to the changes.
+
+        Args:
+            doc (Document): The document with its ``id`` and new content and chunks.
+
+        Returns:
+            Dict[str, int]: Number of ``reused``, ``added`` and ``removed`` chunks.
+        """
+        old: Dict[str, List[int]] = {}
+        for text, _, chunk_id in self._chunk_texts(doc.id):
+            old.setdefault(text_hash(text), []).append(chunk_id)
+        kept = []
+        for chunk_index, chunk in enumerate(doc.chunks):
+            chunk.id = None
+            ids = old.get(text_hash(doc.content[chunk.start : chunk.end]))
+            if ids:
+                chunk.id = ids.pop(0)
+                kept.append((chunk_index, chunk.start, chunk.end, chunk.id))
+        removed = [chunk_id for ids in old.values() for chunk_id in ids]
+
+        if not self.db.in_transaction:
+            self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                """
+                UPDATE documents SET content = ?, title = ?, embedding = ?, meta = ?,
+                    content_hash = ?, file_path = ?, mtime = ?, size = ?, source = ?
+                WHERE id = ?
+                """,
+                (
+                    doc.content,
+                    doc.title,
+                    _document_vector(doc),
+                    json.dumps(doc.meta) if doc.meta else None,
+                    content_hash(doc.content),
+                    doc.meta.get("file_path"),
+                    doc.meta.get("mtime"),
+                    doc.meta.get("size"),
+                    document_source(doc.meta),
+                    doc.id,
+                ),
+            )
+            self.db.executemany(
+                "UPDATE chunks SET chunk_index = ?, start_offset = ?, end_offset = ? WHERE id = ?",
+                kept,
+            )
+            self._delete_chunks(removed)
+            chunks = self._insert_chunks([doc])
+            self._index_chunks(chunks)
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        self._add_exact(chunks)
+        self._maybe_flush_index()
+        return {"reused": len(kept), "added": len(chunks), "removed": len(removed)}
+
+    def delete_document(self: "Storage", doc_id: int) -> bool:
+        """Delete a document and its chunks.
+
+        The chunks are marked deleted in the hnswlib index. Their rows stay in the
+        exact search matrix, where they are ignored, until it is rebuilt, see
+        `compact`.
+
+        Args:
+            doc_id (int): ID of the document.
+
+        Returns:
+            bool: Whether the document existed.
+        """
+        return self.delete_documents([doc_id]) > 0
+
+    def delete_documents(self: "Storage", doc_ids: Sequence[int]) -> int:
+        """Delete documents and their chunks in a single transaction, see `delete_document`.
+
+        Args:
+            doc_ids (Sequence[int]): IDs of the documents.
+
+        Returns:
+            int: The number of documents that existed.
+        """
+        if not self.db.in_transaction:
+            self.db.execute("BEGIN IMMEDIATE")
+        deleted = 0
+        try:
+            for start in range(0, len(doc_ids), 500):
+                batch = list(doc_ids[start : start + 500])
+                placeholders = ",".join("?" * len(batch))
+                chunk_ids = [
+                    chunk_id
+                    for (chunk_id,) in self.db.execute(
+                        f"SELECT id FROM chunks WHERE document_id IN ({placeholders})", batch
+                    )
+                ]
+                self._delete_chunks(chunk_ids)
+                deleted += self.db.execute(
+                    f"DELETE FROM documents WHERE id IN ({placeholders})", batch
+                ).rowcount
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        self._maybe_flush_index()
+        return deleted
+
+    def find_documents(self: "Storage", ref: str) -> List[Tuple[int, str, Optional[str]]]:
+        """Return the documents a reference designates.
+
+        Args:
+            ref (str): A document ID, or a URL prefix such as ``https://example.com/old/``
+                or ``file:///home/me/notes/``.
+
+        Returns:
+            List[Tuple[int, str, Optional[str]]]: The ``(id, title, url)`` of each document.
+
+        Raises:
+            ValueError: If the reference is empty.
+        """
+        if not ref:
+            raise ValueError("Give a document ID or a URL prefix.")
+        if ref.isdigit():
+            condition, params = "id = ?", [int(ref)]
+        else:
+            condition, params = "url >= ? AND url < ?", list(prefix_range(ref))
+        return self.db.execute(
+            f"SELECT id, title, url FROM documents WHERE {condition} ORDER BY id", params
+        ).fetchall()
+
+    def update_pages(self: "Storage", docs: List[Document]) -> List[Document]:
+        """Update in place the stored pages whose content changed since they were crawled.
+
+        A page whose URL is already stored replaces the content of that document,
+        see `update_document`, instead of being added next to the stale one. When
+        its new content is already stored under another document, the stale
+        document is deleted instead, as `kcli sync` does for files.
+
+        Args:
+            docs (List[Document]): Crawled pages, with their embedded chunks.
+
+        Returns:
+            List[Document]: The pages left to add, new, unchanged or duplicates, see
+            `add_many`.
+        """
+        urls = list({doc.url for doc in docs if doc.url})
+        stored: Dict[str, int] = {}
+        for start in range(0, len(urls), 500):
+            batch = urls[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            stored.update(
+                self.db.execute(
+                    f"""
+                    SELECT url, MAX(id) FROM documents
+                    WHERE url IN ({placeholders})
+                    GROUP BY url
+                    """,
+                    batch,
+                ).fetchall()
+            )
+        remaining = []
+        for doc in docs:
+            doc_id = stored.get(doc.url)
+            # Looked up per page, an earlier page of the batch may have stored this content
+            (known_id,) = self.find_contents([doc.content]) if doc_id is not None else (None,)
+            if doc_id is None or known_id == doc_id:
+                remaining.append(doc)
+            elif known_id is not None:
+                # The page now has the same content as another document
+                self.delete_document(doc_id)
+                del stored[doc.url]
+                console.log(f"Document removed: {doc_id}, its page duplicates {known_id}")
+                remaining.append(doc)
+            else:
+                doc.id = doc_id
+                self.update_document(doc)
+                console.log(f"Document updated: {doc_id}")
+        return remaining
+
+    def _dead_rows(self: "Storage") -> int:
+        """Return the rows of the exact search matrix left by deleted chunks."""
+        (chunks,) = self.db.execute(
+            "SELECT COALESCE((SELECT value FROM kcli_stats WHERE key = 'chunks'), 0)"
+        ).fetchone()
+        return max(int(self.get_meta("exact_rows") or 0) - int(chunks), 0)
+
+    def _live_chunks(self: "Storage", chunk_ids: Iterable[int]) -> set:
+        """Return the chunk ids that are still stored, through the primary key."""
+        return {
+            chunk_id
+            for (chunk_id,) in self.db.execute(
+                "SELECT id FROM chunks WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(chunk_ids)),),
+            )
+        }
+
+    def tombstones(self: "Storage") -> Dict[str, float]:
+        """Return the deleted vectors still taking room in the indexes.
+
+        The hnswlib figures are those of the loaded index, or of its last flush.
+
+        Returns:
+            Dict[str, float]: The ``index`` labels marked deleted in hnswlib, the
+            ``matrix`` rows of the exact search matrix left by deleted chunks, the
+            largest ``ratio`` of either to the size of its index, and whether it
+            reached ``KCLI_COMPACT_THRESHOLD``, so `compact` is ``due``.
+        """
+        facts = self._recorded_index_facts()
+        rows = int(self.get_meta("exact_rows") or 0)
+        dead_rows = self._dead_rows()
+        ratio = max(
+            facts["index_deleted"] / max(facts["index_elements"], 1), dead_rows / max(rows, 1)
+        )
+        return {
+            "index": facts["index_deleted"],
+            "matrix": dead_rows,
+            "ratio": ratio,
+            "due": ratio > 0 and ratio >= COMPACT_THRESHOLD,
+        }
+
+    def compact(self: "Storage", force: bool = False, num_threads: int = -1) -> Dict[str, Any]:
+        """Rebuild the indexes without their deleted vectors, and vacuum the database.
+
+        The hnswlib index is rebuilt from the stored chunk embeddings with
+        multi-threaded inserts, and replaces the index file atomically once saved.
+        The exact search matrix is rewritten the same way, see `rebuild_exact_index`.
+        Writers are locked out of the database until the new index is saved.
+
+        Args:
+            force (bool): Compact even if fewer than ``KCLI_COMPACT_THRESHOLD`` of the
+                vectors of either index are deleted.
+            num_threads (int): Threads used to insert into the index, -1 for all cores.
+
+        Returns:
+            Dict[str, Any]: Whether the indexes were ``compacted``, the `tombstones`
+            found, and once compacted the ``vectors`` left, the ``db_bytes`` and
+            ``index_bytes`` ``before`` and after, and the elapsed ``seconds``.
+        """
+        tombstones = self.tombstones()
+        if not force and not tombstones["due"]:
+            return {"compacted": False, "threshold": COMPACT_THRESHOLD, **tombstones}
+        start = time.perf_counter()
+        before = {"db_bytes": self._db_bytes(), "index_bytes": _file_size(self.index_path)}
+        params = self.index_params()
+        (chunks,) = self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            with profiling.span("storage.compact", chunks=chunks):
+                index = VectorIndex(self.index_path, self.vector_dim, params, fresh=True)
+                index.reserve(chunks)
+                for vectors, labels in self._embedding_batches():
+                    index.add(vectors, labels, num_threads=num_threads)
+                index.save()
+            # Every stored chunk is in the saved index
+            self.db.execute("DELETE FROM index_journal")
+            for key, value in self._index_facts(index).items():
+                self.set_meta(key, str(value))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        self._index = index
+        self._unflushed = []
+        self._deleted = False
+        self._last_flush = time.monotonic()
+        self.rebuild_exact_index()
+        with profiling.span("sqlite.vacuum"):
+            self.db.execute("VACUUM")
+        return {
+            "compacted": True,
+            **tombstones,
+            "vectors": index.element_count,
+            "before": before,
+            "db_bytes": self._db_bytes(),
+            "index_bytes": _file_size(self.index_path),
+            "seconds": time.perf_counter() - start,
+        }
+
+    def _delete_chunks(self: "Storage", chunk_ids: List[int]) -> None:
+        """Delete chunks and their pending journal entries, without committing.
+
+        Deleted labels that are still in the hnswlib index are dropped from search
+        results, as they no longer match a chunk, until the deletion is flushed.
+        """
+        for start in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            self.db.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+            self.db.execute(f"DELETE FROM index_journal WHERE label IN ({placeholders})", batch)
+        if chunk_ids and (self._index is not None or os.path.exists(self.index_path)):
+            self.index.mark_deleted(chunk_ids)
+            self._deleted = True
+
+    def enqueue_urls(
+        self: "Storage", entries: Sequence[Tuple[str, int, int, Optional[str]]]
+    ) -> List[Tuple[str, int, int, Optional[str]]]:
+        """Add URLs to the crawl frontier, unless they are known already.
+
+        A URL is known when it is in the frontier, whatever its status, or is the
+        URL of a stored document.
+
+        Args:
+            entries (Sequence[Tuple[str, int, int, Optional[str]]]): Normalized URL, depth,
+                maximum depth of the crawl and the domain it is restricted to, if any.
+
+        Returns:
+            List[Tuple[str, int, int, Optional[str]]]: The entries that were added.
+        """
+        added = []
+        now = datetime.now().isoformat()
+        for url, depth, max_depth, domain in entries:
+            if self.db.execute("SELECT 1 FROM documents WHERE url = ?", (url,)).fetchone():
+                continue
+            cursor = self.db.execute(
+                """
+                INSERT OR IGNORE INTO crawl_frontier (url, depth, max_depth, domain, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (url, depth, max_depth, domain, now),
+            )
+            if cursor.rowcount:
+                added.append((url, depth, max_depth, domain))
+        self.db.commit()
+        return added
+
+    def pending_urls(self: "Storage") -> List[Tuple[str, int, int, Optional[str]]]:
+        """Return the frontier URLs not crawled yet, shallowest first, see `enqueue_urls`."""
+        return self.db.execute(
+            """
+            SELECT url, depth, max_depth, domain FROM crawl_frontier
+            WHERE status = 'pending'
+            ORDER BY depth, rowid
+            """
+        ).fetchall()
+
+    def set_url_status(self: "Storage", urls: Sequence[str], status: str) -> None:
+        """Mark frontier URLs as ``done`` or ``failed``."""
+        now = datetime.now().isoformat()
+        self.db.executemany(
+            "UPDATE crawl_frontier SET status = ?, updated_at = ? WHERE url = ?",
+            [(status, now, url) for url in urls],
+        )
+        self.db.commit()
+
+    def add_source(
+        self: "Storage",
+        path: str,
+        patterns: Optional[Sequence[str]] = None,
+        excludes: Optional[Sequence[str]] = None,
+    ) -> None:
+        """Record a file or directory added to the knowledge base, for `kcli sync`.
+
+        Args:
+            path (str): Absolute path of the file or directory.
+            patterns (Optional[Sequence[str]]): Glob patterns of a directory, None for a file.
+            excludes (Optional[Sequence[str]]): Exclusion patterns of a directory.
+        """
+        self.db.execute(
+            """
+            INSERT OR REPLACE INTO sources (path, patterns, excludes, added_at)
+            VALUES (?, ?, ?, ?)
             """,
-            doc_ids,
+            (
+                path,
+                json.dumps(list(patterns)) if patterns is not None else None,
+                json.dumps(list(excludes or [])),
+                datetime.now().isoformat(),
+            ),
         )
-        rows = cursor.fetchall()
+        self.db.commit()
+
+    def get_sources(self: "Storage") -> List[Dict[str, Any]]:
+        """Return the recorded sources, see `add_source`."""
         return [
-            Document(
-                id=row[0],
-                content=row[1],
-                url=row[2],
-                title=row[3],
-                created_at=datetime.fromisoformat(row[4]),
-                embedding=np.array(json.loads(row[5])) if row[5] else None,
-                meta=json.loads(row[6]) if row[6] else {},
+            {
+                "path": path,
+                "patterns": json.loads(patterns) if patterns is not None else None,
+                "excludes": json.loads(excludes) if excludes else [],
+            }
+            for path, patterns, excludes in self.db.execute(
+                "SELECT path, patterns, excludes FROM sources ORDER BY path"
             )
-            for row in rows
         ]
 
+    def file_documents(self: "Storage", path: str) -> Dict[str, Tuple[int, float, int, str]]:
+        """Return the stored documents of a file, or of the files below a directory.
+
+        Args:
+            path (str): Absolute path of a file or directory.
+
+        Returns:
+            Dict[str, Tuple[int, float, int, str]]: ``(id, mtime, size, content_hash)`` of
+            each document, keyed by file path.
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        # A range on the prefix, the next character after the separator ends it
+        end = prefix[:-1] + chr(ord(os.sep) + 1)
+        rows = self.db.execute(
+            """
+            SELECT file_path, id, mtime, size, content_hash FROM documents
+            WHERE file_path = ? OR (file_path >= ? AND file_path < ?)
+            """,
+            (path, prefix, end),
+        )
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def set_file_stat(self: "Storage", doc_id: int, mtime: float, size: int) -> None:
+        """Record the modification time and size of an unchanged file."""
+        self.db.execute(
+            """
+            UPDATE documents SET mtime = ?, size = ?,
+                meta = json_set(COALESCE(meta, '{}'), '$.mtime', ?, '$.size', ?)
+            WHERE id = ?
+            """,
+            (mtime, size, mtime, size, doc_id),
+        )
+        self.db.commit()
+
+    def migrate(self: "Storage", batch_size: int = 500) -> int:
+        """Upgrade the database to the current schema version.
+
+        JSON-encoded embeddings are converted to float32 BLOBs in place. Rows are
+        converted in batches, each committed on its own, so an interrupted migration
+        can simply be run again. Documents are then split into chunks, see
+        `_migrate_chunks`.
+
+        Args:
+            batch_size (int): Number of rows converted per transaction.
+
+        Returns:
+            int: The number of rows that were converted.
+        """
+        converted = 0
+        dim = None
+        cursor = self.db.cursor()
+        while True:
+            cursor.execute(
+                """
+                SELECT id, embedding FROM documents
+                WHERE typeof(embedding) = 'text'
+                LIMIT ?
+                """,
+                (batch_size,),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for doc_id, value in rows:
+                vector = decode_vector(value)
+                dim = len(vector)
+                updates.append((encode_vector(vector), doc_id))
+            cursor.executemany("UPDATE documents SET embedding = ? WHERE id = ?", updates)
+            self.db.commit()
+            converted += len(updates)
+            console.log(f"Migrated {converted} embeddings")
+        self._set_vector_format(dim or self.vector_dim)
+        if self.get_meta("schema_version") == "1":
+            self.set_meta("schema_version", "2")
+        if self.get_meta("schema_version") == "2":
+            self._migrate_chunks()
+            self._index = None
+            self._unflushed = []
+            self.rebuild_exact_index()
+        if self.get_meta("schema_version") == "3":
+            self._drop_document_vectors()
+        self.db.commit()
+        if converted:
+            # Reclaim the space freed by the much smaller BLOBs.
+            self.db.execute("VACUUM")
+        return converted
+
+    def _migrate_chunks(self: "Storage") -> None:
+        """Index every document of a version 2 database as a single chunk.
+
+        The hnswlib index of version 2 was labelled by document id, so it is
+        discarded and every chunk is journaled to rebuild it on next load.
+        """
+        console.log("Upgrading the knowledge base to chunk-level vectors")
+        self.db.execute(
+            """
+            INSERT INTO chunks (document_id, chunk_index, start_offset, end_offset, embedding)
+            SELECT id, 0, 0, length(content), embedding FROM documents
+            WHERE embedding IS NOT NULL
+            AND id NOT IN (SELECT document_id FROM chunks)
+            ORDER BY id
+            """
+        )
+        self.db.execute("DELETE FROM index_journal")
+        self.db.execute(
+            """
+            INSERT INTO index_journal (label, vector)
+            SELECT id, embedding FROM chunks WHERE embedding IS NOT NULL
+            """
+        )
+        # Force a rebuild of the exact matrix, which was labelled by document id too
+        self.set_meta("exact_rows", "-1")
+        self.set_meta("schema_version", "3")
+        self.db.commit()
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def _drop_document_vectors(self: "Storage") -> None:
+        """Drop the mean vectors of a version 3 database, kept in the chunk vectors already.
+
+        The freed pages are reused by SQLite, `compact` returns them to the file system.
+        """
+        console.log("Dropping the document vectors duplicated by their chunk vectors")
+        self.db.execute(
+            """
+            UPDATE documents SET embedding = NULL
+            WHERE embedding IS NOT NULL AND id IN (SELECT document_id FROM chunks)
+            """
+        )
+        self.set_meta("schema_version", str(SCHEMA_VERSION))
+        self.db.commit()
+
+    def _collect_results(
+        self: "Storage",
+        chunk_ids: List[int],
+        scores: List[float],
+        limit: int,
+        offset: int = 0,
+        passage_chars: Optional[int] = None,
+    ) -> List[SearchResult]:
+        """Group matching chunks by document, best document first, for one page."""
+        ((chunk_ids, scores),) = self._page_hits([(chunk_ids, scores)], limit, offset)
+        rows = self._fetch_passages(chunk_ids, passage_chars)
+        with profiling.span("search.group"):
+            return self._group_results(chunk_ids, scores, limit, rows)
+
+    def _page_hits(
+        self: "Storage",
+        hits: List[Tuple[List[int], List[float]]],
+        limit: int,
+        offset: int,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """Keep the chunks of the documents ranked ``offset`` to ``offset + limit``.
+
+        Documents are ranked by their best chunk. Only the document id of each
+        chunk is read, through the primary key, so that passages are then only
+        fetched for the page, see `_fetch_passages`.
+
+        Args:
+            hits (List[Tuple[List[int], List[float]]]): Chunk ids and scores of each query,
+                best first.
+            limit (int): Number of documents in a page.
+            offset (int): Number of documents skipped before the page.
+
+        Returns:
+            List[Tuple[List[int], List[float]]]: The chunks and scores of the page of each
+            query, in the same order.
+        """
+        chunk_ids = list(dict.fromkeys(chunk_id for ids, _ in hits for chunk_id in ids))
+        if not chunk_ids:
+            return [([], []) for _ in hits]
+        with profiling.span("sqlite.chunk_documents", chunks=len(chunk_ids)):
+            documents = dict(
+                self.db.execute(
+                    """
+                    SELECT id, document_id FROM chunks
+                    WHERE id IN (SELECT value FROM json_each(?))
+                    """,
+                    (json.dumps(chunk_ids),),
+                ).fetchall()
+            )
+        pages = []
+        for ids, scores in hits:
+            ranks: Dict[int, int] = {}
+            page: Tuple[List[int], List[float]] = ([], [])
+            for chunk_id, score in zip(ids, scores):
+                if chunk_id not in documents:
+                    continue
+                rank = ranks.setdefault(documents[chunk_id], len(ranks))
+                if offset <= rank < offset + limit:
+                    page[0].append(chunk_id)
+                    page[1].append(score)
+            pages.append(page)
+        return pages
+
+    def _fetch_passages(
+        self: "Storage", chunk_ids: Iterable[int], passage_chars: Optional[int] = None
+    ) -> Dict[int, Tuple]:
+        """Read matching chunks with their documents, in a single query.
+
+        Only the matching passages are read from the database, cut out of the
+        document content by SQLite, so the result size does not depend on the size
+        of the documents. ``passage_chars`` further cuts each passage to its start.
+        """
+        chunk_ids = list(dict.fromkeys(chunk_ids))
+        if not chunk_ids:
+            return {}
+        with profiling.span("sqlite.fetch_passages", chunks=len(chunk_ids)):
+            rows = self.db.execute(
+                """
+                SELECT c.id, c.start_offset, c.end_offset,
+                    substr(
+                        d.content,
+                        c.start_offset + 1,
+                        MIN(c.end_offset - c.start_offset, COALESCE(?, c.end_offset))
+                    ),
+                    d.id, d.url, d.title, d.created_at, d.meta
+                FROM chunks c JOIN documents d ON d.id = c.document_id
+                WHERE c.id IN (SELECT value FROM json_each(?))
+                """,
+                (passage_chars, json.dumps(chunk_ids)),
+            ).fetchall()
+        profiling.count("sqlite.rows", len(rows))
+        profiling.count("sqlite.passage_chars", sum(len(row[3]) for row in rows))
+        return {row[0]: row for row in rows}
+
+    def _group_results(
+        self: "Storage",
+        chunk_ids: List[int],
+        scores: List[float],
+        limit: int,
+        rows: Dict[int, Tuple],
+    ) -> List[SearchResult]:
+        results: Dict[int, SearchResult] = {}
+        for chunk_id, score in zip(chunk_ids, scores):
+            if chunk_id not in rows:
+                continue
+            _, start, end, text, doc_id, url, title, created_at, meta = rows[chunk_id]
+            if doc_id not in results:
+                if len(results) == limit:
+                    continue
+                results[doc_id] = SearchResult(
+                    id=doc_id,
+                    url=url,
+                    title=title,
+                    created_at=datetime.fromisoformat(created_at),
+                    meta=json.loads(meta) if meta else {},
+                    score=score,
+                    passages=[],
+                )
+            results[doc_id].passages.append(Passage(chunk_id, start, end, score, text))
+        return list(results.values())
+
     def search(
         self: "Storage",
         query: str,
         limit: int = 10,
         similarity_threshold: Optional[float] = None,
-    ) -> List[Document]:
-        """Search for a query in the knowledge base."""
-        if self.index.element_count > 100:
-            return self._hnsw_search(query, limit, similarity_threshold)
-        else:
-            return self._brut_force_search(query, limit, similarity_threshold)
+        ef: Optional[int] = None,
+        mode: str = "vector",
+        filters: Optional[SearchFilter] = None,
+        offset: int = 0,
+        passage_chars: Optional[int] = None,
+    ) -> List[SearchResult]:
+        """Search for a query in the knowledge base.
+
+        Args:
+            query (str): Text to search for.
+            limit (int): Maximum number of documents to return.
+            similarity_threshold (Optional[float]): Minimum cosine similarity of a passage.
+            ef (Optional[int]): hnswlib candidate list size for this query, trading
+                latency for recall. Ignored by the brute force search.
+            mode (str): ``vector`` ranks passages by embedding similarity, ``lexical``
+                by BM25 over the full-text index, without embedding the query, and
+                ``hybrid`` merges both rankings with reciprocal rank fusion.
+            filters (Optional[SearchFilter]): Only search the matching documents. The
+                filter is applied within the index search, so ``limit`` documents are
+                still returned when enough of them match.
+            offset (int): Number of best documents to skip, to page through the results.
+            passage_chars (Optional[int]): Cut the text of each passage to its first
+                characters, in SQL, when only a snippet is shown.
+
+        Returns:
+            List[SearchResult]: Matching documents with their matching passages, best
+            first. Scores are cosine similarities, BM25 scores or fused scores,
+            depending on the mode.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', use one of {', '.join(SEARCH_MODES)}.")
+        k = (offset + limit) * CHUNK_OVERFETCH
+        with profiling.span("search", mode=mode):
+            if mode == "vector":
+                with profiling.span("search.embed_query"):
+                    query_embedding = self.embeddings.create_embeddings(query)
+                chunk_ids, scores = self._vector_candidates(
+                    query_embedding, k, similarity_threshold, ef, filters
+                )
+            elif mode == "lexical":
+                chunk_ids, scores = self._lexical_candidates(query, k, filters)
+            else:
+                chunk_ids, scores = self._hybrid_candidates(
+                    query, k, similarity_threshold, ef, filters
+                )
+            return self._collect_results(chunk_ids, scores, limit, offset, passage_chars)
 
-    def _hnsw_search(
+    def search_many(
         self: "Storage",
-        query: str,
+        queries: List[str],
         limit: int = 10,
         similarity_threshold: Optional[float] = None,
-    ) -> List[Document]:
-        query_embedding = self.embeddings.create_embeddings(query)
-        max(1, min(limit, self.index.element_count - 1))
-        # Search in hnswlib index
-        try:
-            labels, distances = self.index.knn_query(query_embedding, k=limit)
-            # filter results based on similarity threshold
-            if similarity_threshold is not None:
-                filtered_results = [
-                    label
-                    for label, distance in zip(labels[0], distances[0])
-                    if 1 - distance >= similarity_threshold
-                ]
+        ef: Optional[int] = None,
+        mode: str = "vector",
+        filters: Optional[SearchFilter] = None,
+        num_threads: int = -1,
+        offset: int = 0,
+        passage_chars: Optional[int] = None,
+    ) -> List[List[SearchResult]]:
+        """Search several queries in one pass, see `search` for the arguments.
+
+        The queries are embedded with batched requests, searched with a single
+        multi-row index query, and their passages are read with a single SQL
+        query. The embedding runs in a thread while the lexical searches run.
+
+        Args:
+            queries (List[str]): Texts to search for.
+            limit (int): Maximum number of documents per query.
+            similarity_threshold (Optional[float]): Minimum cosine similarity of a passage.
+            ef (Optional[int]): hnswlib candidate list size for these queries.
+            mode (str): ``vector``, ``lexical`` or ``hybrid``.
+            filters (Optional[SearchFilter]): Only search the matching documents.
+            num_threads (int): Threads used by hnswlib, -1 for all cores.
+            offset (int): Number of best documents to skip for each query.
+            passage_chars (Optional[int]): Cut the text of each passage to its first characters.
+
+        Returns:
+            List[List[SearchResult]]: The results of each query, in query order.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', use one of {', '.join(SEARCH_MODES)}.")
+        if not queries:
+            return []
+        k = (offset + limit) * CHUNK_OVERFETCH
+        with profiling.span("search_many", queries=len(queries), mode=mode):
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                if mode != "lexical":
+                    embeddings = pool.submit(self.embeddings.batch_embed, queries)
+                if mode != "vector":
+                    lexical = [self._lexical_candidates(query, k, filters) for query in queries]
+                if mode != "lexical":
+                    with profiling.span("search.embed_query"):
+                        query_embeddings = np.stack(embeddings.result())
+                    vector = self._vector_candidates_many(
+                        query_embeddings, k, similarity_threshold, ef, filters, num_threads
+                    )
+            if mode == "vector":
+                hits = vector
+            elif mode == "lexical":
+                hits = lexical
             else:
-                filtered_results = labels[0]
-            doc_ids = filtered_results.tolist()
+                hits = [
+                    reciprocal_rank_fusion([lexical_ids, vector_ids])
+                    for (lexical_ids, _), (vector_ids, _) in zip(lexical, vector)
+                ]
+                hits = [(chunk_ids[:k], scores[:k]) for chunk_ids, scores in hits]
+            hits = self._page_hits(hits, limit, offset)
+            rows = self._fetch_passages(
+                (chunk_id for chunk_ids, _ in hits for chunk_id in chunk_ids), passage_chars
+            )
+            with profiling.span("search.group"):
+                return [
+                    self._group_results(chunk_ids, scores, limit, rows)
+                    for chunk_ids, scores in hits
+                ]
+
+    def _hybrid_candidates(
+        self: "Storage",
+        query: str,
+        k: int,
+        similarity_threshold: Optional[float] = None,
+        ef: Optional[int] = None,
+        filters: Optional[SearchFilter] = None,
+    ) -> Tuple[List[int], List[float]]:
+        """Rank chunks by lexical and vector search, embedding the query meanwhile."""
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            query_embedding = pool.submit(self.embeddings.create_embeddings, query)
+            lexical_ids, _ = self._lexical_candidates(query, k, filters)
+            vector_ids, _ = self._vector_candidates(
+                query_embedding.result(), k, similarity_threshold, ef, filters
+            )
+        chunk_ids, scores = reciprocal_rank_fusion([lexical_ids, vector_ids])
+        return chunk_ids[:k], scores[:k]
+
+    def _lexical_candidates(
+        self: "Storage", query: str, k: int, filters: Optional[SearchFilter] = None
+    ) -> Tuple[List[int], List[float]]:
+        """Return the ``k`` chunks best matching the words of a query, by BM25."""
+        match = fts_query(query)
+        if match is None:
+            return [], []
+        condition, params = (filters or SearchFilter()).to_sql()
+        with profiling.span("search.lexical"):
+            rows = self.db.execute(
+                f"""
+                SELECT f.rowid, -bm25(chunks_fts) FROM chunks_fts f
+                JOIN chunks c ON c.id = f.rowid JOIN documents d ON d.id = c.document_id
+                WHERE chunks_fts MATCH ? AND {condition} ORDER BY rank LIMIT ?
+                """,
+                (match, *params, k),
+            ).fetchall()
+        profiling.count("sqlite.rows", len(rows))
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def allowed_chunks(self: "Storage", filters: SearchFilter) -> np.ndarray:
+        """Return the ids of the chunks of the documents matching a filter."""
+        condition, params = filters.to_sql()
+        with profiling.span("search.filter"):
+            rows = self.db.execute(
+                f"""
+                SELECT c.id FROM documents d JOIN chunks c ON c.document_id = d.id
+                WHERE {condition}
+                """,
+                params,
+            ).fetchall()
+        profiling.count("sqlite.rows", len(rows))
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def _vector_candidates(
+        self: "Storage",
+        query_embedding: np.ndarray,
+        k: int,
+        similarity_threshold: Optional[float] = None,
+        ef: Optional[int] = None,
+        filters: Optional[SearchFilter] = None,
+    ) -> Tuple[List[int], List[float]]:
+        """Return the ``k`` chunks most similar to a query embedding."""
+        return self._vector_candidates_many(
+            np.atleast_2d(query_embedding), k, similarity_threshold, ef, filters
+        )[0]
+
+    def _vector_candidates_many(
+        self: "Storage",
+        query_embeddings: np.ndarray,
+        k: int,
+        similarity_threshold: Optional[float] = None,
+        ef: Optional[int] = None,
+        filters: Optional[SearchFilter] = None,
+        num_threads: int = -1,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """Return the ``k`` chunks most similar to each query embedding.
+
+        A filter is resolved to the allowed chunk ids first. A selective filter
+        is scored exactly over the allowed rows, a broad one is passed to hnswlib,
+        which skips the other labels while walking the graph.
+        """
+        allowed = None
+        if filters is not None:
+            allowed = self.allowed_chunks(filters)
+            if not len(allowed):
+                return [([], [])] * len(query_embeddings)
+        if (self.exact.count() or 0) > 100 and (
+            allowed is None or len(allowed) > FILTER_EXACT_ROWS
+        ):
+            return self._hnsw_candidates(
+                query_embeddings, k, similarity_threshold, ef, allowed, num_threads
+            )
+        return self._exact_candidates(query_embeddings, k, similarity_threshold, allowed)
+
+    def _exact_candidates(
+        self: "Storage",
+        query_embeddings: np.ndarray,
+        k: int,
+        similarity_threshold: Optional[float] = None,
+        allowed: Optional[np.ndarray] = None,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """Score the exact search matrix.
+
+        On a quantized matrix, ``RERANK_FACTOR`` times more candidates are
+        fetched, then re-ranked with the full-precision embeddings stored in
+        SQLite, so the returned scores are exact.
+
+        Rows of deleted and replaced chunks stay in the matrix until it is
+        rebuilt, see `compact`. Unless ``allowed`` already holds live chunks only,
+        as many more candidates as there are dead rows are fetched, and the dead
+        ones are dropped, so they can never crowd the live chunks out of the top k.
+        """
+        dead = self._dead_rows() if allowed is None else 0
+        if not self.exact.quantized:
+            with profiling.span("search.exact", queries=len(query_embeddings)):
+                candidates = self.exact.search_many(
+                    query_embeddings, k + dead, similarity_threshold, allowed
+                )
+            candidates = [(chunk_ids.tolist(), scores.tolist()) for chunk_ids, scores in candidates]
+            if not dead:
+                return candidates
+            live = self._live_chunks(
+                {chunk_id for chunk_ids, _ in candidates for chunk_id in chunk_ids}
+            )
+            results = []
+            for chunk_ids, scores in candidates:
+                kept = [(c, score) for c, score in zip(chunk_ids, scores) if c in live][:k]
+                results.append(([c for c, _ in kept], [score for _, score in kept]))
+            return results
+        with profiling.span("search.exact", queries=len(query_embeddings)):
+            candidates = self.exact.search_many(
+                query_embeddings, k * RERANK_FACTOR + dead, None, allowed
+            )
+        with profiling.span("search.rerank_fetch"):
+            vectors = self.chunk_embeddings(
+                {chunk_id for chunk_ids, _ in candidates for chunk_id in chunk_ids.tolist()}
+            )
+        results = []
+        for query, (chunk_ids, _) in zip(normalize(query_embeddings), candidates):
+            # Chunks deleted since the matrix was written are not in SQLite anymore
+            chunk_ids = [chunk_id for chunk_id in chunk_ids.tolist() if chunk_id in vectors]
+            if not chunk_ids:
+                results.append(([], []))
+                continue
+            scores = normalize(np.stack([vectors[chunk_id] for chunk_id in chunk_ids])) @ query
+            top = np.argsort(-scores, kind="stable")[:k]
+            if similarity_threshold is not None:
+                top = top[scores[top] >= similarity_threshold]
+            results.append(([chunk_ids[i] for i in top], scores[top].tolist()))
+        return results
+
+    def vector_recall(self: "Storage", k: int = 10, queries: int = 100) -> Dict[str, float]:
+        """Measure the recall of the vector searches against a full-precision scan.
+
+        Stored chunk embeddings are sampled as queries. Their exact ``k`` nearest
+        chunks are found by scanning all the embeddings stored in SQLite, then
+        compared with the results of the exact search matrix, before and after
+        re-ranking, and of the hnswlib index.
+
+        Args:
+            k (int): Number of neighbors compared per query.
+            queries (int): Number of sampled queries.
+
+        Returns:
+            Dict[str, float]: The recall@k of the ``matrix``, ``reranked`` and ``hnsw``
+            searches, from 0 to 1, with the number of ``queries``, the matrix ``dtype``,
+            and its size in bytes, ``matrix_bytes``, next to its size in float32,
+            ``float32_bytes``.
+        """
+        rows = self.db.execute(
+            "SELECT embedding FROM chunks WHERE embedding IS NOT NULL ORDER BY random() LIMIT ?",
+            (queries,),
+        ).fetchall()
+        vectors = [decode_vector(value) for (value,) in rows]
+        vectors = [vector for vector in vectors if len(vector) == self.exact.dim]
+        report: Dict[str, Any] = {
+            "k": k,
+            "queries": len(vectors),
+            "dtype": self.exact.dtype,
+            "matrix_bytes": self.exact.nbytes(),
+            "float32_bytes": (self.exact.count() or 0) * (self.exact.dim * 4 + 8),
+        }
+        if not vectors:
+            return report
+        query_embeddings = normalize(np.stack(vectors))
+        truth = self._scan_neighbors(query_embeddings, k)
+
+        def recall(results: Iterable[Iterable[int]]) -> float:
+            found = [len(set(expected) & set(result)) for expected, result in zip(truth, results)]
+            return sum(found) / max(sum(len(expected) for expected in truth), 1)
+
+        report["matrix"] = recall(
+            ids.tolist() for ids, _ in self.exact.search_many(query_embeddings, k)
+        )
+        report["reranked"] = recall(
+            ids for ids, _ in self._exact_candidates(query_embeddings, k)
+        )
+        report["hnsw"] = recall(ids for ids, _ in self._hnsw_candidates(query_embeddings, k))
+        return report
+
+    def _scan_neighbors(self: "Storage", query_embeddings: np.ndarray, k: int) -> List[List[int]]:
+        """Return the ``k`` nearest stored chunks of normalized queries, by a full scan."""
+        best_ids = np.empty((len(query_embeddings), 0), dtype=np.int64)
+        best_scores = np.empty((len(query_embeddings), 0), dtype=np.float32)
+        for vectors, chunk_ids in self._embedding_batches():
+            scores = np.hstack([best_scores, query_embeddings @ normalize(vectors).T])
+            ids = np.hstack([best_ids, np.broadcast_to(chunk_ids, (len(scores), len(chunk_ids)))])
+            top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_ids = np.take_along_axis(ids, top, axis=1)
+        return best_ids.tolist()
+
+    def _hnsw_candidates(
+        self: "Storage",
+        query_embeddings: np.ndarray,
+        k: int,
+        similarity_threshold: Optional[float] = None,
+        ef: Optional[int] = None,
+        allowed: Optional[np.ndarray] = None,
+        num_threads: int = -1,
+    ) -> List[Tuple[List[int], List[float]]]:
+        accept = set(allowed.tolist()).__contains__ if allowed is not None else None
+        # Search in hnswlib index, all the queries at once
+        try:
+            labels, distances = self.index.search(
+                query_embeddings, k=k, ef=ef, filter=accept, num_threads=num_threads
+            )
         except RuntimeError as err:
             if "M is too small" in err.args[0]:
                 console.log("Not enough data to do search returning all the documents")
-                doc_ids = self.index.get_ids_list()
-            else:
-                raise err
-        # Fetch documents from SQLite
-        placeholders = ",".join("?" * len(doc_ids))
-        cursor = self.db.cursor()
-        cursor.execute(
-            f"""
-            SELECT id, content, url, title, created_at, embedding, meta
-            FROM documents
-            WHERE id IN ({placeholders})
-            """,
-            doc_ids,
-        )
-        rows = cursor.fetchall()
-        return [
-            Document(
-                id=row[0],
-                content=row[1],
-                url=row[2],
-                title=row[3],
-                created_at=datetime.fromisoformat(row[4]),
-                embedding=np.array(json.loads(row[5])) if row[5] else None,
-                meta=json.loads(row[6]) if row[6] else {},
-            )
-            for row in rows
-        ]
+                chunk_ids = [i for i in self.index.get_ids_list() if accept is None or accept(i)]
+                return [(chunk_ids, [0.0] * len(chunk_ids))] * len(query_embeddings)
+            raise err
+        results = []
+        for chunk_ids, scores in zip(labels.tolist(), (1 - distances).tolist()):
+            # filter results based on similarity threshold
+            if similarity_threshold is not None:
+                kept = [
+                    (chunk_id, score)
+                    for chunk_id, score in zip(chunk_ids, scores)
+                    if score >= similarity_threshold
+                ]
+                chunk_ids = [chunk_id for chunk_id, _ in kept]
+                scores = [score for _, score in kept]
+            results.append((chunk_ids, scores))
+        return results
 
     def close(self: "Storage") -> None:
         """Close database connection and save index."""
+        self.flush_index()
         self.db.close()
 
-    def add(self: "Storage", doc: Document) -> None:
-        """Add a document to the storage.
-
-        Args:
-            doc (Document): Document object to be stored in the database. Must contain
-                content and metadata fields.
-        """
-
     def __enter__(self: "Storage") -> "Storage":
         """Enter the context manager."""
         return self
@@ -318,10 +2216,7 @@ class Storage:
             exc_val (Exception): Value of the exception that was raised during context execution.
             exc_tb (str): Traceback information if an exception occurred during context execution.
         """
-        """Close database connection and save index."""
         self.close()
-        if hasattr(self, "index"):
-            self.index.save_index(self.index_path)
 
 
 if __name__ == "__main__":
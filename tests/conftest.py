@@ -7,7 +7,7 @@ import numpy as np
 import pytest
 
 import kcli.main as main
-from kcli import storage
+from kcli import embeddings, storage
 
 TEST_DIR = ".test_kcli"
 
@@ -22,8 +22,12 @@ def override_paths(request: pytest.FixtureRequest) -> None:
 
     # Set environment variables for this test
     os.environ["KCLI_TEST_MODE"] = "True"
+    # Never talk to a daemon the developer may be running
+    os.environ["KCLI_NO_DAEMON"] = "True"
+    os.environ["KCLI_SOCKET_PATH"] = os.path.join(test_dir, "kcli.sock")
     os.environ["KCLI_DB_PATH"] = os.path.join(test_dir, "test.db")
     os.environ["KCLI_INDEX_PATH"] = os.path.join(test_dir, "test.index")
+    os.environ["KCLI_EMBEDDING_CACHE_PATH"] = os.path.join(test_dir, "cache.sqlite")
 
     # Configure storage with new paths
     storage.configure()
@@ -31,6 +35,7 @@ def override_paths(request: pytest.FixtureRequest) -> None:
     yield
 
     # Cleanup after test
+    embeddings.get_embeddings().close()
     if os.path.exists(test_dir):
         shutil.rmtree(test_dir)
 
@@ -39,5 +44,7 @@ def override_paths(request: pytest.FixtureRequest) -> None:
 def mock_litellm() -> None:
     """Mock litellm to return an array of ones for embeddings."""
     with patch("litellm.embedding") as mock_embedding:
-        mock_embedding.return_value = {"data": [{"embedding": np.ones(1500).tolist()}]}
+        mock_embedding.side_effect = lambda model, input: {
+            "data": [{"embedding": np.ones(1536).tolist()} for _ in input]
+        }
         yield mock_embedding
@@ -0,0 +1,34 @@
+"""Tests for kcli.cli."""
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ("hnswlib", "litellm", "crawl4ai")
+
+
+def _imported_heavy_modules(*args: str) -> list:
+    script = (
+        "import json, sys\n"
+        "from kcli.cli import main\n"
+        "try:\n"
+        "    main(sys.argv[1:])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", script, *args],
+        env=dict(os.environ),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_cheap_commands_do_not_import_heavy_modules() -> None:
+    """Test that --help, doc and stats do not load the index, litellm or crawl4ai."""
+    assert _imported_heavy_modules("--help") == []
+    assert _imported_heavy_modules("doc", "1") == []
+    assert _imported_heavy_modules("stats") == []
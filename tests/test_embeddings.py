@@ -0,0 +1,176 @@
+"""Tests for kcli.embeddings."""
+from datetime import datetime
+from typing import Dict, List
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+from kcli.embeddings import Embeddings
+
+
+def _fake_embedding(model: str, input: List[str]) -> Dict:  # noqa: A002
+    return {"data": [{"embedding": [float(len(text)), 1.0]} for text in input]}
+
+
+def test_embedding_size_does_not_call_the_model(mock_litellm: MagicMock) -> None:
+    """Test that known models and opened databases never probe the model."""
+    from kcli.storage import Storage
+
+    assert Embeddings().embedding_size == 1536
+    storage = Storage()
+    assert storage.get_meta("vector_dim") == "1536"
+    assert storage.get_meta("embedding_model") == "text-embedding-ada-002"
+    mock_litellm.assert_not_called()
+
+
+def test_embedding_cache(mock_litellm: MagicMock) -> None:
+    """Test that cached texts are not sent to the provider again."""
+    mock_litellm.side_effect = _fake_embedding
+    embeddings = Embeddings()
+    first = embeddings.create_embeddings("cached text")
+    second = embeddings.create_embeddings("cached text")
+    assert mock_litellm.call_count == 1
+    assert (first == second).all()
+
+    vectors = embeddings._embed_chunks(["cached text", "new text", "new text"])
+    assert mock_litellm.call_count == 2
+    assert mock_litellm.call_args.kwargs["input"] == ["new text"]
+    assert [v[0] for v in vectors] == [11.0, 8.0, 8.0]
+
+    stats = embeddings.cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["entries"] == 2
+    embeddings.close()
+
+
+def test_embedding_cache_eviction(
+    monkeypatch: pytest.MonkeyPatch, mock_litellm: MagicMock
+) -> None:
+    """Test that the least recently used entries are evicted."""
+    mock_litellm.side_effect = _fake_embedding
+    monkeypatch.setenv("KCLI_EMBEDDING_CACHE_SIZE", "2")
+    embeddings = Embeddings()
+    embeddings._embed_chunks(["a"])
+    embeddings._embed_chunks(["bb"])
+    embeddings._embed_chunks(["a"])
+    embeddings._embed_chunks(["ccc"])
+    cached = embeddings.cache.get_many(embeddings.model_name, ["a", "bb", "ccc"])
+    assert [v is not None for v in cached] == [True, False, True]
+    assert np.array_equal(cached[0], [1.0, 1.0])
+    embeddings.close()
+
+
+def test_other_embedding_model_is_refused(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a knowledge base is not opened with another embedding model."""
+    from kcli import embeddings
+    from kcli.storage import Storage
+
+    Storage()
+    monkeypatch.setattr(embeddings, "_embeddings", None)
+    monkeypatch.setenv("KCLI_EMBEDDING_MODEL", "text-embedding-3-large")
+    with pytest.raises(RuntimeError, match="KCLI_EMBEDDING_MODEL=text-embedding-ada-002"):
+        Storage()
+
+
+def test_embedding_requests_are_bounded(
+    monkeypatch: pytest.MonkeyPatch, mock_litellm: MagicMock
+) -> None:
+    """Test that many chunks are split into requests bounded in items and tokens."""
+    mock_litellm.side_effect = _fake_embedding
+    monkeypatch.setenv("KCLI_EMBEDDING_BATCH_ITEMS", "3")
+    monkeypatch.setenv("KCLI_EMBEDDING_BATCH_TOKENS", "4")
+    monkeypatch.setenv("KCLI_EMBEDDING_CONCURRENCY", "1")
+    embeddings = Embeddings()
+    texts = ["a", "bb", "ccc", "dddd", "e" * 12, "f"]
+    vectors = embeddings._embed_chunks(texts)
+    requests = [call.kwargs["input"] for call in mock_litellm.call_args_list]
+    assert requests == [["a", "bb", "ccc"], ["dddd"], ["e" * 12], ["f"]]
+    assert [v[0] for v in vectors] == [1.0, 2.0, 3.0, 4.0, 12.0, 1.0]
+    embeddings.close()
+
+
+def test_embedding_requests_are_retried(
+    monkeypatch: pytest.MonkeyPatch, mock_litellm: MagicMock
+) -> None:
+    """Test that concurrent requests are retried on rate limits and keep input order."""
+    import threading
+
+    import litellm
+
+    from kcli import embeddings as embeddings_module
+
+    failed = set()
+    lock = threading.Lock()
+
+    def flaky_embedding(model: str, input: List[str]) -> Dict:  # noqa: A002
+        with lock:
+            first_attempt = input[0] not in failed
+            failed.add(input[0])
+        if first_attempt:
+            raise litellm.RateLimitError("slow down", llm_provider="openai", model=model)
+        return _fake_embedding(model, input)
+
+    mock_litellm.side_effect = flaky_embedding
+    monkeypatch.setattr(embeddings_module.time, "sleep", lambda seconds: None)
+    monkeypatch.setenv("KCLI_EMBEDDING_BATCH_ITEMS", "2")
+    embeddings = Embeddings()
+    texts = ["x" * n for n in range(1, 10)]
+    vectors = embeddings._embed_chunks(texts)
+    assert [v[0] for v in vectors] == [float(n) for n in range(1, 10)]
+
+    stats = embeddings.stats.summary()
+    assert stats["requests"] == 5
+    assert stats["retries"] == 5
+    assert stats["items"] == 9
+    assert stats["tokens_per_second"] > 0
+    embeddings.close()
+
+
+def test_local_embedding_model(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: "Path", mock_litellm: MagicMock  # noqa: F821
+) -> None:
+    """Test that the local model embeds and searches offline, deterministically."""
+    from kcli import embeddings as embeddings_module
+    from kcli import storage as storage_module
+    from kcli.local_embeddings import HashingEmbedder
+    from kcli.storage import Chunk, Document, Storage
+
+    vectors = HashingEmbedder(64).encode(["red apple pie", "Apple pie, red!", "blue ocean", ""])
+    assert vectors.shape == (4, 64)
+    assert vectors.dtype == np.float32
+    assert np.allclose(vectors[0], vectors[1])
+    assert vectors[0] @ vectors[2] < 0.5
+    assert not vectors[3].any()
+    assert np.array_equal(HashingEmbedder(64).encode(["blue ocean"])[0], vectors[2])
+
+    monkeypatch.setattr(embeddings_module, "_embeddings", None)
+    monkeypatch.setenv("KCLI_EMBEDDING_MODEL", "local/hashing-64")
+    monkeypatch.setenv("KCLI_DB_PATH", str(tmp_path / "local.db"))
+    monkeypatch.setenv("KCLI_INDEX_PATH", str(tmp_path / "local.index"))
+    storage_module.configure()
+    storage = Storage()
+    assert storage.get_meta("vector_dim") == "64"
+    texts = ["how to bake an apple pie", "sailing on the blue ocean", "tuning sqlite indexes"]
+    spans = embeddings_module.get_embeddings().chunk_and_embed(texts)
+    storage.add_many(
+        [
+            Document(
+                content=text,
+                url=None,
+                title=text,
+                created_at=datetime.now(),
+                embedding=None,
+                meta={},
+                chunks=[Chunk(*span) for span in chunks],
+            )
+            for text, chunks in zip(texts, spans)
+        ]
+    )
+    results = storage.search("apple pie", limit=1)
+    assert results[0].title == texts[0]
+    mock_litellm.assert_not_called()
+
+    with pytest.raises(ValueError, match="local/hashing-<dim>"):
+        embeddings_module.local_model_dim("local/other")
@@ -1,10 +1,14 @@
 """Tests for kcli."""
+import io
 import os
 import tempfile
+import zlib
 from datetime import datetime
+from typing import Dict, List
 from unittest.mock import patch
 
 import numpy as np
+from rich.console import Console
 
 
 def test_add_file() -> None:
@@ -32,10 +36,28 @@ def test_add_file() -> None:
     os.remove(tmp_file_path)
 
 
-def test_search_knowledge_base() -> None:
+def _word_embedding(model: str, input: List[str]) -> Dict:  # noqa: A002
+    """Embed texts as bags of words, so that texts sharing words are similar."""
+    data = []
+    for text in input:
+        vector = np.zeros(1536)
+        for word in text.lower().split():
+            vector[zlib.crc32(word.strip(".,").encode()) % 1536] += 1
+        data.append({"embedding": vector.tolist()})
+    return {"data": data}
+
+
+def _render(table: "Table") -> str:  # noqa: F821
+    console = Console(width=400, record=True, file=io.StringIO())
+    console.print(table)
+    return console.export_text()
+
+
+def test_search_knowledge_base(mock_litellm: "MagicMock") -> None:  # noqa: F821
     """Test the search_knowledge_base function."""
     from kcli.main import add_file, search_knowledge_base
 
+    mock_litellm.side_effect = _word_embedding
     # Create temporary files
     with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp_file1:
         tmp_file1.write("This is the first test document. It contains some keywords.")
@@ -50,46 +72,29 @@ def test_search_knowledge_base() -> None:
     add_file(tmp_file_path2)
 
     # Search for a query that should match both documents
-    search_results = search_knowledge_base("keywords")
-    assert (
-        f"## {os.path.basename(tmp_file_path1)} (file://{tmp_file_path1})"
-        in search_results
-    )
-    assert (
-        "This is the first test document. It contains some keywords." in search_results
-    )
-    assert (
-        f"## {os.path.basename(tmp_file_path2)} (file://{tmp_file_path2})"
-        in search_results
-    )
-    assert (
-        "This is the second test document. It also has some keywords." in search_results
-    )
+    search_results = _render(search_knowledge_base("keywords"))
+    assert os.path.basename(tmp_file_path1) in search_results
+    assert "This is the first test document. It contains some keywords." in search_results
+    assert os.path.basename(tmp_file_path2) in search_results
+    assert "This is the second test document. It also has some keywords." in search_results
 
     # Search for a query that should match only the first document
-    search_results = search_knowledge_base("first test document", limit=1)
-    assert (
-        f"## {os.path.basename(tmp_file_path1)} (file://{tmp_file_path1})"
-        in search_results
-    )
-    assert (
-        "This is the first test document. It contains some keywords." in search_results
-    )
-    assert (
-        f"## {os.path.basename(tmp_file_path2)} (file://{tmp_file_path2})"
-        not in search_results
-    )
+    search_results = _render(search_knowledge_base("first test document", limit=1))
+    assert os.path.basename(tmp_file_path1) in search_results
+    assert "This is the first test document. It contains some keywords." in search_results
+    assert os.path.basename(tmp_file_path2) not in search_results
 
     for i in range(10):
         with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp_file:
             tmp_file.write(f"This is the {i} test document. It also has some keywords.")
-            tmp_file_path = tmp_file2.name
+            tmp_file_path = tmp_file.name
         add_file(tmp_file_path)
+        os.remove(tmp_file_path)
     # Search for a query that should not match any documents
-    search_results = search_knowledge_base(
-        "nonexistent query", similarity_threshold=0.9
-    )
-    assert search_results == ""
+    search_results = search_knowledge_base("nonexistent query", similarity_threshold=0.9)
+    assert search_results is None
+    os.remove(tmp_file_path1)
+    os.remove(tmp_file_path2)
 
 
 def test_crawl_web_content() -> None:
@@ -108,7 +113,7 @@ def test_crawl_web_content() -> None:
             meta={"source": "web"},
         )
         crawl_web_content("https://example.com")
-        mock_process_url.assert_called_once_with("https://example.com")
+        mock_process_url.assert_called_once_with("https://example.com/")
 
         results = storage.query(
             "SELECT * FROM documents WHERE url = 'https://example.com'"
@@ -143,3 +148,346 @@ def test_get_document_by_id() -> None:
     assert retrieved_doc.content == "This is a test document for get_document_by_id."
     assert retrieved_doc.title == os.path.basename(tmp_file_path)
     os.remove(tmp_file_path)
+
+
+def test_migrate_json_embeddings() -> None:
+    """Test that a pre-versioned database is migrated to the current schema."""
+    import json
+    import sqlite3
+
+    from kcli import storage as storage_module
+    from kcli.main import close_storage, get_document_by_id, get_storage, migrate_database
+
+    # Replace the test database by one created by the first kcli version
+    close_storage()
+    os.remove(storage_module.DB_PATH)
+    db = sqlite3.connect(storage_module.DB_PATH)
+    db.execute(
+        """
+        CREATE TABLE documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT,
+            url TEXT,
+            title TEXT,
+            created_at TEXT,
+            embedding float[1536],
+            meta TEXT
+        );
+        """
+    )
+    db.execute(
+        """
+        INSERT INTO documents (content, url, title, created_at, embedding, meta)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        ("legacy", None, "legacy", datetime.now().isoformat(), json.dumps([0.5] * 1536), None),
+    )
+    db.commit()
+    db.close()
+
+    storage = get_storage()
+    assert storage.get_meta("schema_version") == "1"
+    assert migrate_database(batch_size=1) == 1
+    # The vector moved to the document's chunk, its mean is derived on read
+    row = storage.db.execute(
+        "SELECT typeof(embedding), length(embedding) FROM chunks"
+    ).fetchone()
+    assert row == ("blob", 1536 * 4)
+    assert storage.db.execute("SELECT embedding FROM documents").fetchone() == (None,)
+    assert storage.get_meta("schema_version") == "4"
+    assert storage.get_meta("vector_dtype") == "float32"
+    doc = get_document_by_id(1)
+    assert doc.embedding.dtype == np.float32
+    assert (doc.embedding == 0.5).all()
+
+    # The document was split into a chunk and can be found
+    chunks = storage.db.execute(
+        "SELECT document_id, start_offset, end_offset FROM chunks"
+    ).fetchall()
+    assert chunks == [(1, 0, len("legacy"))]
+    results = storage.search("legacy")
+    assert [result.id for result in results] == [1]
+    assert results[0].passages[0].text == "legacy"
+
+
+def test_add_directory(mock_litellm: "MagicMock") -> None:  # noqa: F821
+    """Test bulk ingestion of a directory in batches."""
+    from kcli.main import add_directory, get_storage
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "docs", "skip"))
+        for i in range(5):
+            with open(os.path.join(directory, "docs", f"{i}.md"), "w") as f:
+                f.write(f"Document number {i}")
+        with open(os.path.join(directory, "docs", "skip", "x.md"), "w") as f:
+            f.write("excluded")
+        with open(os.path.join(directory, "docs", "empty.md"), "w") as f:
+            f.write("  ")
+        with open(os.path.join(directory, "notes.txt"), "w") as f:
+            f.write("not matched")
+
+        summary = add_directory(
+            directory, ["**/*.md"], ["docs/skip/*"], workers=2, batch_docs=2
+        )
+
+    assert summary["files"] == 6
+    assert summary["documents"] == 5
+    assert summary["skipped"] == 1
+    assert summary["chunks"] == 5
+    assert mock_litellm.call_count == 3
+    storage = get_storage()
+    assert storage.db.execute("SELECT COUNT(*) FROM documents").fetchone() == (5,)
+    assert sorted(storage.index.get_ids_list()) == [1, 2, 3, 4, 5]
+    assert storage.exact.count() == 5
+
+
+def test_sync_sources(mock_litellm: "MagicMock") -> None:  # noqa: F821
+    """Test that sync only re-embeds changed chunks and removes deleted files."""
+    from kcli.main import add_directory, get_storage, sync_sources
+
+    storage = get_storage()
+    storage.embeddings.chunk_size = 100
+    paragraph = "word " * 30
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f"{i}.md") for i in range(3)]
+        for i, path in enumerate(paths):
+            with open(path, "w") as f:
+                f.write(f"{i} {paragraph}\n{paragraph}\nend of file {i}")
+        add_directory(directory, ["*.md"])
+        chunks = storage.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        calls = mock_litellm.call_count
+
+        summary = sync_sources()
+        assert summary["unchanged"] == 3
+        assert summary["chunks"] == 0
+        assert mock_litellm.call_count == calls
+
+        with open(paths[0], "a") as f:
+            f.write(" and a new ending")
+        os.remove(paths[1])
+        with open(os.path.join(directory, "3.md"), "w") as f:
+            f.write("a new file")
+        summary = sync_sources()
+
+    assert summary["updated"] == 1
+    assert summary["removed"] == 1
+    assert summary["added"] == 1
+    # Only the chunks of the changed file that differ, and the new file, are embedded
+    updated = len(storage._chunk_texts(1))
+    assert summary["reused"] > 0
+    assert summary["chunks"] == updated - summary["reused"] + 1
+    doc = storage.get_document_by_id(1)
+    assert doc.content.endswith("and a new ending")
+    assert storage._chunk_texts(1)[-1][0].endswith("and a new ending")
+    assert storage.get_document_by_id(2) is None
+    (count,) = storage.db.execute("SELECT COUNT(*) FROM chunks").fetchone()
+    assert count == chunks // 3 + updated + 1
+
+
+def test_read_files_bounds_read_ahead() -> None:
+    """Test that files are read in order, at most a window ahead of the consumer."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from kcli.main import _read_files
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(10):
+            paths.append(os.path.join(directory, f"{i}.txt"))
+            with open(paths[-1], "w") as f:
+                f.write(str(i))
+        with ThreadPoolExecutor(2) as pool, patch.object(
+            pool, "submit", wraps=pool.submit
+        ) as submit:
+            reader = _read_files(pool, paths, window=3)
+            assert next(reader)[1] == "0"
+            assert submit.call_count == 4
+            assert [content for _, content, _ in reader] == [str(i) for i in range(1, 10)]
+
+
+def test_crawl_urls_shares_one_browser() -> None:
+    """Test that many URLs are crawled by one browser and stored in batches."""
+    from types import SimpleNamespace
+
+    from kcli.main import crawl_urls, get_storage
+
+    class FakeCrawler:
+        instances = 0
+
+        def __init__(self, config: object) -> None:
+            FakeCrawler.instances += 1
+
+        async def __aenter__(self) -> "FakeCrawler":
+            return self
+
+        async def __aexit__(self, *args: object) -> None:
+            pass
+
+        async def arun(self, url: str, config: object) -> SimpleNamespace:
+            if url.endswith("broken"):
+                return None
+            # Two URLs serve the same page
+            page = url.replace("/copy", "/0")
+            return SimpleNamespace(markdown=f"Page at {page}", metadata={"title": page})
+
+    urls = [f"https://example.com/{i}" for i in range(5)]
+    urls += ["https://example.com/copy", "https://example.com/broken", urls[0]]
+    # Spelled like the crawl frontier stores it, see `normalize_url`
+    urls += ["HTTPS://Example.com:443/1#intro", "ftp://example.com/file"]
+    with patch("crawl4ai.AsyncWebCrawler", FakeCrawler), patch.object(
+        get_storage(), "add_many", wraps=get_storage().add_many
+    ) as add_many:
+        summary = crawl_urls(urls, concurrency=3, batch_size=2)
+
+    assert FakeCrawler.instances == 1
+    assert summary["urls"] == 8
+    assert summary["documents"] == 5
+    assert summary["skipped"] == 1
+    assert summary["failed"] == 2
+    assert all(len(call.args[0]) <= 2 for call in add_many.call_args_list)
+    rows = get_storage().db.execute("SELECT url FROM documents ORDER BY url").fetchall()
+    assert len(rows) == 5 and ("https://example.com/1",) in rows
+
+
+def test_crawl_site_follows_links() -> None:
+    """Test that links are followed up to the depth, on the seed's host, and resumed."""
+    from types import SimpleNamespace
+
+    from kcli.main import crawl_site, get_storage
+
+    site = {
+        "https://example.com/": ["/a", "b#top", "https://other.org/x"],
+        "https://example.com/a": ["/c", "/"],
+        "https://example.com/b": ["/c"],
+        "https://example.com/c": ["/d"],
+        "https://other.org/x": [],
+    }
+
+    class FakeCrawler:
+        fetched: List[str] = []
+
+        def __init__(self, config: object) -> None:
+            pass
+
+        async def __aenter__(self) -> "FakeCrawler":
+            return self
+
+        async def __aexit__(self, *args: object) -> None:
+            pass
+
+        async def arun(self, url: str, config: object) -> SimpleNamespace:
+            FakeCrawler.fetched.append(url)
+            links = {"internal": [{"href": href} for href in site.get(url, [])]}
+            return SimpleNamespace(markdown=f"Page at {url}", metadata={}, links=links)
+
+    with patch("crawl4ai.AsyncWebCrawler", FakeCrawler):
+        summary = crawl_site(["https://EXAMPLE.com"], depth=2, delay=0, batch_size=2)
+
+    assert sorted(FakeCrawler.fetched) == [
+        "https://example.com/",
+        "https://example.com/a",
+        "https://example.com/b",
+        "https://example.com/c",
+    ]
+    assert summary["documents"] == 4
+    # A URL left pending by an interrupted crawl is resumed, stored URLs are not refetched
+    storage = get_storage()
+    assert storage.pending_urls() == []
+    storage.enqueue_urls([("https://example.com/d", 0, 0, "example.com")])
+    FakeCrawler.fetched = []
+    with patch("crawl4ai.AsyncWebCrawler", FakeCrawler):
+        summary = crawl_site(["https://example.com/a"], depth=2, delay=0)
+    assert FakeCrawler.fetched == ["https://example.com/d"]
+    assert summary["documents"] == 1
+    assert storage.pending_urls() == []
+
+
+def test_search_batch_cli(mock_litellm: "MagicMock") -> None:  # noqa: F821
+    """Test that a batch of queries is embedded and searched together, as JSON lines."""
+    import json
+
+    from click.testing import CliRunner
+
+    from kcli.cli import main
+    from kcli.main import add_file, get_storage
+
+    mock_litellm.side_effect = _word_embedding
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, text in (("cats.md", "cats purr and sleep"), ("dogs.md", "dogs bark loudly")):
+            path = os.path.join(tmp_dir, name)
+            with open(path, "w") as f:
+                f.write(text)
+            add_file(path)
+        calls = mock_litellm.call_count
+        with patch.object(
+            get_storage().exact, "search_many", wraps=get_storage().exact.search_many
+        ) as search_many:
+            result = CliRunner().invoke(
+                main, ["search", "--batch", "-", "--limit", "1"], input="cats purr\n\ndogs bark\n"
+            )
+    assert result.exit_code == 0, result.output
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert [r["query"] for r in records] == ["cats purr", "dogs bark"]
+    assert [r["results"][0]["title"] for r in records] == ["cats.md", "dogs.md"]
+    assert records[0]["results"][0]["passages"][0]["text"] == "cats purr and sleep"
+    assert mock_litellm.call_count == calls + 1
+    assert search_many.call_count == 1
+
+
+def test_daemon_serves_the_cli(monkeypatch: "pytest.MonkeyPatch") -> None:  # noqa: F821
+    """Test that the CLI adds, searches and reads documents through a running daemon."""
+    import shutil
+    import subprocess
+    import sys
+    import time
+
+    from click.testing import CliRunner
+
+    from kcli.cli import main
+    from kcli.main import get_document_by_id
+
+    tmp_dir = tempfile.mkdtemp()
+    # Unix socket paths are limited to about 100 characters
+    socket_path = os.path.join(tmp_dir, "kcli.sock")
+    env = {
+        **os.environ,
+        "KCLI_EMBEDDING_MODEL": "local/hashing-64",
+        "KCLI_DB_PATH": os.path.join(tmp_dir, "kcli.db"),
+        "KCLI_INDEX_PATH": os.path.join(tmp_dir, "kcli.index"),
+        "KCLI_EMBEDDING_CACHE_PATH": os.path.join(tmp_dir, "cache.sqlite"),
+        "KCLI_SOCKET_PATH": socket_path,
+    }
+    daemon = subprocess.Popen([sys.executable, "-m", "kcli.cli", "serve"], env=env)
+    try:
+        deadline = time.monotonic() + 60
+        while not os.path.exists(socket_path):
+            assert daemon.poll() is None and time.monotonic() < deadline
+            time.sleep(0.1)
+        monkeypatch.delenv("KCLI_NO_DAEMON")
+        monkeypatch.setenv("KCLI_SOCKET_PATH", socket_path)
+        path = os.path.join(tmp_dir, "cats.md")
+        with open(path, "w") as f:
+            f.write("cats purr and sleep all day")
+
+        runner = CliRunner()
+        assert runner.invoke(main, ["add", path]).exit_code == 0
+        result = runner.invoke(main, ["search", "cats sleeping"])
+        assert result.exit_code == 0, result.output
+        assert "cats.md" in result.output
+        result = runner.invoke(main, ["doc", "1"])
+        assert "cats purr and sleep all day" in result.output
+        # Nothing was written to the database of the test
+        assert get_document_by_id(1) is None
+        # In-process writers would have their index overwritten by the daemon
+        for command in (["migrate"], ["--profile", "add", path]):
+            result = runner.invoke(main, command)
+            assert result.exit_code == 1 and "Stop the daemon first" in result.output
+        monkeypatch.setenv("KCLI_NO_DAEMON", "1")
+        result = runner.invoke(main, ["rm", "1", "--yes"])
+        assert result.exit_code == 1 and "Stop the daemon first" in result.output
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=30)
+    assert daemon.returncode == 0
+    assert not os.path.exists(socket_path)
+    shutil.rmtree(tmp_dir)
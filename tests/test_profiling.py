@@ -0,0 +1,73 @@
+"""Tests for kcli.profiling."""
+import json
+import os
+import tempfile
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import pytest
+
+from kcli import profiling
+
+
+@pytest.fixture(autouse=True)
+def profiling_off() -> None:
+    """Leave profiling disabled after each test."""
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def test_spans_and_counters_of_a_search() -> None:
+    """Test that a search records its stages and counters, and feeds the hooks."""
+    from kcli.main import get_storage
+    from kcli.storage import Document
+
+    storage = get_storage()
+    for i in range(3):
+        vector = np.zeros(storage.vector_dim)
+        vector[i] = 1
+        storage.add(Document(f"doc {i}", None, f"doc {i}", datetime.now(), vector, {}))
+
+    assert profiling.span("idle") is profiling.span("other")  # the shared no-op
+    received: List[profiling.Span] = []
+    profiling.add_hook(received.append)
+    profiling.enable()
+    try:
+        storage.search("doc", limit=2)
+    finally:
+        profiling.remove_hook(received.append)
+    summary = profiling.summary()
+    assert {"search", "search.embed_query", "sqlite.fetch_passages"} <= summary["stages"].keys()
+    assert summary["stages"]["search"]["calls"] == 1
+    # Passages are only read for the page of 2 documents, out of 3 candidates
+    assert summary["counters"]["sqlite.rows"] == 2
+    assert "sqlite.chunk_documents" in summary["stages"]
+    assert [span.name for span in received][-1] == "search"
+    trace = profiling.chrome_trace()
+    assert {event["name"] for event in trace["traceEvents"]} == summary["stages"].keys()
+
+    profiling.disable()
+    storage.search("doc", limit=2)
+    assert profiling.summary()["stages"]["search"]["calls"] == 1
+
+
+@pytest.mark.parametrize("options", [["--profile-format", "json"], []])
+def test_profile_option_writes_json(options: List[str]) -> None:
+    """Test that the global --profile option reports the stages of a command."""
+    from click.testing import CliRunner
+
+    from kcli.cli import main
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, "profile.json")
+        result = CliRunner().invoke(
+            main, ["--profile", *options, "--profile-output", output, "search", "x"]
+        )
+        assert result.exit_code == 0, result.output
+        with open(output) as f:
+            summary = json.load(f)
+    assert "search" in summary["stages"]
+    assert summary["wall_ms"] > 0
+    assert not profiling.is_enabled()
@@ -0,0 +1,418 @@
+"""Tests for kcli.storage."""
+import os
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import pytest
+
+from kcli.storage import Chunk, Document, Storage, encode_vector
+
+
+def _document(content: str, embedding: np.ndarray) -> Document:
+    return Document(
+        content=content,
+        url=None,
+        title=content,
+        created_at=datetime.now(),
+        embedding=embedding,
+        meta={},
+    )
+
+
+def test_exact_index_search_and_rebuild() -> None:
+    """Test the memory-mapped exact search and its resync with SQLite."""
+    storage = Storage()
+    dim = storage.exact.dim
+    basis = np.eye(dim)
+    for i in range(3):
+        storage.add(_document(f"doc {i}", basis[i] + 0.1 * basis[3]))
+
+    doc_ids, scores = storage.exact.search(basis[1], k=2)
+    assert doc_ids.tolist()[0] == 2
+    assert scores[0] > scores[1]
+
+    # A missing matrix is rebuilt from the embeddings stored in SQLite
+    os.remove(storage.exact.vectors_path)
+    storage = Storage()
+    assert storage.exact.count() == 3
+    assert storage.exact.search(basis[2], k=1)[0].tolist() == [3]
+
+
+def test_index_grows_and_keeps_its_parameters(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the index resizes itself and reloads with the stored parameters."""
+    monkeypatch.setenv("KCLI_HNSW_INITIAL_CAPACITY", "4")
+    monkeypatch.setenv("KCLI_HNSW_M", "8")
+    storage = Storage()
+    vectors = np.random.default_rng(0).normal(size=(10, storage.vector_dim))
+    for i, vector in enumerate(vectors):
+        storage.add(_document(f"doc {i}", vector))
+    assert storage.index.element_count == 10
+    assert storage.index.max_elements == 16
+
+    monkeypatch.delenv("KCLI_HNSW_M")
+    monkeypatch.setenv("KCLI_HNSW_EF_SEARCH", "64")
+    storage = Storage()
+    assert storage.index.params.M == 8
+    assert storage.index.params.ef_search == 64
+    assert storage.get_meta("hnsw_m") == "8"
+
+    labels, _ = storage.index.search(vectors[3], k=20, ef=100)
+    assert labels[0][0] == 4
+    assert len(labels[0]) == 10
+    assert storage.index.hnsw.ef == 64
+
+
+def test_index_journal_is_replayed_and_flushed(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that unflushed vectors survive a crash and are flushed in batches."""
+    monkeypatch.setenv("KCLI_INDEX_FLUSH_ITEMS", "3")
+    storage = Storage()
+    vectors = np.random.default_rng(1).normal(size=(4, storage.vector_dim))
+    for i, vector in enumerate(vectors[:2]):
+        storage.add(_document(f"doc {i}", vector))
+    assert storage._index is None
+    assert not os.path.exists(storage.index_path)
+
+    # Simulate a crash: a new storage replays the journal into the index
+    storage = Storage()
+    assert sorted(storage.index.get_ids_list()) == [1, 2]
+    assert storage.index.search(vectors[1], k=1)[0][0].tolist() == [2]
+
+    storage.add(_document("doc 2", vectors[2]))
+    assert os.path.exists(storage.index_path)
+    assert storage.db.execute("SELECT COUNT(*) FROM index_journal").fetchone() == (0,)
+
+    storage.add(_document("doc 3", vectors[3]))
+    storage.close()
+    storage = Storage()
+    assert storage.db.execute("SELECT COUNT(*) FROM index_journal").fetchone() == (0,)
+    assert sorted(storage.index.get_ids_list()) == [1, 2, 3, 4]
+
+
+def test_search_returns_matching_passages(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that chunks are indexed on their own and grouped by document."""
+    storage = Storage()
+    basis = np.eye(storage.vector_dim)
+    content = "intro about cats. details about dogs."
+    doc = Document(
+        content=content,
+        url=None,
+        title="pets",
+        created_at=datetime.now(),
+        embedding=None,
+        meta={},
+        chunks=[Chunk(0, 17, basis[0]), Chunk(18, 37, basis[1] + 0.1 * basis[2])],
+    )
+    assert doc.embedding is not None
+    storage.add(doc)
+    storage.add(_document("unrelated", basis[2]))
+
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", lambda text: basis[1])
+    results = storage.search("dogs", limit=1)
+    assert [result.id for result in results] == [1]
+    best = results[0].passages[0]
+    assert (best.start, best.end, best.text) == (18, 37, "details about dogs.")
+    assert results[0].score == pytest.approx(best.score)
+
+    # Only the chunk vectors are stored, the document vector is derived from them
+    stored = storage.db.execute("SELECT embedding FROM documents").fetchall()
+    assert stored == [(None,), (None,)]
+    chunk_bytes = storage.db.execute("SELECT sum(length(embedding)) FROM chunks").fetchone()[0]
+    assert storage.get_stats()["vector_bytes"] == chunk_bytes
+    assert np.allclose(storage.get_document_by_id(1).embedding, doc.embedding)
+
+    # A version 2 database, one vector per document, is upgraded when opened
+    vectors = {1: doc.embedding, 2: basis[2]}
+    for doc_id, vector in vectors.items():
+        storage.db.execute(
+            "UPDATE documents SET embedding = ? WHERE id = ?", (encode_vector(vector), doc_id)
+        )
+    storage.db.execute("DELETE FROM chunks")
+    storage.set_meta("schema_version", "2")
+    storage.db.commit()
+    storage = Storage()
+    assert storage.get_meta("schema_version") == "4"
+    assert storage.db.execute("SELECT embedding FROM documents").fetchall() == stored
+    rows = storage.db.execute(
+        "SELECT id, document_id, start_offset, end_offset FROM chunks ORDER BY id"
+    ).fetchall()
+    assert [row[1:] for row in rows] == [(1, 0, len(content)), (2, 0, len("unrelated"))]
+    assert sorted(storage.index.get_ids_list()) == [row[0] for row in rows]
+    assert storage.exact.count() == 2
+
+
+def test_duplicates_are_found_by_hash() -> None:
+    """Test that content is deduplicated through the hash index, before embedding."""
+    storage = Storage()
+    vector = np.ones(storage.vector_dim)
+    assert storage.add_many([_document("same\r\n", vector), _document("same", vector)])
+    assert storage.add_many([_document("  same", vector)]) == []
+    assert storage.find_contents(["same", "other"]) == [1, None]
+    plan = storage.db.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM documents WHERE content_hash = ?", ("x",)
+    ).fetchall()
+    assert "documents_content_hash" in plan[0][3]
+
+    # Databases created before the column existed are backfilled when opened
+    storage.db.execute("DROP INDEX documents_content_hash")
+    storage.db.execute("DROP INDEX documents_file")
+    storage.db.execute("ALTER TABLE documents DROP COLUMN content_hash")
+    storage.db.commit()
+    storage = Storage()
+    assert storage.find_contents(["same"]) == [1]
+
+
+def test_lexical_and_hybrid_search(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the full-text index follows the chunks and is fused with vector search."""
+    storage = Storage()
+    basis = np.eye(storage.vector_dim)
+    storage.add(_document("call get_storage to open the knowledge base", basis[0]))
+    storage.add(_document("ruff reports E501 for long lines", basis[1]))
+    storage.add(_document("storage of vectors on disk", basis[2]))
+
+    def no_embedding(text: str) -> np.ndarray:
+        raise AssertionError("lexical search must not embed the query")
+
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", no_embedding)
+    assert [r.id for r in storage.search("E501", mode="lexical")] == [2]
+    assert [r.id for r in storage.search("get_storage()", mode="lexical")] == [1]
+    assert storage.search("AND (", mode="lexical") == []
+
+    # Hybrid ranks first what both searches agree on
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", lambda text: basis[2])
+    results = storage.search("storage", mode="hybrid")
+    assert [r.id for r in results][:2] == [3, 1]
+    assert results[0].score > results[1].score
+
+    updated = _document("ruff reports W291 for trailing spaces", basis[1])
+    updated.id = 2
+    updated.chunks = [Chunk(0, len(updated.content), basis[1])]
+    storage.update_document(updated)
+    storage.delete_document(1)
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", no_embedding)
+    assert storage.search("E501", mode="lexical") == []
+    assert [r.id for r in storage.search("W291", mode="lexical")] == [2]
+    assert [r.id for r in storage.search("storage", mode="lexical")] == [3]
+    with pytest.raises(ValueError, match="lexical"):
+        storage.search("storage", mode="fuzzy")
+
+
+def test_search_filters(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that filters are applied within the index search, in every mode."""
+    from datetime import timedelta
+
+    from kcli import storage as storage_module
+    from kcli.storage import SearchFilter
+
+    storage = Storage()
+    rng = np.random.default_rng(0)
+    docs = []
+    for i in range(150):
+        doc = _document(f"page {i} about release notes", rng.normal(size=storage.vector_dim))
+        if i % 3 == 0:
+            doc.url = f"https://docs.example.com/{i}"
+            doc.meta = {"source": "web"}
+        else:
+            doc.meta = {"file_path": f"/src/{'app' if i % 3 == 1 else 'app2'}/{i}.py"}
+        doc.created_at = datetime(2024, 1, 1) + timedelta(days=i)
+        docs.append(doc)
+    storage.add_many(docs)
+    query = docs[0].embedding
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", lambda text: query)
+
+    def ids(filters: SearchFilter, **kwargs: object) -> List[int]:
+        return [r.id for r in storage.search("release", limit=5, filters=filters, **kwargs)]
+
+    web = SearchFilter(source="web")
+    assert ids(web)[0] == 1
+    assert len(ids(web)) == 5 and all((i - 1) % 3 == 0 for i in ids(web))
+    app = ids(SearchFilter(path_prefix="/src/app"))
+    assert len(app) == 5 and all((i - 1) % 3 == 1 for i in app)
+    assert ids(SearchFilter(path_prefix="/src/app/4.py")) == [5]
+    assert all(i > 100 for i in ids(SearchFilter(since=datetime(2024, 4, 10))))
+    assert ids(SearchFilter(url_prefix="https://other.org/")) == []
+    for mode in ("lexical", "hybrid"):
+        assert all((i - 1) % 3 == 0 for i in ids(web, mode=mode))
+        assert len(ids(web, mode=mode)) == 5
+
+    # Broad filters go through the hnswlib filter callback
+    monkeypatch.setattr(storage_module, "FILTER_EXACT_ROWS", 0)
+    assert ids(web)[0] == 1
+    assert len(ids(web)) == 5 and all((i - 1) % 3 == 0 for i in ids(web))
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_quantized_exact_index(monkeypatch: pytest.MonkeyPatch, dtype: str) -> None:
+    """Test that a quantized matrix is smaller, and re-ranked to exact scores."""
+    from kcli import storage as storage_module
+    from kcli.exact import normalize
+
+    monkeypatch.setattr(storage_module, "MATRIX_TYPE", dtype)
+    storage = Storage()
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(150, storage.vector_dim))
+    storage.add_many([_document(f"doc {i}", v) for i, v in enumerate(vectors)])
+    assert storage.exact.count() == 150
+    ratio = {"int8": 3.9, "float16": 1.9}[dtype]
+    assert storage.exact.nbytes() * ratio < 150 * (storage.vector_dim * 4 + 8)
+
+    queries = vectors[:5] + rng.normal(scale=0.5, size=(5, storage.vector_dim))
+    expected = normalize(queries) @ normalize(vectors).T
+    for query_scores, (chunk_ids, scores) in zip(
+        expected, storage._exact_candidates(queries, k=3)
+    ):
+        top = np.argsort(-query_scores)[:3]
+        assert chunk_ids == (top + 1).tolist()
+        np.testing.assert_allclose(scores, query_scores[top], rtol=1e-5)
+
+    report = storage.vector_recall(k=5, queries=20)
+    assert report["queries"] == 20
+    assert report["reranked"] == 1.0
+    assert report["matrix"] >= 0.9
+
+    # Going back to float32 rebuilds the matrix and drops the quantized files
+    quantized_path = storage.exact.vectors_path
+    monkeypatch.setattr(storage_module, "MATRIX_TYPE", "float32")
+    storage = Storage()
+    assert storage.exact.count() == 150
+    assert not os.path.exists(quantized_path)
+
+
+def test_stats_follow_writes_without_scans() -> None:
+    """Test that the maintained aggregates match a full recount after writes."""
+    storage = Storage()
+    storage.index  # noqa: B018, the removed chunks are then deleted labels of the index
+    vectors = np.random.default_rng(2).normal(size=(4, storage.vector_dim))
+    for i, vector in enumerate(vectors[:3]):
+        storage.add(_document(f"doc {i}", vector))
+    doc = _document("doc 1, longer", vectors[3])
+    doc.id = 2
+    doc.meta = {"source": "web"}
+    doc.chunks = [Chunk(0, len(doc.content), vectors[3])]
+    storage.update_document(doc)
+    storage.delete_document(1)
+
+    stats = storage.get_stats()
+    assert stats["documents"] == 2
+    assert stats["documents_by_source"] == {"other": 1, "web": 1}
+    assert stats["content_bytes"] == len("doc 2") + len("doc 1, longer")
+
+    def aggregates() -> dict:
+        rows = storage.db.execute("SELECT key, value FROM kcli_stats WHERE key != 'updated_at'")
+        return {key: value for key, value in rows if value}
+
+    maintained = aggregates()
+    storage.rebuild_stats()
+    assert aggregates() == maintained
+
+    storage.flush_index()
+    storage.close()
+    stats = Storage().get_stats()
+    assert stats["index"]["elements"] == stats["chunks"] + stats["index"]["deleted"]
+    assert stats["index"]["deleted"] > 0
+    assert stats["index"]["pending"] == 0
+    assert stats["index_bytes"] > 0 and stats["matrix_bytes"] > 0
+
+
+def test_pages_are_updated_deleted_and_compacted(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test update in place by URL, deletion by URL prefix, and compaction."""
+    from kcli import storage as storage_module
+
+    monkeypatch.setattr(storage_module, "COMPACT_THRESHOLD", 0.3)
+    storage = Storage()
+    vectors = np.random.default_rng(3).normal(size=(11, storage.vector_dim))
+    pages = []
+    for i, vector in enumerate(vectors[:10]):
+        page = _document(f"page {i}", vector)
+        page.url = f"https://example.com/{'old' if i < 4 else 'docs'}/{i}"
+        pages.append(page)
+    storage.add_many(pages)
+
+    changed = _document("page 5, edited", vectors[10])
+    changed.url = pages[5].url
+    changed.chunks = [Chunk(0, len(changed.content), vectors[10])]
+    assert storage.update_pages([changed, pages[6]]) == [pages[6]]
+    assert changed.id == pages[5].id
+    assert storage.get_document_by_id(pages[5].id).content == "page 5, edited"
+
+    # Two stored pages now with the same content: the second is a duplicate of the first
+    same = []
+    for i in (8, 9):
+        page = _document("moved to a single page", vectors[10])
+        page.url = pages[i].url
+        page.chunks = [Chunk(0, len(page.content), vectors[10])]
+        same.append(page)
+    assert storage.update_pages(same) == [same[1]]
+    assert storage.get_document_by_id(pages[8].id).content == "moved to a single page"
+    assert storage.get_document_by_id(pages[9].id) is None
+
+    assert [doc_id for doc_id, _, _ in storage.find_documents("3")] == [3]
+    old = [doc_id for doc_id, _, _ in storage.find_documents("https://example.com/old/")]
+    assert old == [1, 2, 3, 4]
+    assert storage.delete_documents(old) == 4
+    tombstones = storage.tombstones()
+    assert (tombstones["index"], tombstones["matrix"]) == (7, 7)
+    assert tombstones["due"]
+
+    result = storage.compact()
+    assert result["compacted"] and result["vectors"] == 5
+    assert storage.tombstones() == {"index": 0, "matrix": 0, "ratio": 0.0, "due": False}
+    assert not storage.compact()["compacted"]
+    storage.close()
+
+    storage = Storage()
+    assert sorted(storage.index.get_ids_list()) == sorted(storage.exact._load()[1].tolist())
+    assert {result.id for result in storage.search("page", limit=10)}.isdisjoint(old)
+
+
+def test_search_pages_and_snippets(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that pages of results follow the full ranking, with passages cut in SQL."""
+    storage = Storage()
+    rng = np.random.default_rng(4)
+    vectors = rng.normal(size=(12, storage.vector_dim))
+    docs = []
+    for i, vector in enumerate(vectors):
+        doc = _document(f"document number {i} " * 20, vector)
+        middle = len(doc.content) // 2
+        doc.chunks = [
+            Chunk(0, middle, vector),
+            Chunk(middle, len(doc.content), vector + rng.normal(scale=0.5, size=len(vector))),
+        ]
+        docs.append(doc)
+    storage.add_many(docs)
+    query = vectors[0] + vectors[1]
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", lambda text: query)
+    monkeypatch.setattr(storage.embeddings, "batch_embed", lambda texts: [query] * len(texts))
+
+    ranking = [result.id for result in storage.search("q", limit=9)]
+    pages = [storage.search("q", limit=3, offset=offset) for offset in (0, 3, 6)]
+    assert [result.id for page in pages for result in page] == ranking
+    assert [[result.id for result in page] for page in storage.search_many(["q"], 3, offset=3)] == [
+        ranking[3:6]
+    ]
+
+    (result,) = storage.search("q", limit=1, passage_chars=10)
+    assert [len(passage.text) for passage in result.passages] == [10] * len(result.passages)
+    assert result.passages[0].end - result.passages[0].start > 10
+
+
+def test_updated_document_is_found_among_dead_rows(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that replaced chunks left in the exact matrix never hide the live one."""
+    storage = Storage()
+    rng = np.random.default_rng(5)
+    query = rng.normal(size=storage.vector_dim)
+    storage.add_many(
+        [_document(f"page {i}", rng.normal(size=storage.vector_dim)) for i in range(7)]
+    )
+    for version in range(59):
+        vector = query + rng.normal(scale=0.1, size=len(query))
+        doc = _document(f"page 0, version {version}", vector)
+        doc.id = 1
+        doc.chunks = [Chunk(0, len(doc.content), doc.embedding)]
+        storage.update_document(doc)
+    assert storage.exact.count() == 66
+
+    monkeypatch.setattr(storage.embeddings, "create_embeddings", lambda text: query)
+    results = storage.search("page", limit=5)
+    assert [result.id for result in results][0] == 1
+    assert len(results) == 5